@@ -20,6 +20,10 @@ import json
 from pkg_resources import resource_filename as pkgrf
 from io import open
 
+from cappat.transfer import Uploader, ImageStore, run_concurrently
+from cappat.session import AgaveSession
+from cappat.metrics import METRICS
+
 logging.basicConfig()
 logger = logging.getLogger('appgen')
 logger.setLevel(logging.INFO)
@@ -61,51 +65,45 @@ class CappatAgaveClient(object):
     AGAVE_CAPPAT_CLIENT = 'cappat-client'
     AGAVE_BASEURL = 'https://api.tacc.utexas.edu'
     AGAVE_SESSION_FILE = op.expanduser('~/.agave/current')
-
-    def __init__(self, app_desc=None, auth=None):
-        """Creates an Agave session object"""
-        from agavepy.agave import Agave
+    _uploader = None
+    _image_store = None
+    # Ids of the registered apps, listed once per session
+    _app_ids = None
+    # Root folder of the storage systems
+    _root_dirs = None
+
+    def __init__(self, app_desc=None, auth=None, agave=None, content_addressed=False):
+        """
+        Creates an Agave session object, or uses ``agave`` if an
+        authenticated client is given. With ``content_addressed``, images
+        are named after their digest and reused across apps.
+        """
         from cappat.info import __wrapperver__ as wversion
 
+        self.content_addressed = content_addressed
+
         self.app_desc = app_desc
         if app_desc is not None:
             if self.app_desc['deploymentPath'].endswith('/'):
                 self.app_desc['deploymentPath'] = self.app_desc['deploymentPath'][:-1]
             self.app_desc['deploymentPath'] += '-{}'.format(wversion)
 
-        # CAPPAT works only with the crnenv loaded
-        self.app_desc['modules'] = ['load crnenv']
+            # CAPPAT works only with the crnenv loaded
+            self.app_desc['modules'] = ['load crnenv']
         client_name = '{}-{}'.format(self.AGAVE_CAPPAT_CLIENT, gethostname())
 
-        if op.isfile(self.AGAVE_SESSION_FILE):
-            with open(self.AGAVE_SESSION_FILE, 'r') as asf:
-                session_data = json.load(asf)
-
-            for key in ['access_token', 'refresh_token', 'baseurl',
-                        'apikey', 'apisecret']:
-                if not session_data.get(key):
-                    raise RuntimeError('{} required'.format())
-
-            self.agave = Agave(
-                api_server=session_data['baseurl'].decode(),
-                api_key=session_data['apikey'].decode(),
-                api_secret=session_data['apisecret'].decode(),
-                token=session_data['access_token'].decode(),
-                username=auth[0],
-                password=auth[1],
-                refresh_token=session_data['refresh_token'].decode(),
-                client_name=client_name.decode(),
-                verify=session_data.get('verify', False)
-            )
-
-            try:
-                clients = self.agave.clients.list()
-                return
-            except AttributeError:
-                logger.warn('Agave token could not be reused, trying to '
-                            'access using username and password.')
+        if agave is not None:
+            self.agave = agave
+            return
 
+        # Reuse the token of the Agave CLI, if valid
+        self.agave = AgaveSession.from_cache(self.AGAVE_SESSION_FILE)
+        if self.agave is not None:
+            return
 
+        logger.warning('Agave token could not be reused, trying to '
+                       'access using username and password.')
+        from agavepy.agave import Agave
         do_retry = False
         try:
             self.agave = Agave(
@@ -138,80 +136,96 @@ class CappatAgaveClient(object):
                 body={'clientName': client_name})
 
 
+    @property
+    def uploader(self):
+        """The transfer engine, shared by all the uploads of this session"""
+        if self._uploader is None:
+            self._uploader = Uploader(self.agave)
+        return self._uploader
+
+    @property
+    def image_store(self):
+        """The content-addressed image store"""
+        if self._image_store is None:
+            self._image_store = ImageStore(self.uploader)
+        return self._image_store
+
     def _upload_file(self, fname, remote_path, remote_fname=None,
                      system='openfmri-storage', overwrite=True):
         """Upload file to an storage system"""
-
-        if remote_fname is None:
-            remote_fname = op.basename(fname)
-
-        logger.info('Uploading "%s" to remote path "%s/%s" in %s',
-                    fname, remote_path, remote_fname, system)
-
-        head_path, tail_path = op.split(remote_path)
-        if head_path and head_path != '/':
-            while head_path.endswith('/'):
-                head_path, tail = op.split(head_path)
-                tail_path = op.join(tail, tail_path)
-
-            # Make sure the folder exists
-            self.agave.files.manage(
-                systemId=system, filePath=head_path,
-                body={'action':'mkdir', 'path': tail_path})
-            logger.info('Created/checked that "%s/" folder exists under "%s/"',
-                        tail_path, head_path)
-
-        existing_files = [f.name for f in self.agave.files.list(
-            systemId=system, filePath=remote_path)]
-        file_exists = remote_fname in existing_files
-        if not overwrite and file_exists:
-            logger.warn(
-                'Overwriting remote path "%s/%s" in "%s" is not allowed, skipping...',
-                remote_path, remote_fname, system)
-            return True
-
-        if file_exists:
-            logger.warn('Overwriting remote path "%s/%s" in "%s"',
-                        remote_path, remote_fname, system)
-
-        with open(fname, 'rb') as file_to_upload:
-            result = self.agave.files.importData(
-                systemId=system, filePath=remote_path,
-                fileName=remote_fname, fileToUpload=file_to_upload
-            )
-        return result
+        return self.uploader.upload(fname, remote_path, remote_fname=remote_fname,
+                                    system=system, overwrite=overwrite)
+
+    def _wrapper_transfer(self):
+        return {'fname': pkgrf('cappat', 'data/wrapper.sh'),
+                'remote_path': self.app_desc['deploymentPath'],
+                'remote_fname': self.app_desc['templatePath'],
+                'system': self.app_desc['deploymentSystem']}
+
+    def _image_system(self):
+        return 'images-' + self.app_desc['executionSystem'].split('-')[1]
+
+    def _image_upload(self, image_file):
+        if self.content_addressed:
+            return self.image_store.put, {'image_file': image_file,
+                                          'system': self._image_system()}
+        return self.uploader.upload, {'fname': image_file, 'remote_path': '',
+                                      'remote_fname': op.basename(image_file),
+                                      'system': self._image_system(),
+                                      'overwrite': False}
 
     def upload_wrapper(self):
         """Upload the wrapper"""
-        self._upload_file(
-            pkgrf('cappat', 'data/wrapper.sh'),
-            self.app_desc['deploymentPath'],
-            remote_fname=self.app_desc['templatePath'],
-            system=self.app_desc['deploymentSystem'])
+        return self.uploader.upload(**self._wrapper_transfer())
 
     def singularity_image(self, image_file):
         """Upload singularity image"""
-        image_storage = 'images-' + self.app_desc['executionSystem'].split('-')[1]
+        func, kwargs = self._image_upload(image_file)
+        self._set_image_cmd(func(**kwargs))
 
-        self._upload_file(image_file, '',
-                          remote_fname=op.basename(image_file),
-                          system=image_storage,
-                          overwrite=False)
+    def _root_dir(self, system):
+        if self._root_dirs is None:
+            self._root_dirs = {}
+        if system not in self._root_dirs:
+            self._root_dirs[system] = self.agave.systems.get(
+                systemId=system)['storage']['rootDir']
+        return self._root_dirs[system]
 
-        root_dir = self.agave.systems.get(
-            systemId=image_storage)['storage']['rootDir']
+    def _set_image_cmd(self, image_upload):
+        root_dir = self._root_dir(image_upload['system'])
 
         for i, param in enumerate(self.app_desc['parameters']):
             if param['id'] == 'execPath':
                 exec_cmd = ' '.join(
-                    ['singularity', 'run', op.join(root_dir, op.basename(image_file))])
+                    ['singularity', 'run', op.join(root_dir, image_upload['remote'])])
                 logger.info('Registering a singularity-image-based app, command line is "%s"',
                             exec_cmd)
                 self.app_desc['parameters'][i]['value']['default'] = exec_cmd
 
+    def upload_artifacts(self, image_file=None):
+        """Uploads the wrapper and the singularity image (if any) at once"""
+        calls = [(self.uploader.upload, self._wrapper_transfer())]
+        if image_file is not None:
+            calls.append(self._image_upload(image_file))
+        results = run_concurrently(calls, self.uploader.concurrency)
+        if image_file is not None:
+            self._set_image_cmd(results[1])
+        return results
+
+    @property
+    def app_ids(self):
+        """The ids of the apps registered in Agave"""
+        if self._app_ids is None:
+            self._app_ids = set(app['id'] for app in self.agave.apps.list())
+        return self._app_ids
+
+    @property
+    def app_id(self):
+        return '{name}-{version}'.format(**self.app_desc)
+
     def add_app(self):
-        apps = [app['id'] for app in self.agave.apps.list()]
-        app_id = '{name}-{version}'.format(**self.app_desc)
+        apps = self.app_ids
+        app_id = self.app_id
 
         logger.info('Registering app "%s" with spec:\n--\n%s\n--',
                     app_id, json.dumps(self.app_desc, indent=4))
@@ -219,12 +233,68 @@ class CappatAgaveClient(object):
         if app_id in apps:
             raise RuntimeError('Trying to overwrite an existing '
                                'version of the app ({})'.format(app_id))
-        return self.agave.apps.add(body=self.app_desc)
+        result = self.agave.apps.add(body=self.app_desc)
+        apps.add(app_id)
+        return result
 
-    def install(self):
+    def install(self, image_file=None):
         """Performs the prescribed actions in order"""
-        self.upload_wrapper()
-        self.add_app()
+        self.upload_artifacts(image_file)
+        return self.add_app()
+
+
+def app_description(app_name, app_version, execution_system, entry_point, fields=None,
+                    participant_args=None, group_args=None):
+    """
+    Builds the Agave description of an app. ``fields`` sets the optional
+    fields (see ``AGAVE_APP_OPTIONAL``), the rest take their default value.
+    """
+    settings = {
+        'label': '{} (cappat @ {})'.format(
+            app_name.upper(), execution_system),
+        'shortDescription': '{}-{} app automatically registered with cappat'.format(
+            app_name, app_version),
+        'longDescription': json.dumps({
+            'support': 'Please add a link for support',
+            'description': 'Please add a description',
+            'acknowledgments': 'Please cite <citation-here>'
+        })
+    }
+
+    fields = fields or {}
+    for field, default_value in AGAVE_APP_OPTIONAL:
+        val = fields.get(field, default_value)
+        if val is not None:
+            settings[field] = val
+
+    settings.update({
+        'name': app_name,
+        'version': app_version,
+        'executionSystem': execution_system
+    })
+
+    # Set default parameters
+    with open(pkgrf('cappat', 'data/default_app_params.json')) as defp:
+        settings['parameters'] = json.load(defp)
+
+    arg_ids = [item['id'] for item in settings['parameters']]
+
+    settings['parameters'][arg_ids.index('loadModules')]['value']['default'] = \
+        settings['modules'] if settings.get('modules') else ''
+    settings['parameters'][arg_ids.index('execPath')]['value']['default'] = entry_point
+    settings.pop('modules', None)
+
+    if participant_args:
+        settings['parameters'][arg_ids.index('participantArgs')]['value']['default'] = \
+            participant_args
+
+    if group_args:
+        settings['parameters'][arg_ids.index('groupArgs')]['value']['default'] = \
+            group_args
+
+    with open(pkgrf('cappat', 'data/default_app_inputs.json')) as defp:
+        settings['inputs'] = json.load(defp)
+    return settings
 
 
 def main():
@@ -267,61 +337,25 @@ CRN-platform""", formatter_class=RawTextHelpFormatter)
     g_optional = parser.add_argument('--participant-args', nargs='*')
     g_optional = parser.add_argument('--group-args', nargs='*')
 
+    g_images = parser.add_argument_group('Images')
+    g_images.add_argument(
+        '--content-addressed', action='store_true', default=False,
+        help='name images after their digest and reuse those already uploaded')
+
     g_outputs = parser.add_argument_group('Outputs')
     g_outputs.add_argument('-o', '--output', action='store')
 
     opts = parser.parse_args()
-
-    settings = {
-        'label': '{} (cappat @ {})'.format(
-            opts.app_name.upper(), opts.execution_system),
-        'shortDescription': '{}-{} app automatically registered with cappat'.format(
-            opts.app_name, opts.app_version),
-        'longDescription': json.dumps({
-            'support': 'Please add a link for support',
-            'description': 'Please add a description',
-            'acknowledgments': 'Please cite <citation-here>'
-        })
-    }
-
-    for field, _ in AGAVE_APP_OPTIONAL:
-        val = getattr(opts, field, None)
-        if val is not None:
-            settings[field] = val
-
-    settings.update({
-        'name': opts.app_name,
-        'version': opts.app_version,
-        'executionSystem': opts.execution_system
-    })
-
-    # Set default parameters
-    with open(pkgrf('cappat', 'data/default_app_params.json')) as defp:
-        settings['parameters'] = json.load(defp)
-
-    arg_ids = [item['id'] for item in settings['parameters']]
-
-    settings['parameters'][arg_ids.index('loadModules')]['value']['default'] = \
-        opts.modules if opts.modules else ''
-    settings['parameters'][arg_ids.index('execPath')]['value']['default'] = opts.entry_point
-    settings.pop('modules', None)
-
-    if opts.participant_args:
-        settings['parameters'][arg_ids.index('participantArgs')]['value']['default'] = \
-            opts.participant_args
-
-    if opts.group_args:
-        settings['parameters'][arg_ids.index('groupArgs')]['value']['default'] = \
-            opts.group_args
-
-    with open(pkgrf('cappat', 'data/default_app_inputs.json')) as defp:
-        settings['inputs'] = json.load(defp)
+    settings = app_description(
+        opts.app_name, opts.app_version, opts.execution_system, opts.entry_point,
+        fields=dict((field, getattr(opts, field, None)) for field, _ in AGAVE_APP_OPTIONAL),
+        participant_args=opts.participant_args, group_args=opts.group_args)
 
     # 2. Connect agave and register app
-    a_ses = CappatAgaveClient(settings, (opts.username, opts.password))
-    if op.isfile(opts.entry_point):
-        a_ses.singularity_image(opts.entry_point)
-    a_ses.install()
+    a_ses = CappatAgaveClient(settings, (opts.username, opts.password),
+                              content_addressed=opts.content_addressed)
+    a_ses.install(opts.entry_point if op.isfile(opts.entry_point) else None)
+    logger.info('Timing of the Agave API calls:\n%s', METRICS.summary())
 
 
 
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+A local fake of the Agave API used by cappat (files, systems, apps and
+clients), keeping everything in memory. Use it in place of an
+authenticated client::
+
+    fake = FakeAgave(latency=0.05)
+    uploader = Uploader(fake)
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os.path as op
+from threading import Lock
+from time import sleep
+from builtins import object
+
+from cappat.session import AttrDict
+
+
+class FakeFiles(object):
+    """The files service: one dictionary of paths per system"""
+
+    def __init__(self, agave):
+        self._agave = agave
+        self.storage = {}
+        # Number of next uploads that will be interrupted half way
+        self.fail_uploads = 0
+
+    def manage(self, systemId, filePath, body):
+        self._agave._call('files.manage')
+        return AttrDict(path=op.join(filePath, body.get('path', '')))
+
+    def list(self, systemId, filePath):
+        self._agave._call('files.list')
+        folder = filePath.strip('/')
+        return [AttrDict(name=op.basename(path), length=len(content), type='file')
+                for (system, path), content in list(self.storage.items())
+                if system == systemId and op.dirname(path) == folder]
+
+    def download(self, systemId, filePath):
+        self._agave._call('files.download')
+        key = (systemId, filePath.strip('/'))
+        if key not in self.storage:
+            raise IOError('File/folder does not exist')
+        return self.storage[key]
+
+    def importData(self, systemId, filePath, fileName, fileToUpload):
+        self._agave._call('files.importData')
+        key = (systemId, op.join(filePath, fileName).strip('/'))
+        content = fileToUpload.read()
+        with self._agave._lock:
+            failed = self.fail_uploads > 0
+            if failed:
+                self.fail_uploads -= 1
+        if failed:
+            self.storage[key] = content[:len(content) // 2]
+            raise IOError('Connection reset by peer')
+        self.storage[key] = content
+        return AttrDict(name=fileName, path=key[1], length=len(content))
+
+
+class FakeSystems(object):
+    """The systems service"""
+
+    def __init__(self, agave):
+        self._agave = agave
+
+    def get(self, systemId):
+        self._agave._call('systems.get')
+        return AttrDict(id=systemId, storage=AttrDict(rootDir='/%s' % systemId))
+
+
+class FakeApps(object):
+    """The apps service"""
+
+    def __init__(self, agave):
+        self._agave = agave
+        self.registered = {}
+
+    def list(self):
+        self._agave._call('apps.list')
+        return [AttrDict(id=app_id) for app_id in sorted(self.registered)]
+
+    def add(self, body):
+        self._agave._call('apps.add')
+        app_id = '{name}-{version}'.format(**body)
+        with self._agave._lock:
+            self.registered[app_id] = body
+        return AttrDict(id=app_id)
+
+
+class FakeClients(object):
+    """The clients service"""
+
+    def __init__(self, agave):
+        self._agave = agave
+        self.names = []
+
+    def list(self):
+        self._agave._call('clients.list')
+        return [AttrDict(name=name) for name in self.names]
+
+    def create(self, body):
+        self._agave._call('clients.create')
+        self.names.append(body['clientName'])
+        return AttrDict(name=body['clientName'])
+
+
+class FakeAgave(object):
+    """
+    Simulates the Agave services used by cappat. ``latency`` is the
+    response time of each call, in seconds. The number of calls to each
+    method is kept in ``calls``.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = {}
+        self._lock = Lock()
+        self.files = FakeFiles(self)
+        self.systems = FakeSystems(self)
+        self.apps = FakeApps(self)
+        self.clients = FakeClients(self)
+
+    def _call(self, name):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+        if self.latency:
+            sleep(self.latency)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+A local fake Slurm: answers ``sbatch``, ``squeue``, ``sacct`` and
+``scancel`` in-process, simulating the latency of the controller, the
+queue wait and runtime of the jobs, and failures. Plug it into a task
+manager replacing its scheduler runner::
+
+    fake = FakeSlurm(latency=0.05, queue_wait=2, runtime=10)
+    manager._run_scheduler = fake.run
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import re
+import subprocess as sp
+from collections import OrderedDict
+from random import Random
+from threading import Lock
+from time import sleep
+from timeit import default_timer as timer
+from io import open
+from builtins import object
+
+from cappat.manager.tools import _secs2time
+from cappat.manager.parsers import expand_array_range
+
+ARRAY_RE = re.compile(r'^#SBATCH --array=(?P<ids>[\d,%-]+)', re.MULTILINE)
+TRANSIENT_ERROR = ('sbatch: error: Batch job submission failed: '
+                   'Socket timed out on send/recv operation')
+
+
+class FakeSlurm(object):
+    """
+    Simulates a Slurm controller. Times are in seconds: ``latency`` is the
+    mean response time of each command, ``queue_wait`` the mean time a job
+    spends pending (exponentially distributed) and ``runtime`` the mean
+    time it runs. Jobs fail with probability ``failure_rate`` and sbatch
+    returns a transient error with probability ``submit_error_rate``.
+    ``backlog`` jobs of other users stay pending in the partition.
+    """
+
+    def __init__(self, latency=0.0, queue_wait=0.0, runtime=0.0, failure_rate=0.0,
+                 submit_error_rate=0.0, first_jobid=1000, seed=None, backlog=0):
+        self.latency = latency
+        self.backlog = backlog
+        self.queue_wait = queue_wait
+        self.runtime = runtime
+        self.failure_rate = failure_rate
+        self.submit_error_rate = submit_error_rate
+        self._next_jobid = first_jobid
+        self._rng = Random(seed)
+        self._lock = Lock()
+        # jobid -> [start, end, final state, exit code]
+        self._jobs = OrderedDict()
+        # parent jobid -> ids of the array elements
+        self._arrays = {}
+        self.calls = {}
+        self.call_seconds = {}
+
+    @property
+    def njobs(self):
+        return len(self._jobs)
+
+    def run(self, cmd):
+        """Runs a scheduler command, returning its output like ``run_cmd``"""
+        start = timer()
+        if self.latency:
+            sleep(self.latency * self._rng.uniform(0.5, 1.5))
+        try:
+            with self._lock:
+                output = getattr(self, '_' + cmd[0])(cmd[1:])
+        finally:
+            with self._lock:
+                self.calls[cmd[0]] = self.calls.get(cmd[0], 0) + 1
+                self.call_seconds[cmd[0]] = (
+                    self.call_seconds.get(cmd[0], 0.0) + timer() - start)
+        return output or None
+
+    __call__ = run
+
+    def _new_job(self, jobid, now):
+        wait = self._rng.expovariate(1.0 / self.queue_wait) if self.queue_wait else 0.0
+        runtime = self.runtime * self._rng.uniform(0.8, 1.2)
+        failed = self._rng.random() < self.failure_rate
+        self._jobs[jobid] = [now + wait, now + wait + runtime,
+                             'FAILED' if failed else 'COMPLETED', 1 if failed else 0]
+
+    def _expand(self, ids):
+        jobids = []
+        for jobid in ids.split(','):
+            jobids += self._arrays.get(jobid, [jobid])
+        return [jobid for jobid in jobids if jobid in self._jobs]
+
+    def _state(self, jobid, now):
+        start, end, state, exit_code = self._jobs[jobid]
+        if now < start:
+            return 'PENDING', 'PD', 0, 0
+        if now < end:
+            return 'RUNNING', 'R', now - start, 0
+        return state, None, end - start, exit_code
+
+    @staticmethod
+    def _option(args, flag):
+        return args[args.index(flag) + 1] if flag in args else None
+
+    def _sbatch(self, args):
+        if self._rng.random() < self.submit_error_rate:
+            raise sp.CalledProcessError(1, ['sbatch'] + args, output=TRANSIENT_ERROR)
+
+        with open(args[-1]) as sfh:
+            match = ARRAY_RE.search(sfh.read())
+
+        jobid = '%d' % self._next_jobid
+        self._next_jobid += 1
+        now = timer()
+        if match is None:
+            self._new_job(jobid, now)
+        else:
+            self._arrays[jobid] = expand_array_range(jobid, match.group('ids'))
+            for element in self._arrays[jobid]:
+                self._new_job(element, now)
+        return 'Submitted batch job %s' % jobid
+
+    def _squeue(self, args):
+        fmt = self._option(args, '-o') or '%i,%t'
+        now = timer()
+        lines = []
+        states = self._option(args, '-t')
+        if '-u' in args or '-p' in args:
+            jobids = list(self._jobs.keys())
+        else:
+            jobids = self._expand(self._option(args, '-j') or '')
+        if '-p' in args:
+            # The jobs of other users in the partition
+            lines += [fmt.replace('%i', 'other-%d' % i).replace('%t', 'PD')
+                      for i in range(self.backlog) if states in (None, 'PD')]
+        for jobid in jobids:
+            code = self._state(jobid, now)[1]
+            if code is not None and states in (None, code):
+                lines.append(fmt.replace('%i', jobid).replace('%t', code))
+        return '\n'.join(lines)
+
+    def _sacct(self, args):
+        now = timer()
+        lines = []
+        fields = (self._option(args, '-o') or 'JobID,State,ExitCode').split(',')
+        for jobid in self._expand(self._option(args, '-j') or ''):
+            state, _, elapsed, exit_code = self._state(jobid, now)
+            if '-P' not in args:
+                lines.append('%s  %s  %d:0' % (jobid, state, exit_code))
+                continue
+
+            values = {
+                'JobID': jobid, 'State': state, 'Elapsed': _secs2time(elapsed),
+                'ExitCode': '%d:0' % exit_code, 'AllocCPUS': '1', 'NNodes': '1',
+                'ReqMem': '4000Mc',
+                'TotalCPU': _secs2time(elapsed * self._rng.uniform(0.3, 0.9))}
+            lines.append('|'.join(values.get(field, '') for field in fields))
+            values.update({
+                'JobID': jobid + '.batch', 'AllocCPUS': '', 'NNodes': '', 'ReqMem': '',
+                'MaxRSS': '%dK' % self._rng.randint(10000, 100000),
+                'MaxDiskRead': '%dM' % self._rng.randint(1, 100),
+                'MaxDiskWrite': '%dM' % self._rng.randint(1, 100)})
+            lines.append('|'.join(values.get(field, '') for field in fields))
+        return '\n'.join(lines)
+
+    def _scancel(self, args):
+        now = timer()
+        for jobid in self._expand(','.join(arg for arg in args if not arg.startswith('-'))):
+            job = self._jobs[jobid]
+            if now < job[1]:
+                self._jobs[jobid] = [min(job[0], now), now, 'CANCELLED', 0]
+        return ''
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Benchmark: parsing squeue and sacct outputs with the precompiled parsers
+vs. the former line by line parsing
+
+    python -m cappat.benchmarks.parsers -n 50000
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import re
+from argparse import ArgumentParser
+from random import Random
+from timeit import default_timer as timer
+import json
+
+from cappat.manager.parsers import StateTable, parse_squeue, parse_sacct
+
+SQUEUE_CODES = ['PD', 'R', 'CG', 'CD', 'F']
+SACCT_STATES = ['COMPLETED', 'FAILED', 'TIMEOUT', 'CANCELLED by 1234', 'OUT_OF_MEMORY']
+
+
+def _outputs(nlines, seed=0):
+    rng = Random(seed)
+    jobids = ['%d_%d' % (1000 + i // 1000, i % 1000) for i in range(nlines)]
+    squeue = '\n'.join('%s|%s' % (jobid, rng.choice(SQUEUE_CODES)) for jobid in jobids)
+    sacct = '\n'.join('%s|%s|%d:0' % (jobid, rng.choice(SACCT_STATES), rng.randint(0, 2))
+                      for jobid in jobids)
+    return jobids, squeue, sacct
+
+
+def _legacy_squeue(output, jobs):
+    sqexp = re.compile('(?P<jobid>\\d+(?:_\\d+)?)\\|(?P<jobstatus>[' +
+                       '|'.join(['R', 'PD', 'CF', 'CG', 'CA', 'F', 'TO', 'NF', 'SE']) +
+                       ']*)')
+    pending = []
+    for line in output.split('\n'):
+        m = sqexp.search(line)
+        if m is not None and all(m.groups()) and m.group('jobid') in jobs:
+            jobs[m.group('jobid')] = m.group('jobstatus')
+            if m.group('jobstatus') not in ['CA', 'F', 'TO', 'NF', 'SE']:
+                pending.append(m.group('jobid'))
+    return pending
+
+
+def _legacy_sacct(output, jobs):
+    regexp = re.compile('(?P<jobid>\\d+(?:_\\d+)?)\\|(?P<status>\\w*)[^|]*\\|'
+                        '(?P<exit_code>\\d+):\\d+')
+    exit_codes = []
+    for line in output.split('\n'):
+        m = regexp.search(line)
+        if m is not None and all(m.groups()) and m.group('jobid') in jobs:
+            jobs[m.group('jobid')] = m.group('status')
+            exit_codes.append(int(m.group('exit_code')))
+    return exit_codes
+
+
+def _time(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = timer()
+        func()
+        elapsed = timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def benchmark(nlines=50000, repeat=5):
+    """Times parsing ``nlines`` lines of squeue and sacct output"""
+    jobids, squeue, sacct = _outputs(nlines)
+    legacy_jobs = dict((jobid, 'SUBMITTED') for jobid in jobids)
+    table = StateTable()
+    for jobid in jobids:
+        table[jobid] = 'SUBMITTED'
+
+    def _squeue():
+        for jobid, code in parse_squeue(squeue):
+            if jobid in table:
+                table.set_code(jobid, code)
+
+    def _sacct():
+        for jobid, code, _ in parse_sacct(sacct):
+            if jobid in table:
+                table.set_code(jobid, code)
+
+    results = {
+        'lines': nlines,
+        'squeue_legacy': _time(lambda: _legacy_squeue(squeue, legacy_jobs), repeat),
+        'squeue': _time(_squeue, repeat),
+        'sacct_legacy': _time(lambda: _legacy_sacct(sacct, legacy_jobs), repeat),
+        'sacct': _time(_sacct, repeat),
+    }
+    results['squeue_speedup'] = results['squeue_legacy'] / results['squeue']
+    results['sacct_speedup'] = results['sacct_legacy'] / results['sacct']
+    return results
+
+
+def main():
+    """Entry point"""
+    parser = ArgumentParser(description='Benchmark scheduler output parsing')
+    parser.add_argument('-n', '--nlines', type=int, default=50000)
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    opts = parser.parse_args()
+    print(json.dumps(benchmark(opts.nlines, opts.repeat), indent=2))
+
+
+if __name__ == '__main__':
+    main()
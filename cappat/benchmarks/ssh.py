@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Benchmark: one ssh connection per command vs. a multiplexed connection
+
+    python -m cappat.benchmarks.ssh -n 20 ssh -oStrictHostKeyChecking=no login2
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from argparse import ArgumentParser, REMAINDER
+from timeit import default_timer as timer
+import json
+
+from cappat.manager.tools import run_cmd, SSHTransport
+
+
+def _time_calls(run, ncalls, cmd):
+    times = []
+    for _ in range(ncalls):
+        start = timer()
+        run(cmd)
+        times.append(timer() - start)
+    return {
+        'calls': ncalls,
+        'total': sum(times),
+        'mean': sum(times) / ncalls,
+        'first': times[0],
+        'max': max(times),
+    }
+
+
+def benchmark(cmd_prefix, ncalls=20, cmd=None):
+    """Times ``ncalls`` remote commands with and without multiplexing"""
+    if cmd is None:
+        cmd = ['squeue', '--version']
+
+    results = {'prefix': ' '.join(cmd_prefix), 'command': ' '.join(cmd)}
+    results['per_call'] = _time_calls(
+        lambda c: run_cmd(cmd_prefix + c), ncalls, cmd)
+
+    transport = SSHTransport(cmd_prefix)
+    try:
+        results['multiplexed'] = _time_calls(transport.run, ncalls, cmd)
+    finally:
+        transport.close()
+
+    results['speedup'] = results['per_call']['total'] / results['multiplexed']['total']
+    return results
+
+
+def main():
+    """Entry point"""
+    parser = ArgumentParser(description='Benchmark ssh multiplexing')
+    parser.add_argument('-n', '--ncalls', type=int, default=20)
+    parser.add_argument('-c', '--command', default='squeue --version',
+                        help='remote command to run')
+    parser.add_argument('cmd_prefix', nargs=REMAINDER,
+                        help='ssh command prefix, e.g. "ssh login2"')
+    opts = parser.parse_args()
+    print(json.dumps(benchmark(opts.cmd_prefix, opts.ncalls, opts.command.split()),
+                     indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Benchmark: the full TaskManager workflow (build, map, wait, group) against
+a fake Slurm, for growing numbers of tasks
+
+    python -m cappat.benchmarks.taskmanager --sizes 10 100 1000 10000 \\
+        --latency 0.01 --queue-wait 1 --runtime 2 -o results.json
+
+Compare with a previous run using ``--baseline previous.json``.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+from argparse import ArgumentParser
+from tempfile import mkdtemp
+from timeit import default_timer as timer
+from io import open
+import shutil
+import json
+import logging
+
+import yaml
+
+from cappat.manager.factory import TaskManager
+from cappat.benchmarks.fakeslurm import FakeSlurm
+
+BENCH_SIZES = [10, 100, 1000, 10000]
+BENCH_SETTINGS = {
+    'execution_system': 'sherlock.stanford.edu',
+    'executable': 'true',
+    'bids_dir': '/data',
+    'nodes': 1,
+    'max_runtime': '01:00:00',
+    'partition': 'normal',
+    'job_name': 'benchmark',
+    'mincpus': 1,
+    'mem_per_cpu': 4000,
+    'modules': [],
+    'poll_min_seconds': 0.05,
+    'poll_max_seconds': 1.0,
+}
+
+
+def _timed(func, counter):
+    def _wrapper(*args, **kwargs):
+        start = timer()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            counter.append(timer() - start)
+    return _wrapper
+
+
+def run_benchmark(ntasks, settings=None, work_dir=None, **fake_args):
+    """
+    Runs the workflow for ``ntasks`` tasks, with the given manager settings
+    and FakeSlurm arguments, and returns the measurements
+    """
+    bench_settings = BENCH_SETTINGS.copy()
+    bench_settings.update(settings or {})
+    tasks = ['true --participant_label %06d' % i for i in range(ntasks)]
+
+    tmp_dir = work_dir is None
+    if tmp_dir:
+        work_dir = mkdtemp(prefix='cappat-bench-')
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+
+    fake = FakeSlurm(**fake_args)
+    polls = []
+    results = {'tasks': ntasks, 'settings': settings or {}, 'fakeslurm': fake_args}
+    try:
+        start = timer()
+        stm = TaskManager.build(tasks, bench_settings, work_dir=work_dir)
+        stm._run_scheduler = fake.run
+        stm._get_jobs_status = _timed(stm._get_jobs_status, polls)
+
+        stm.map_participant()
+        submitted = timer()
+        results['failed'] = False
+        try:
+            stm.wait_participant()
+        except RuntimeError:
+            results['failed'] = True
+        waited = timer()
+        stm.run_grouplevel()
+        stm.close()
+        end = timer()
+    finally:
+        os.chdir(cwd)
+        if tmp_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    squeue_seconds = fake.call_seconds.get('squeue', 0.0)
+    results.update({
+        'jobs': fake.njobs,
+        'submit_seconds': submitted - start,
+        'submit_throughput': ntasks / (submitted - start),
+        'wait_seconds': waited - submitted,
+        'group_seconds': end - waited,
+        'wall_seconds': end - start,
+        'calls': fake.calls,
+        'scheduler_seconds': fake.call_seconds,
+        'polls': len(polls),
+        # Time spent by cappat itself parsing the queue status
+        'poll_overhead_seconds': max(0.0, sum(polls) - squeue_seconds),
+    })
+    return results
+
+
+def sweep(sizes=None, settings=None, **fake_args):
+    """Runs the benchmark for each number of tasks in ``sizes``"""
+    if sizes is None:
+        sizes = BENCH_SIZES
+    return [run_benchmark(ntasks, settings=settings, **fake_args) for ntasks in sizes]
+
+
+def compare(results, baseline):
+    """Ratios of the wall and submission times with respect to a baseline"""
+    previous = dict((run['tasks'], run) for run in baseline)
+    ratios = []
+    for run in results:
+        if run['tasks'] in previous:
+            ratios.append({
+                'tasks': run['tasks'],
+                'wall': run['wall_seconds'] / previous[run['tasks']]['wall_seconds'],
+                'submit': run['submit_seconds'] / previous[run['tasks']]['submit_seconds'],
+            })
+    return ratios
+
+
+def main():
+    """Entry point"""
+    parser = ArgumentParser(description='Benchmark the task manager with a fake Slurm')
+    parser.add_argument('--sizes', type=int, nargs='+', default=BENCH_SIZES)
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='mean response time of scheduler commands (s)')
+    parser.add_argument('--queue-wait', type=float, default=0.5,
+                        help='mean queue wait of jobs (s)')
+    parser.add_argument('--runtime', type=float, default=1.0,
+                        help='mean runtime of jobs (s)')
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--submit-error-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-s', '--setting', action='append', default=[],
+                        metavar='KEY=VALUE', help='task manager setting (yaml value)')
+    parser.add_argument('-o', '--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON results of a previous run to compare')
+    opts = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    settings = {}
+    for setting in opts.setting:
+        key, value = setting.split('=', 1)
+        settings[key] = yaml.safe_load(value)
+
+    results = sweep(opts.sizes, settings=settings, latency=opts.latency,
+                    queue_wait=opts.queue_wait, runtime=opts.runtime,
+                    failure_rate=opts.failure_rate,
+                    submit_error_rate=opts.submit_error_rate, seed=opts.seed)
+    output = {'results': results}
+    if opts.baseline:
+        with open(opts.baseline) as bfh:
+            output['compare'] = compare(results, json.load(bfh)['results'])
+
+    if opts.output:
+        with open(opts.output, 'w') as ofh:
+            ofh.write('%s' % json.dumps(output, indent=2))
+
+    for run in results:
+        print('%6d tasks: submit %8.2fs (%7.1f tasks/s), wait %8.2fs, group %6.2fs, '
+              'wall %8.2fs, %d polls, calls %s' % (
+                  run['tasks'], run['submit_seconds'], run['submit_throughput'],
+                  run['wait_seconds'], run['group_seconds'], run['wall_seconds'],
+                  run['polls'], json.dumps(run['calls'], sort_keys=True)))
+    for ratio in output.get('compare', []):
+        print('%6d tasks: wall x%.2f, submit x%.2f vs. baseline' % (
+            ratio['tasks'], ratio['wall'], ratio['submit']))
+
+
+if __name__ == '__main__':
+    main()
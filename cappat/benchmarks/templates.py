@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Benchmark: rendering sbatch files with a new jinja environment per file
+vs. the shared compiled-template cache
+
+    python -m cappat.benchmarks.templates -n 10000
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from os import path as op
+from argparse import ArgumentParser
+from tempfile import mkdtemp
+from timeit import default_timer as timer
+from io import open
+import shutil
+import json
+
+import jinja2
+from pkg_resources import resource_filename as pkgrf
+
+from cappat.tpl import Template
+from cappat.tpl.config import clear_cache
+
+SBATCH_TEMPLATE = op.abspath(pkgrf('cappat', 'tpl/sherlock-sbatch.jnj2'))
+SETTINGS = {
+    'nodes': 1,
+    'child_runtime': '01:00:00',
+    'partition': 'normal',
+    'qos': 'normal',
+    'work_dir': '/scratch/users/someone/job',
+    'jobname': 'benchmark',
+    'mincpus': 4,
+    'mem_per_cpu': 4000,
+    'modules': ['module load singularity'],
+}
+
+
+def _task_settings(ntasks):
+    for i in range(ntasks):
+        settings = SETTINGS.copy()
+        settings['commandline'] = (
+            'singularity run app.img /data out/ participant '
+            '--participant_label %06d' % i)
+        settings['task_index'] = i
+        yield settings
+
+
+def _render_uncached(settings_iter, paths):
+    """The former behaviour: one environment (and one parse) per file"""
+    for configs, path in zip(settings_iter, paths):
+        env = jinja2.Environment(loader=jinja2.FileSystemLoader(searchpath='/'),
+                                 trim_blocks=True, lstrip_blocks=True)
+        with open(path, 'w+') as output_file:
+            output_file.write(env.get_template(SBATCH_TEMPLATE).render(configs))
+
+
+def benchmark(ntasks=10000, out_dir=None):
+    """Times the generation of ``ntasks`` sbatch files"""
+    tmp_dir = out_dir is None
+    if tmp_dir:
+        out_dir = mkdtemp(prefix='cappat-tpl-')
+
+    paths = [op.join(out_dir, 'slurm-%06d.sbatch' % i) for i in range(ntasks)]
+    results = {'tasks': ntasks}
+    try:
+        start = timer()
+        _render_uncached(_task_settings(ntasks), paths)
+        results['uncached'] = timer() - start
+
+        clear_cache()
+        start = timer()
+        Template(SBATCH_TEMPLATE).render_many(_task_settings(ntasks), paths)
+        results['render_many'] = timer() - start
+    finally:
+        if tmp_dir:
+            shutil.rmtree(out_dir, ignore_errors=True)
+
+    results['per_file_ms'] = 1000 * results['render_many'] / max(ntasks, 1)
+    results['speedup'] = results['uncached'] / results['render_many']
+    return results
+
+
+def main():
+    """Entry point"""
+    parser = ArgumentParser(description='Benchmark sbatch rendering')
+    parser.add_argument('-n', '--ntasks', type=int, default=10000)
+    parser.add_argument('-o', '--out-dir', help='write the files here instead of '
+                        'a temporary directory')
+    opts = parser.parse_args()
+    print(json.dumps(benchmark(opts.ntasks, opts.out_dir), indent=2))
+
+
+if __name__ == '__main__':
+    main()
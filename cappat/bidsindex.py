@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+BIDS index: a cached summary of the subjects of a BIDS dataset
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+from os import path as op
+import json
+import hashlib
+import logging
+from io import open
+from multiprocessing.pool import ThreadPool
+from builtins import object, zip
+
+try:
+    from os import scandir
+except ImportError:  # python 2
+    from scandir import scandir
+
+from cappat.utils import atomic_write, check_folder
+
+INDEX_VERSION = 1
+INDEX_NTHREADS = 8
+INDEX_CACHE_DIR = op.join('~', '.cappat', 'bidsindex')
+
+wlogger = logging.getLogger('wrapper')
+
+
+def scan_subject(subject_dir):
+    """
+    Walks the folder of one subject and returns its sessions, number of
+    files, total size in bytes, newest modification time and the
+    modification time of every directory (used to invalidate the index)
+    """
+    record = {'sessions': [], 'nfiles': 0, 'bytes': 0, 'mtime': 0.0, 'dirs': {}}
+    folders = [subject_dir]
+    while folders:
+        folder = folders.pop()
+        record['dirs'][op.relpath(folder, subject_dir)] = os.stat(folder).st_mtime
+        for entry in scandir(folder):
+            if entry.is_dir(follow_symlinks=False):
+                folders.append(entry.path)
+                if folder == subject_dir and entry.name.startswith('ses-'):
+                    record['sessions'].append(entry.name[4:])
+                continue
+
+            record['nfiles'] += 1
+            try:
+                stat = entry.stat()
+            except OSError:
+                # Broken symlinks (e.g. annexed files not retrieved)
+                continue
+            record['bytes'] += stat.st_size
+            record['mtime'] = max(record['mtime'], stat.st_mtime)
+
+    record['sessions'].sort()
+    return record
+
+
+class BIDSIndex(object):
+    """
+    Indexes the subjects of a BIDS dataset with a parallel walk of their
+    folders. The index is cached on disk, and only the subjects with a
+    directory that was modified since the last build are walked again.
+    The cache is ``cache_file`` or, by default, a file named after the
+    dataset in ``cache_dir``.
+    """
+
+    def __init__(self, bids_dir, cache_file=None, cache_dir=None, nthreads=INDEX_NTHREADS):
+        self.bids_dir = op.abspath(op.expanduser(bids_dir))
+        if cache_file is None:
+            cache_file = op.join(
+                op.expanduser(cache_dir or INDEX_CACHE_DIR), '%s.json' % hashlib.sha1(
+                    self.bids_dir.encode('utf-8')).hexdigest()[:16])
+        self.cache_file = cache_file
+        self.nthreads = max(1, int(nthreads))
+        self.subjects = {}
+        self.rescanned = []
+
+    def _load_cache(self):
+        if not op.isfile(self.cache_file):
+            return {}
+        try:
+            with open(self.cache_file, 'r') as cfh:
+                data = json.load(cfh)
+        except (IOError, OSError, ValueError) as exc:
+            wlogger.warning('Could not read BIDS index cache %s: %s', self.cache_file, exc)
+            return {}
+
+        if data.get('version') != INDEX_VERSION or data.get('bids_dir') != self.bids_dir:
+            return {}
+        return data.get('subjects', {})
+
+    def _save_cache(self):
+        try:
+            check_folder(op.dirname(op.abspath(self.cache_file)))
+            atomic_write(self.cache_file, json.dumps({
+                'version': INDEX_VERSION,
+                'bids_dir': self.bids_dir,
+                'subjects': self.subjects,
+            }))
+        except (IOError, OSError) as exc:
+            wlogger.warning('Could not write BIDS index cache %s: %s', self.cache_file, exc)
+
+    def _is_current(self, label, record):
+        subject_dir = op.join(self.bids_dir, 'sub-' + label)
+        try:
+            return all(os.stat(op.join(subject_dir, relpath)).st_mtime == mtime
+                       for relpath, mtime in list(record['dirs'].items()))
+        except OSError:
+            return False
+
+    def build(self):
+        """Builds (or refreshes) the index"""
+        cached = self._load_cache()
+        labels = sorted(entry.name[4:] for entry in scandir(self.bids_dir)
+                        if entry.name.startswith('sub-') and entry.is_dir())
+
+        pool = ThreadPool(self.nthreads)
+        try:
+            current = pool.map(
+                lambda label: label in cached and self._is_current(label, cached[label]),
+                labels)
+            stale = [label for label, valid in zip(labels, current) if not valid]
+            records = pool.map(
+                lambda label: scan_subject(op.join(self.bids_dir, 'sub-' + label)),
+                stale)
+        finally:
+            pool.close()
+            pool.join()
+
+        self.subjects = dict((label, cached[label])
+                             for label, valid in zip(labels, current) if valid)
+        self.subjects.update(zip(stale, records))
+        self.rescanned = stale
+        if stale or set(cached.keys()) != set(labels):
+            self._save_cache()
+
+        wlogger.info('Indexed %d subjects in %s (%d walked, %d from cache)',
+                     len(labels), self.bids_dir, len(stale), len(labels) - len(stale))
+        return self
+
+    def sizes(self, subject_list=None):
+        """The total size in bytes of the input data of each subject"""
+        if subject_list is None:
+            subject_list = sorted(self.subjects)
+        return dict((subject, self.subjects[subject]['bytes'])
+                    for subject in subject_list if subject in self.subjects)
+
+    def sessions(self, subject):
+        """The sessions of a subject (empty for datasets without sessions)"""
+        return self.subjects[subject]['sessions']
+
+    def empty(self, subject_list=None):
+        """Returns the subjects without any input file"""
+        if subject_list is None:
+            subject_list = sorted(self.subjects)
+        return [subject for subject in subject_list
+                if self.subjects.get(subject, {}).get('nfiles', 0) == 0]
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Bulk app registration: registers many apps on many execution systems
+from a manifest, with one Agave session::
+
+    defaults:
+      deploymentSystem: openfmri-storage
+      participant_args: --nthreads 4
+    apps:
+      - name: fmriprep-{system}
+        version: 1.0.0
+        image: /images/fmriprep-1.0.0.img
+        systems: [slurm-sherlock.stanford.edu, slurm-ls5.tacc.utexas.edu]
+      - name: mriqc-{system}
+        version: 0.9.6
+        image: /images/mriqc-0.9.6.img
+        systems: all
+
+``{system}`` is replaced by the execution system (without its domain),
+so that each system gets its own app id.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import os.path as op
+import json
+import logging
+from io import open
+from collections import OrderedDict
+from argparse import ArgumentParser, RawTextHelpFormatter
+from builtins import object
+
+import yaml
+
+from cappat.appgen import (CappatAgaveClient, AGAVE_APP_OPTIONAL,
+                           AGAVE_EXECUTION_SYSTEMS, app_description)
+from cappat.transfer import (Uploader, ImageStore, TransferState, run_concurrently,
+                             TRANSFER_STATE_FILE, IMAGE_INDEX_FILE)
+from cappat.metrics import METRICS
+
+logger = logging.getLogger('appgen')
+
+MANIFEST_KEYS = ['name', 'version', 'image', 'systems', 'participant_args', 'group_args']
+
+
+def read_manifest(manifest_file):
+    """
+    Reads a manifest and returns the list of (app description, image file)
+    of every app and execution system
+    """
+    with open(manifest_file) as mfh:
+        manifest = yaml.safe_load(mfh) or {}
+
+    defaults = manifest.get('defaults') or {}
+    optional = [field for field, _ in AGAVE_APP_OPTIONAL]
+    apps = []
+    for entry in manifest.get('apps') or []:
+        entry = dict(defaults, **entry)
+        unknown = set(entry.keys()) - set(MANIFEST_KEYS) - set(optional)
+        if unknown:
+            raise RuntimeError('Unknown fields in the manifest entry of app "{}": {}'.format(
+                entry.get('name'), ', '.join(sorted(unknown))))
+
+        systems = entry.get('systems') or 'all'
+        if systems == 'all':
+            systems = AGAVE_EXECUTION_SYSTEMS
+        if not isinstance(systems, list):
+            systems = [systems]
+
+        for system in systems:
+            if system not in AGAVE_EXECUTION_SYSTEMS:
+                raise RuntimeError('Unknown execution system "{}"'.format(system))
+            desc = app_description(
+                entry['name'].format(system=system.split('.')[0]), '%s' % entry['version'],
+                system, entry['image'],
+                fields=dict((field, entry[field]) for field in optional if field in entry),
+                participant_args=entry.get('participant_args'),
+                group_args=entry.get('group_args'))
+            apps.append((desc, entry['image'] if op.isfile(entry['image']) else None))
+    return apps
+
+
+class BulkRegistration(object):
+    """
+    Registers many apps sharing one authenticated client (``agave``): apps
+    and storage systems are listed once, the wrapper and each image are
+    uploaded once per storage system, and up to ``concurrency`` uploads
+    and registrations run at once. The state of the uploads and the index
+    of the images are kept in ``state_file`` and ``index_file``.
+    """
+
+    def __init__(self, agave, concurrency=4, content_addressed=False,
+                 state_file=TRANSFER_STATE_FILE, index_file=IMAGE_INDEX_FILE):
+        self.agave = agave
+        self.concurrency = concurrency
+        self.content_addressed = content_addressed
+        self.uploader = Uploader(agave, state=TransferState(state_file),
+                                 concurrency=concurrency)
+        self.image_store = ImageStore(
+            self.uploader, index_file=index_file) if content_addressed else None
+        self.app_ids = set(app['id'] for app in agave.apps.list())
+        self._root_dirs = {}
+
+    def _client(self, app_desc):
+        client = CappatAgaveClient(app_desc, agave=self.agave,
+                                   content_addressed=self.content_addressed)
+        # Share the caches of the session
+        client._uploader = self.uploader
+        client._image_store = self.image_store
+        client._app_ids = self.app_ids
+        client._root_dirs = self._root_dirs
+        return client
+
+    @staticmethod
+    def _call(func, kwargs):
+        try:
+            return func(**kwargs), None
+        except Exception as error:  # pylint: disable=broad-except
+            logger.error('Upload of "%s" failed: %s',
+                         kwargs.get('fname', kwargs.get('image_file')), error)
+            return None, error
+
+    @staticmethod
+    def _add(client):
+        try:
+            client.add_app()
+            return 'registered'
+        except Exception as error:  # pylint: disable=broad-except
+            logger.error('Registration of app "%s" failed: %s', client.app_id, error)
+            return 'failed: %s' % error
+
+    def register(self, apps):
+        """
+        Registers a list of (app description, image file) and returns the
+        status of each app id (``registered``, ``exists`` or ``failed: ...``)
+        """
+        clients = [(self._client(desc), image) for desc, image in apps]
+        app_ids = [client.app_id for client, _ in clients]
+        duplicates = sorted(set(app_id for app_id in app_ids if app_ids.count(app_id) > 1))
+        if duplicates:
+            raise RuntimeError('Apps registered more than once: {}. Use "{{system}}" in '
+                               'the names of apps with several systems.'.format(
+                                   ', '.join(duplicates)))
+
+        status = OrderedDict((app_id, 'exists') for app_id in app_ids)
+        pending = [(client, image) for client, image in clients
+                   if client.app_id not in self.app_ids]
+        for client, _ in clients:
+            if client.app_id in self.app_ids:
+                logger.warning('App "%s" is already registered, skipping', client.app_id)
+
+        # Shared artifacts are uploaded once
+        uploads = OrderedDict()
+        needs = []
+        for client, image in pending:
+            calls = [(client.uploader.upload, client._wrapper_transfer())]
+            if image is not None:
+                calls.append(client._image_upload(image))
+            keys = []
+            for func, kwargs in calls:
+                key = json.dumps(kwargs, sort_keys=True)
+                uploads.setdefault(key, (self._call, {'func': func, 'kwargs': kwargs}))
+                keys.append(key)
+            needs.append(keys)
+
+        logger.info('Uploading %d files for %d apps', len(uploads), len(pending))
+        results = dict(zip(uploads.keys(), run_concurrently(
+            list(uploads.values()), self.concurrency)))
+
+        ready = []
+        for (client, image), keys in zip(pending, needs):
+            errors = [results[key][1] for key in keys if results[key][1] is not None]
+            if errors:
+                status[client.app_id] = 'failed: %s' % errors[0]
+                continue
+            if image is not None:
+                client._set_image_cmd(results[keys[1]][0])
+            ready.append(client)
+
+        for client, result in zip(ready, run_concurrently(
+                [(self._add, {'client': client}) for client in ready], self.concurrency)):
+            status[client.app_id] = result
+        return status
+
+
+def main():
+    """Entry point"""
+    parser = ArgumentParser(description="""\
+Registers the apps and execution systems listed in a manifest in the \
+CRN-platform""", formatter_class=RawTextHelpFormatter)
+    parser.add_argument('manifest', action='store', help='YAML manifest of the apps')
+    parser.add_argument('-j', '--jobs', action='store', type=int, default=4,
+                        help='uploads and registrations run at once')
+    parser.add_argument(
+        '--content-addressed', action='store_true', default=False,
+        help='name images after their digest and reuse those already uploaded')
+    parser.add_argument('-o', '--output', action='store',
+                        help='write the status of each app to this JSON file')
+
+    g_agave = parser.add_argument_group('Agave settings')
+    g_agave.add_argument('-u', '--username', action='store',
+                         default=os.getenv('AGAVE_USERNAME', None),
+                         help='agave username')
+    g_agave.add_argument('-p', '--password', action='store',
+                         default=os.getenv('AGAVE_PASSWORD', None),
+                         help='agave password')
+    opts = parser.parse_args()
+
+    apps = read_manifest(opts.manifest)
+    session = CappatAgaveClient(auth=(opts.username, opts.password))
+    status = BulkRegistration(session.agave, concurrency=opts.jobs,
+                              content_addressed=opts.content_addressed).register(apps)
+
+    for app_id, app_status in list(status.items()):
+        logger.info('%s: %s', app_id, app_status)
+    logger.info('Timing of the Agave API calls:\n%s', METRICS.summary())
+    if opts.output:
+        with open(opts.output, 'w') as ofh:
+            ofh.write('%s' % json.dumps(status, indent=2))
+
+    failed = [app_id for app_id, app_status in list(status.items())
+              if app_status.startswith('failed')]
+    if failed:
+        raise RuntimeError('Registration failed for apps: {}'.format(', '.join(failed)))
+
+
+if __name__ == '__main__':
+    main()
@@ -26,6 +26,10 @@ echo "  max_runtime: \"${AGAVE_JOB_MAX_RUNTIME}\"" >> settings.yml
 echo "  modules: ${loadModules}" >> settings.yml
 echo "  participant_args: ${participantArgs}" >> settings.yml
 echo "  group_args: ${groupArgs}" >> settings.yml
+# Runtimes are only recorded if a database is set (e.g. ~/.cappat/runtimes.sqlite)
+if [[ -n "${CAPPAT_RUNTIME_DB}" ]]; then
+    echo "  runtime_db: ${CAPPAT_RUNTIME_DB}" >> settings.yml
+fi
 
 echo "" >> settings.yml
 echo "agave:" >> settings.yml
@@ -44,7 +44,8 @@ URL = 'http://{}.readthedocs.io/'.format(__packagename__)
 REQUIRES = [
     'jinja2',
     'PyYAML',
-    'future'
+    'future',
+    'scandir; python_version < "3.5"',
 ]
 
 # Required before running setup()
@@ -62,7 +63,7 @@ TESTS_REQUIRES = [
 # Dependencies to install for extra features
 # For now, only documentation is enabled. Install with pip install -e .[doc]
 EXTRA_REQUIRES = {
-    'appgen': ['agavepy'],
+    'appgen': ['agavepy', 'requests'],
     'doc': ['sphinx'],
     'tests': TESTS_REQUIRES,
 }
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Accounting: resource usage and efficiency of finished jobs, from sacct
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import logging
+from io import open
+from math import ceil
+from builtins import zip
+
+from .tools import parse_elapsed, parse_memory
+from .parsers import split_jobid
+
+# sacct -n -P -o <ACCT_FIELDS>
+ACCT_FIELDS = ['JobID', 'State', 'Elapsed', 'TotalCPU', 'MaxRSS', 'MaxDiskRead',
+               'MaxDiskWrite', 'ReqMem', 'AllocCPUS', 'NNodes']
+# Job ids per sacct call, keeps the command line well below ARG_MAX
+SACCT_MAX_IDS = 500
+# Headroom of the suggested resource requests over the observed peaks
+SUGGEST_MARGIN = 1.2
+
+JOB_LOG = logging.getLogger('taskmanager')
+
+
+def chunks(items, size=SACCT_MAX_IDS):
+    """Splits a list in consecutive chunks of at most ``size`` elements"""
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def parse_reqmem(reqmem, cpus=None, nnodes=None):
+    """
+    Converts the ReqMem field of sacct to the total KB requested by the
+    job. Older Slurm versions append ``c`` (per cpu) or ``n`` (per node).
+
+    >>> parse_reqmem('4000Mc', cpus=4)
+    16384000
+
+    """
+    reqmem = reqmem.strip()
+    if not reqmem:
+        return None
+
+    per = None
+    if reqmem[-1] in 'cn':
+        per, reqmem = reqmem[-1], reqmem[:-1]
+    if reqmem.replace('.', '', 1).isdigit():
+        # Slurm memory requests are in MB by default
+        reqmem += 'M'
+
+    kbytes = parse_memory(reqmem)
+    if per == 'c':
+        kbytes *= cpus or 1
+    elif per == 'n':
+        kbytes *= nnodes or 1
+    return kbytes
+
+
+def _int(value):
+    value = value.strip()
+    return int(value) if value.isdigit() else None
+
+
+def parse_usage(results, job_ids, fields=None):
+    """
+    Parses the output of ``sacct -n -P -o <fields>`` into a dictionary of
+    jobs with their final state, elapsed and total cpu time (s), peak
+    resident memory, disk read and written and memory requested (KB),
+    allocated cpus and cpu and memory efficiency. Only the jobs in
+    ``job_ids`` are kept. Peaks are the maximum over all the job steps.
+    """
+    if fields is None:
+        fields = ACCT_FIELDS
+
+    usage = {}
+    for line in results.split('\n'):
+        values = line.strip().split('|')
+        if len(values) < len(fields):
+            continue
+        row = dict(zip(fields, values))
+        jobid, step = split_jobid(row['JobID'])
+        if jobid not in job_ids:
+            continue
+
+        job = usage.setdefault(jobid, {
+            'state': None, 'elapsed': None, 'totalcpu': None, 'cpus': None,
+            'maxrss': 0, 'reqmem': None, 'disk_read': 0, 'disk_write': 0})
+        if step is None:
+            job['state'] = row['State'].split(' ')[0]
+            job['elapsed'] = parse_elapsed(row['Elapsed'])
+            job['totalcpu'] = parse_elapsed(row.get('TotalCPU', ''))
+            job['cpus'] = _int(row.get('AllocCPUS', ''))
+            job['reqmem'] = parse_reqmem(row.get('ReqMem', ''), job['cpus'],
+                                         _int(row.get('NNodes', '')))
+        job['maxrss'] = max(job['maxrss'], parse_memory(row.get('MaxRSS', '')))
+        job['disk_read'] = max(job['disk_read'], parse_memory(row.get('MaxDiskRead', '')))
+        job['disk_write'] = max(job['disk_write'],
+                                parse_memory(row.get('MaxDiskWrite', '')))
+
+    for job in list(usage.values()):
+        job['cpu_efficiency'] = None
+        if job['elapsed'] and job['cpus'] and job['totalcpu'] is not None:
+            job['cpu_efficiency'] = job['totalcpu'] / (job['elapsed'] * job['cpus'])
+        job['mem_efficiency'] = None
+        if job['reqmem']:
+            job['mem_efficiency'] = job['maxrss'] / job['reqmem']
+    return usage
+
+
+def _mean(values):
+    values = [value for value in values if value is not None]
+    return sum(values) / len(values) if values else None
+
+
+def accounting_report(usage, job_tasks, task_participants, app=None):
+    """
+    Builds the per-task efficiency table and the summary of the app,
+    with suggested ``mincpus`` and ``mem_per_cpu`` (MB) for the next runs
+    """
+    tasks = []
+    for jobid, task_indices in list(job_tasks.items()):
+        if jobid not in usage:
+            continue
+        task = dict(usage[jobid])
+        task['jobid'] = jobid
+        task['participants'] = [subject for i in task_indices
+                                for subject in task_participants[i]]
+        tasks.append(task)
+
+    completed = [task for task in tasks if task['state'] == 'COMPLETED' and
+                 task['elapsed'] and task['cpus']]
+    summary = {'app': app, 'jobs': len(tasks), 'completed': len(completed)}
+    if completed:
+        allocated = sum(task['elapsed'] * task['cpus'] for task in completed)
+        used = sum(task['totalcpu'] or 0 for task in completed)
+        cpus_used = max((task['totalcpu'] or 0) / task['elapsed'] for task in completed)
+        maxrss = max(task['maxrss'] for task in completed)
+        mincpus = max(1, int(ceil(cpus_used * SUGGEST_MARGIN)))
+        summary.update({
+            'core_hours': allocated / 3600,
+            'cpu_hours_used': used / 3600,
+            'cpu_efficiency': used / allocated,
+            'mem_efficiency': _mean(task['mem_efficiency'] for task in completed),
+            'maxrss': maxrss,
+            'suggested_mincpus': mincpus,
+            'suggested_mem_per_cpu': int(ceil(maxrss * SUGGEST_MARGIN / mincpus / 1024)),
+        })
+    return {'summary': summary, 'tasks': tasks}
+
+
+def write_report(report, path):
+    """Writes the accounting report as JSON"""
+    with open(path, 'w') as rfh:
+        rfh.write('%s' % json.dumps(report, indent=2, sort_keys=True))
+    summary = report['summary']
+    if summary.get('completed'):
+        JOB_LOG.info(
+            'Accounting of %d jobs: %.1f core-hours, cpu efficiency %.0f%%, memory '
+            'efficiency %.0f%%. Suggested mincpus=%d, mem_per_cpu=%d (report: %s)',
+            summary['jobs'], summary['core_hours'], 100 * summary['cpu_efficiency'],
+            100 * (summary['mem_efficiency'] or 0), summary['suggested_mincpus'],
+            summary['suggested_mem_per_cpu'], path)
+    return path
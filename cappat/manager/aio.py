@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Asyncio driver of a task manager (Python 3 only), so that one event loop
+can supervise many workflows::
+
+    stm = TaskManager.build(task_list, settings, work_dir=work_dir)
+    amgr = AsyncTaskManager(stm)
+    await amgr.map_participant()
+    async for jobid, state, participants in amgr.completions():
+        ...
+    await amgr.run_grouplevel()
+
+The bookkeeping (sbatch generation, job states, retries, listeners) is
+that of the wrapped manager, only the scheduler commands and the waits
+are run asynchronously.
+"""
+import asyncio
+import logging
+import os
+from os import path as op
+import signal
+import subprocess as sp
+from timeit import default_timer as timer
+
+from cappat.metrics import METRICS
+from .base import GROUP_OUTPUT_BYTES
+from .tools import LineSplitter, OutputBuffer, READ_CHUNK_BYTES
+from .watcher import JobWatcher
+
+JOB_LOG = logging.getLogger('taskmanager')
+
+
+class AsyncTaskManager(object):
+    """
+    Runs the submission, polling and group level of ``manager`` (a
+    ``TaskSubmissionBase``) without blocking the event loop. Workflows
+    driven from the same loop can share ``semaphore`` to bound the number
+    of scheduler commands running at once.
+    """
+
+    def __init__(self, manager, semaphore=None):
+        self._manager = manager
+        self._settings = manager._settings
+        self._semaphore = semaphore
+        if semaphore is None:
+            self._semaphore = asyncio.Semaphore(
+                int(self._settings.get('scheduler_concurrency', 4)))
+
+    @property
+    def manager(self):
+        return self._manager
+
+    @property
+    def job_ids(self):
+        return self._manager.job_ids
+
+    async def _run_cmd(self, cmd, timeout=None):
+        JOB_LOG.info('Executing command line: %s', ' '.join(cmd))
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+        try:
+            output, _ = await asyncio.wait_for(proc.communicate(), timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            JOB_LOG.critical('Command timed out after %ss: \n\tCmdline: %s',
+                             timeout, ' '.join(cmd))
+            raise RuntimeError('Command "{}" timed out after {}s'.format(' '.join(cmd), timeout))
+        output = output.decode('utf-8', 'replace')
+        if proc.returncode != 0:
+            JOB_LOG.critical('Error submitting (exit code %d): \n\tCmdline: %s\n\tOutput:\n\t%s',
+                             proc.returncode, ' '.join(cmd), output)
+            raise sp.CalledProcessError(proc.returncode, cmd, output=output)
+        output = '\n'.join([line for line in output.split('\n') if line.strip()])
+        return output or None
+
+    async def _run_scheduler(self, cmd):
+        """Runs a scheduler command, on the remote host if necessary"""
+        prefix = self._manager._cmd_prefix
+        transport = self._manager._transport
+        if transport is not None:
+            # Opening the master connection blocks, once
+            await asyncio.get_running_loop().run_in_executor(None, transport.open)
+            prefix = transport.prefix
+
+        async with self._semaphore:
+            start = timer()
+            try:
+                return await self._run_cmd(
+                    list(prefix) + cmd, timeout=self._settings.get('scheduler_timeout'))
+            finally:
+                METRICS.observe('scheduler.' + cmd[0], timer() - start)
+
+    async def _submit_retry(self, task):
+        retries = int(self._settings.get('submit_retries', 3))
+        rate_limiter = self._manager._rate_limiter
+        for attempt in range(retries + 1):
+            if rate_limiter is not None:
+                # The token bucket blocks: wait for it out of the event loop
+                await asyncio.get_running_loop().run_in_executor(
+                    None, rate_limiter.acquire)
+            try:
+                return await self._run_scheduler(['sbatch', task])
+            except sp.CalledProcessError as error:
+                await asyncio.sleep(
+                    self._manager._submit_delay(task, error, attempt, retries))
+
+    async def _submit_files(self, sbatch_files):
+        # Job ids are recorded in the order of the files, as the manager does
+        results = await asyncio.gather(*[self._submit_retry(task) for task in sbatch_files])
+        return [self._manager._submitted(i, task, sresult)
+                for i, (task, sresult) in enumerate(zip(sbatch_files, results))]
+
+    async def map_participant(self, task_indices=None):
+        """Submits the sbatch files concurrently and returns the job ids"""
+        return await self._submit_files(
+            self._manager._generate_sbatch(task_indices=task_indices))
+
+    async def _get_job_acct(self, job_ids=None):
+        if job_ids is None:
+            job_ids = self.job_ids
+        JOB_LOG.info('Checking exit code of jobs %s', ' '.join(job_ids))
+        outputs = await asyncio.gather(*[
+            self._run_scheduler(cmd) for cmd in self._manager._sacct_cmds(job_ids)])
+        results = '\n'.join(output for output in outputs if output) or None
+        return self._manager._update_acct(results, job_ids)
+
+    async def _jobs_finished(self, job_ids):
+        """Asynchronous counterpart of ``TaskSubmissionBase._jobs_finished``"""
+        manager = self._manager
+        await self._get_job_acct(job_ids)
+
+        resubmitted = []
+        if manager._retry is not None:
+            task_indices = manager._select_retries(job_ids)
+            if task_indices:
+                resubmitted = await self._submit_files(
+                    manager._resubmit_sbatch(task_indices))
+                manager._resubmitted(task_indices, resubmitted)
+
+        manager._notify_listeners(job_ids)
+        return resubmitted
+
+    async def completions(self):
+        """
+        Polls the scheduler and generates ``(jobid, state, participants)``
+        for every job as it leaves the queue, where participants are those
+        of its tasks that completed. Finishes when no job is left.
+        """
+        manager = self._manager
+        intervals = JobWatcher(manager).intervals()
+        while True:
+            squeue = await self._run_scheduler(manager._squeue_cmd())
+            all_finished = manager._update_status(squeue)
+            finished = manager._collect_finished(all_finished)
+            if finished:
+                if await self._jobs_finished(finished):
+                    # Some tasks were resubmitted
+                    all_finished = False
+                retried = dict(manager.retries)
+                for jobid in finished:
+                    if jobid in retried:
+                        yield jobid, retried[jobid], []
+                    else:
+                        yield (jobid, manager.jobs[jobid],
+                               manager._completed_participants([jobid]))
+
+            if all_finished:
+                break
+            await asyncio.sleep(next(intervals))
+
+    async def wait_participant(self):
+        """
+        Waits until all jobs are done. If the waiting task is cancelled,
+        the jobs are cancelled in the scheduler as well.
+        """
+        JOB_LOG.info('Starting wait on jobs %s', ' '.join(self.job_ids))
+        try:
+            async for _ in self.completions():
+                pass
+        except asyncio.CancelledError:
+            await self.cancel()
+            raise
+
+        JOB_LOG.info('Finished wait on jobs %s', ', '.join(self.job_ids))
+        return self._manager._check_exit_codes(await self._get_job_acct())
+
+    async def cancel(self, job_ids=None):
+        """Cancels the jobs that are still in the queue (all by default)"""
+        manager = self._manager
+        if job_ids is None:
+            job_ids = [jobid for jobid in manager.job_ids
+                       if jobid not in manager._finished]
+        if not job_ids:
+            return []
+
+        JOB_LOG.warning('Cancelling jobs %s', ', '.join(job_ids))
+        # Whole arrays are cancelled through their parent id
+        query_ids = manager._query_ids(job_ids)
+        await self._run_scheduler(['scancel'] + query_ids)
+        for jobid in job_ids:
+            manager.jobs[jobid] = 'CANCELLED'
+        return job_ids
+
+    async def run_grouplevel(self):
+        """
+        Runs the reduce operation over the participant map. As in the
+        synchronous path, its full output goes to ``group-wrapper.log``
+        and only ``group_output_bytes`` of it are kept in memory
+        """
+        cmdline = self._manager._final_group_cmdline()
+        if cmdline is None:
+            return True
+
+        JOB_LOG.info('Kicking off reduce operation')
+        group_wrapper = self._manager._write_group_wrapper(cmdline)
+        group_log = op.join(self._manager.aux_dir, 'group-wrapper.log')
+        JOB_LOG.info('Output of the group level is written to %s', group_log)
+        timeout = self._manager._settings.get('group_timeout')
+        cmd = ['/bin/bash', group_wrapper]
+        JOB_LOG.info('Executing command line: %s', ' '.join(cmd))
+
+        output = OutputBuffer(self._manager._settings.get(
+            'group_output_bytes', GROUP_OUTPUT_BYTES))
+        splitter = LineSplitter()
+
+        async def _collect(proc):
+            with open(group_log, 'ab') as tee:
+                while True:
+                    chunk = await proc.stdout.read(READ_CHUNK_BYTES)
+                    if not chunk:
+                        break
+                    tee.write(chunk)
+                    for line in splitter.feed(chunk):
+                        if line.strip():
+                            output.append(line)
+            for line in splitter.close():
+                if line.strip():
+                    output.append(line)
+            return await proc.wait()
+
+        # The wrapper runs in its own process group, so that killing it also
+        # kills its children (asyncio waits for the pipe to be closed)
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT,
+            start_new_session=True)
+        try:
+            retcode = await asyncio.wait_for(_collect(proc), timeout)
+        except asyncio.TimeoutError:
+            JOB_LOG.critical('Group level timed out after %ss:\n\tOutput:\n\t%s',
+                             timeout, output.getvalue())
+            raise RuntimeError('Command "{}" timed out after {}s'.format(
+                ' '.join(cmd), timeout))
+        finally:
+            if proc.returncode is None:
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                await proc.wait()
+
+        if retcode != 0:
+            JOB_LOG.critical('Group level finished with exit code %d:\n\tOutput:\n\t%s',
+                             retcode, output.getvalue())
+            raise sp.CalledProcessError(retcode, cmd, output=output.getvalue())
+        JOB_LOG.info('Group level finished successfully.')
+        return True
+
+
+def run_workflows(managers, group=True):
+    """
+    Runs the participant and group levels of several task managers in one
+    event loop. Returns the job ids or the exception of each workflow.
+    """
+    async def _run(amgr):
+        await amgr.map_participant()
+        job_ids = await amgr.wait_participant()
+        if group:
+            await amgr.run_grouplevel()
+        return job_ids
+
+    async def _main():
+        semaphore = asyncio.Semaphore(int(
+            managers[0]._settings.get('scheduler_concurrency', 4)) if managers else 1)
+        return await asyncio.gather(*[
+            _run(AsyncTaskManager(manager, semaphore)) for manager in managers],
+            return_exceptions=True)
+
+    return asyncio.run(_main())
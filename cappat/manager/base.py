@@ -10,24 +10,48 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 import os
 from os import path as op
 import re
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from random import uniform
 from time import sleep
+from time import time
+from timeit import default_timer as timer
+import subprocess as sp
 import logging
 from pprint import pformat as pf
+from io import open
 from pkg_resources import resource_filename as pkgrf
-from builtins import object
+from builtins import object, zip
 
 from cappat import AGAVE_JOB_LOGS, AGAVE_JOB_OUTPUT
+from cappat.metrics import METRICS
 from ..tpl import Template
 from ..utils import check_folder
 
 from .tools import (
     time_fraction as _tf,
     format_modules as _format_modules,
-    run_cmd as _run_cmd)
-
-SLURM_FAIL_STATUS = ['CA', 'F', 'TO', 'NF', 'SE']
-SLURM_WAIT_STATUS = ['R', 'PD', 'CF', 'CG']
-SLEEP_SECONDS = 5
+    run_cmd as _run_cmd,
+    task_participants as _task_participants,
+    _time2secs, _secs2time,
+    SSHTransport,
+    RateLimiter)
+from .watcher import WATCHERS, JobWatcher, SLEEP_SECONDS, SENTINEL_PATTERN
+from .retry import RetryPolicy
+from .group import IncrementalGroup, GROUP_UPDATE_RETRIES
+from .broker import StatusBroker
+from .accounting import ACCT_FIELDS, chunks as _chunks, parse_usage as _parse_usage
+from .parsers import (StateTable, SQUEUE_FORMAT, STATE_NAMES, TERMINAL, COMPLETED,
+                      parse_squeue as _parse_squeue, parse_sacct as _parse_sacct,
+                      parse_sbatch as _parse_sbatch)
+
+# sbatch errors worth retrying
+SLURM_TRANSIENT_ERRORS = [
+    'Socket timed out', 'temporarily unable', 'Resource temporarily unavailable',
+    'Unable to contact slurm controller', 'busy']
+SUBMIT_RETRY_SECONDS = 2
+# Output of the group level kept in memory (the full output goes to a log file)
+GROUP_OUTPUT_BYTES = 1024 * 1024
 
 JOB_LOG = logging.getLogger('taskmanager')
 
@@ -41,6 +65,7 @@ class TaskSubmissionBase(object):
 
     SLURM_TEMPLATE = None
     GROUP_TEMPLATE = op.abspath(pkgrf('cappat', 'tpl/group-wrapper.jnj2'))
+    GROUP_SBATCH_TEMPLATE = op.abspath(pkgrf('cappat', 'tpl/group-sbatch.jnj2'))
 
     def __init__(self, task_list, settings=None, work_dir=None):
 
@@ -48,8 +73,32 @@ class TaskSubmissionBase(object):
             raise RuntimeError('a list of tasks is required')
 
         self.task_list = task_list
-        self._jobs = {}
-
+        self.task_participants = [_task_participants(task) for task in task_list]
+        self._jobs = StateTable()
+        # Indices of the tasks run by each job
+        self._job_tasks = OrderedDict()
+        # Indices of the tasks run by each sbatch file, and the task ids
+        # of the job array files
+        self._sbatch_tasks = {}
+        self._array_sbatch = {}
+        # Jobs that left the queue, jobs in the queue at the last poll
+        self._finished = set()
+        # Submission and end (when the job left the queue) times of each job
+        self._job_times = OrderedDict()
+        self._pending = None
+        # Wall clock time of the last submission
+        self._last_submit = 0.0
+        # Jobs that were replaced by a resubmission: (jobid, state)
+        self._retries = []
+        # Callbacks receiving the participants of completed tasks
+        self._listeners = []
+        self._incremental = None
+        self._group_job = None
+        # Batch files rendered by a plan, instead of written
+        self._rendered = None
+
+        # Do not share settings between instances
+        self._settings = self._settings.copy()
         if settings is not None:
             self._settings.update(settings)
 
@@ -57,6 +106,13 @@ class TaskSubmissionBase(object):
             work_dir = os.getcwd()
 
         self._settings['child_runtime'] = _tf(self._settings['max_runtime'])
+        if self._settings.get('task_runtimes'):
+            # Per-task walltime requests, never above the default
+            max_secs = _time2secs(self._settings['child_runtime'])
+            self._settings['task_runtimes'] = [
+                _secs2time(min(_time2secs(runtime), max_secs)) if runtime
+                else self._settings['child_runtime']
+                for runtime in self._settings['task_runtimes']]
 
         self.work_dir = check_folder(op.abspath(work_dir))
         self.aux_dir = check_folder(op.join(self.work_dir, AGAVE_JOB_LOGS))
@@ -64,6 +120,16 @@ class TaskSubmissionBase(object):
             {'work_dir': self.work_dir, 'aux_dir': self.aux_dir}
         )
 
+        self.sentinel_dir = None
+        if self._settings.get('watcher', 'scheduler') not in WATCHERS:
+            raise RuntimeError('Unknown watcher "{}", valid watchers are: {}'.format(
+                self._settings['watcher'], ', '.join(sorted(WATCHERS.keys()))))
+
+        if self._settings.get('watcher') == 'sentinel':
+            # Tasks will write their exit code in this folder
+            self.sentinel_dir = check_folder(op.join(self.aux_dir, 'sentinels'))
+            self._settings['sentinel_dir'] = self.sentinel_dir
+
         self._group_cmd = [self._settings['executable'], self._settings['bids_dir'],
                            AGAVE_JOB_OUTPUT, 'group']
 
@@ -80,6 +146,35 @@ class TaskSubmissionBase(object):
         JOB_LOG.info('Automatically inferred group level command: "%s"',
                      ' '.join(self.group_cmd))
 
+        self._retry = None
+        if self._settings.get('retry', False):
+            self._retry = RetryPolicy(
+                self._settings, len(task_list), rules=self._settings.get('retry_rules'),
+                max_attempts=self._settings.get('retry_max_attempts'),
+                budget=self._settings.get('retry_budget'))
+
+        self._rate_limiter = None
+        if self._settings.get('submit_rate'):
+            self._rate_limiter = RateLimiter(
+                self._settings['submit_rate'], self._settings.get('submit_burst', 1))
+
+        self._broker = None
+        if self._settings.get('status_broker', False):
+            self._broker = StatusBroker(
+                cache_file=self._settings.get('status_broker_file'),
+                interval=self._settings.get('poll_min_seconds', SLEEP_SECONDS),
+                system=self._settings.get('execution_system'))
+
+        if self._settings.get('cmd_prefix'):
+            # The scheduler is reached through this command (e.g. ssh to a login node)
+            self._cmd_prefix = self._settings['cmd_prefix']
+            if not isinstance(self._cmd_prefix, list):
+                self._cmd_prefix = self._cmd_prefix.split()
+
+        self._transport = None
+        if 'ssh' in self._cmd_prefix and self._settings.get('ssh_multiplex', True):
+            self._transport = SSHTransport(self._cmd_prefix)
+
         self._settings['modules'] = _format_modules(self._settings.get('modules', []))
         JOB_LOG.info('Created TaskManager type "%s" with default settings: \n\t%s',
                      self.__class__.__name__, pf(self._settings))
@@ -92,6 +187,38 @@ class TaskSubmissionBase(object):
     def jobs(self):
         return self._jobs
 
+    @property
+    def job_tasks(self):
+        """The indices of the tasks in task_list run by each job"""
+        return self._job_tasks
+
+    @property
+    def job_times(self):
+        """
+        The time each job was submitted and the time it was found out of
+        the queue (``None`` while it is in the queue)
+        """
+        return self._job_times
+
+    @property
+    def retries(self):
+        """The jobs that were resubmitted, and their final state"""
+        return self._retries
+
+    @property
+    def query_ids(self):
+        """
+        The list of job ids that must be passed to squeue/sacct.
+        Array elements (``<jobid>_<taskid>``) are queried through
+        their parent job id.
+        """
+        return self._query_ids(self.job_ids)
+
+    @staticmethod
+    def _query_ids(job_ids):
+        return list(OrderedDict(
+            (jobid.split('_')[0], None) for jobid in job_ids).keys())
+
     @property
     def group_cmd(self):
         return self._group_cmd
@@ -103,58 +230,152 @@ class TaskSubmissionBase(object):
 
         self._group_cmd = value
 
-    def _parse_jobid(self, slurm_msg):
+    def _parse_jobid(self, slurm_msg, tasks=None, array_ids=None):
         if isinstance(slurm_msg, (list, tuple)):
             slurm_msg = '\n'.join(slurm_msg)
 
+        if tasks is None:
+            tasks = []
+
         jobid = self.jobexp.search(slurm_msg).group('jobid')
-        if jobid:
+        self._last_submit = time()
+        if jobid and array_ids is not None:
+            for taskid, task_index in zip(array_ids, tasks):
+                self._jobs['%s_%d' % (jobid, taskid)] = 'SUBMITTED'
+                self._job_tasks['%s_%d' % (jobid, taskid)] = [task_index]
+                self._job_times['%s_%d' % (jobid, taskid)] = [timer(), None]
+        elif jobid:
             self._jobs[jobid] = 'SUBMITTED'
+            self._job_tasks[jobid] = tasks
+            self._job_times[jobid] = [timer(), None]
         else:
             raise RuntimeError('Job ID could not extracted. Slurm message:\n{}'.format(
                 slurm_msg))
         return jobid
 
-    def _generate_sbatch(self):
+    def _generate_sbatch(self, task_indices=None, overrides=None):
+        """
+        Generates the sbatch files for the tasks in ``task_indices``
+        (all by default), updating the settings of each task with
+        ``overrides`` (a dictionary indexed by task)
+        """
         raise NotImplementedError
 
-    def _submit_sbatch(self, task):
-        return _run_cmd(self._cmd_prefix + ['sbatch', task])
-
-    def _run_sacct(self):
-        # sacct -n -X -j 10016750,10016749 -o JobID,State,ExitCode
-        return _run_cmd(self._cmd_prefix + [
-            'sacct', '-n', '-X', '-j', ','.join(self.job_ids),
-            '-o', 'JobID,State,ExitCode'])
+    def _run_scheduler(self, cmd):
+        """Runs a scheduler command, on the remote host if necessary"""
+        timeout = self._settings.get('scheduler_timeout')
+        with METRICS.timer('scheduler.' + cmd[0]):
+            if self._transport is not None:
+                return self._transport.run(cmd, timeout=timeout)
+            return _run_cmd(self._cmd_prefix + cmd, timeout=timeout)
 
-    def _get_job_acct(self):
-        JOB_LOG.info('Checking exit code of jobs %s', ' '.join(self.job_ids))
-        results = self._run_sacct()
+    def _submit_sbatch(self, task):
+        return self._run_scheduler(['sbatch', task])
 
+    def _submit_retry(self, task):
+        """
+        Submits one sbatch file, retrying with an exponential backoff
+        and jitter when sbatch fails with a transient error
+        """
+        retries = int(self._settings.get('submit_retries', 3))
+        for attempt in range(retries + 1):
+            if self._rate_limiter is not None:
+                self._rate_limiter.acquire()
+            try:
+                return self._submit_sbatch(task)
+            except sp.CalledProcessError as error:
+                sleep(self._submit_delay(task, error, attempt, retries))
+
+    @staticmethod
+    def _submit_delay(task, error, attempt, retries):
+        """
+        The wait before submitting again after ``error``, which is raised
+        again if it is not transient or there are no retries left
+        """
+        output = '%s' % error.output
+        transient = any(msg in output for msg in SLURM_TRANSIENT_ERRORS)
+        if attempt == retries or not transient:
+            raise error
+        delay = SUBMIT_RETRY_SECONDS * 2 ** attempt * uniform(0.5, 1.5)
+        METRICS.incr('submit_retries')
+        JOB_LOG.warning('Transient error submitting %s (attempt %d/%d), '
+                        'retrying in %.1fs', task, attempt + 1, retries + 1, delay)
+        return delay
+
+    def _sacct_cmds(self, job_ids):
+        # sacct -n -X -P -j 10016750,10016749 -o JobID,State,ExitCode
+        return [['sacct', '-n', '-X', '-P', '-j', ','.join(query_ids),
+                 '-o', 'JobID,State,ExitCode']
+                for query_ids in _chunks(self._query_ids(job_ids))]
+
+    def _run_sacct(self, job_ids=None):
+        if job_ids is None:
+            job_ids = self.job_ids
+        outputs = [self._run_scheduler(cmd) for cmd in self._sacct_cmds(job_ids)]
+        return '\n'.join(output for output in outputs if output) or None
+
+    def _get_job_acct(self, job_ids=None):
+        if job_ids is None:
+            job_ids = self.job_ids
+        JOB_LOG.info('Checking exit code of jobs %s', ' '.join(job_ids))
+        return self._update_acct(self._run_sacct(job_ids), job_ids)
+
+    def _update_acct(self, results, job_ids):
+        """Updates the state of the jobs from sacct, returns their exit codes"""
         if results is None:
             JOB_LOG.critical('Running sacct over jobs %s did not produce any output',
-                             ', '.join(self.job_ids))
+                             ', '.join(job_ids))
             raise RuntimeError('sacct command output is empty')
 
-        #parse results
-        regexp = re.compile('(?P<jobid>\\d*) +(?P<status>\\w*)\\+? +'
-                            '(?P<exit_code>\\d+):\\d+')
+        job_ids = set(job_ids)
         exit_codes = []
-        for line in results.split('\n'):
-            m = regexp.search(line)
-            if m is not None and all(m.groups()):
-                self._jobs[m.group('jobid')] = m.group('status')
-                if not m.group('status').startswith('CANCEL'):
-                    exit_codes.append(int(m.group('exit_code')))
-                else:
-                    exit_codes.append(128)
+        for jobid, code, exit_code in _parse_sacct(results):
+            if jobid in job_ids:
+                self._jobs.set_code(jobid, code)
+                exit_codes.append(exit_code)
 
         return exit_codes
 
+    def _run_sacct_usage(self, job_ids=None):
+        if job_ids is None:
+            job_ids = self.job_ids
+        # sacct -n -P -j 10016750,10016749 -o JobID,State,Elapsed,TotalCPU,...
+        outputs = [self._run_scheduler([
+            'sacct', '-n', '-P', '-j', ','.join(query_ids), '-o', ','.join(ACCT_FIELDS)])
+                   for query_ids in _chunks(self._query_ids(job_ids))]
+        return '\n'.join(output for output in outputs if output) or None
+
+    def get_job_usage(self, job_ids=None):
+        """
+        Returns the final state and resource usage of each job: elapsed and
+        total cpu time (in seconds), allocated cpus, peak resident memory,
+        disk read and written and requested memory (in KB), and the cpu and
+        memory efficiency (see ``accounting.parse_usage``)
+        """
+        if job_ids is None:
+            job_ids = self.job_ids
+        results = self._run_sacct_usage(job_ids)
+        if results is None:
+            JOB_LOG.warning('Running sacct over jobs %s did not produce any output',
+                            ', '.join(job_ids))
+            return {}
+        return _parse_usage(results, set(job_ids))
+
+    def _squeue_cmd(self):
+        return ['squeue', '-r', '-j', ','.join(self.query_ids), '-o', SQUEUE_FORMAT, '-h']
+
     def _get_jobs_status(self):
-        squeue = _run_cmd(self._cmd_prefix + [
-            'squeue', '-j', ','.join(self.job_ids), '-o', '%i,%t', '-h'])
+        if self._broker is not None:
+            # The queue of the user, shared with the other workflows
+            return self._update_status(self._broker.squeue(
+                self._run_scheduler, newer_than=self._last_submit))
+        return self._update_status(self._run_scheduler(self._squeue_cmd()))
 
+    def _update_status(self, squeue):
+        """
+        Updates the state of the jobs from squeue, returns True when
+        none of them is pending
+        """
         # Jobs are not in the queue anymore
         if squeue is None:
             JOB_LOG.warn('Command "squeue" was empty: jobs are completed.')
@@ -165,20 +386,17 @@ class TaskSubmissionBase(object):
             return True
 
         pending = []
-        sqexp = re.compile('(?P<jobid>\\d*),(?P<jobstatus>[' +
-                           '|'.join(SLURM_WAIT_STATUS + SLURM_FAIL_STATUS) + ']*)')
-        statuses = squeue.split('\n')
-        for line in statuses:
-            m = sqexp.search(line)
-            if m is not None and all(m.groups()):
-                status = m.groups()
-                self._jobs[status[0]] = status[1]
-
-                if status[1] in SLURM_FAIL_STATUS:
-                    JOB_LOG.warn('Job id %s failed (%s).', *status)
-                else:
-                    pending.append(status[0])
-
+        for jobid, code in _parse_squeue(squeue):
+            if jobid not in self._jobs:
+                continue
+            self._jobs.set_code(jobid, code)
+            # Finished jobs are listed for a while after they end
+            if code not in TERMINAL:
+                pending.append(jobid)
+            elif code != COMPLETED:
+                JOB_LOG.warning('Job id %s failed (%s).', jobid, STATE_NAMES[code])
+
+        self._pending = set(pending)
         if pending:
             JOB_LOG.info('There are pending jobs: %s', ' '.join(pending))
             return False
@@ -187,41 +405,300 @@ class TaskSubmissionBase(object):
                      ', '.join(self.job_ids))
         return True
 
-    def map_participant(self):
+    def map_participant(self, task_indices=None):
+        """
+        Submits a list of sbatch files (for all the tasks, or those in
+        ``task_indices``) and returns the assigned job ids
+        """
+        return self._submit_files(self._generate_sbatch(task_indices=task_indices))
+
+    def queue_depth(self):
+        """
+        The number of jobs pending in the partition, as a proxy of the
+        queue wait of new jobs
+        """
+        squeue = self._run_scheduler([
+            'squeue', '-h', '-t', 'PD', '-p', self._settings.get('partition', 'normal'),
+            '-o', '%i'])
+        return len((squeue or '').split())
+
+    def _job_cpus(self, request):
+        """The cpus allocated to a job with the ``#SBATCH`` directives in ``request``"""
+        return int(request.get('nodes') or 1) * int(
+            request.get('mincpus') or request.get('cpus_per_task') or 1)
+
+    def _task_cpus(self):
+        return self._job_cpus(self._settings)
+
+    def task_core_hours(self, task_index):
+        """The core-hours requested to run one task"""
+        runtime = self._settings['child_runtime']
+        if self._settings.get('task_runtimes'):
+            runtime = self._settings['task_runtimes'][task_index]
+        return self._task_cpus() * _time2secs(runtime) / 3600.0
+
+    def _template(self, template_str):
+        return Template(template_str, outputs=self._rendered)
+
+    def _write_aux(self, fname, content):
+        """Writes an auxiliary file of the jobs, kept in memory when planning"""
+        if self._rendered is not None:
+            self._rendered[fname] = content
+            return
+        with open(fname, 'w') as afh:
+            afh.write(content)
+
+    def _plan_job(self, sbatch_file, tasks=None):
+        script = self._rendered[sbatch_file]
+        request = _parse_sbatch(script)
+        cpus = self._job_cpus(request)
+        hours = _time2secs(request['time']) / 3600.0 if request.get('time') else 0.0
+        # Each element of an array is a job with the same resources
+        njobs = request.get('array_size', 1)
+        return {
+            'sbatch': sbatch_file,
+            'tasks': tasks,
+            'jobs': njobs,
+            'nodes': request.get('nodes') or 1,
+            'cpus': cpus,
+            'walltime': request.get('time'),
+            'partition': request.get('partition'),
+            'core_hours': round(njobs * cpus * hours, 2),
+            'script': script,
+        }
+
+    def plan(self, group=False, task_indices=None):
+        """
+        The execution plan of the workflow, without running any scheduler
+        command or writing the batch files: the sbatch scripts
+        ``map_participant`` would submit, the tasks, nodes, cpus and
+        walltime of their jobs and the core-hours they request. With
+        ``group``, the plan includes the job of ``submit_grouplevel``.
+        """
+        self._rendered = OrderedDict()
+        try:
+            jobs = [self._plan_job(sbatch_file, self._sbatch_tasks[sbatch_file])
+                    for sbatch_file in self._generate_sbatch(task_indices=task_indices)]
+            if group:
+                jobs.append(self._plan_job(
+                    self._generate_group_sbatch(self.group_cmdline())))
+                jobs[-1]['group'] = True
+        finally:
+            self._rendered = None
+
+        walltimes = [job['walltime'] for job in jobs if job['walltime']]
+        return {
+            'manager': self.__class__.__name__,
+            'tasks': len(self.task_list) if task_indices is None else len(task_indices),
+            'jobs': jobs,
+            'submissions': len(jobs),
+            'scheduler_jobs': sum(job['jobs'] for job in jobs),
+            'core_hours': round(sum(job['core_hours'] for job in jobs), 2),
+            'max_walltime': max(walltimes, key=_time2secs) if walltimes else None,
+        }
+
+    def _submit_files(self, sbatch_files):
+        concurrency = min(int(self._settings.get('submit_concurrency', 1)),
+                          len(sbatch_files))
+
+        if concurrency <= 1:
+            return [self._submitted(i, task, self._submit_retry(task))
+                    for i, task in enumerate(sbatch_files)]
+
+        JOB_LOG.info('Submitting %d sbatch/launcher files, %d at a time',
+                     len(sbatch_files), concurrency)
+        pool = ThreadPool(concurrency)
+        try:
+            # All the files are submitted, even if some fail: the jobs
+            # created by the others are recorded before raising
+            results = pool.map(self._try_submit, sbatch_files)
+        finally:
+            pool.close()
+            pool.join()
+
+        jobids = []
+        errors = []
+        for i, (task, (sresult, error)) in enumerate(zip(sbatch_files, results)):
+            if error is not None:
+                JOB_LOG.error('Submission of sbatch/launcher file %s failed: %s',
+                              task, error)
+                errors.append(error)
+                continue
+            jobids.append(self._submitted(i, task, sresult))
+
+        if errors:
+            raise errors[0]
+        return jobids
+
+    def _try_submit(self, task):
+        try:
+            return self._submit_retry(task), None
+        except (sp.CalledProcessError, RuntimeError, OSError) as error:
+            return None, error
+
+    def _submitted(self, i, task, sresult):
+        """Records the job(s) created by the ``i``-th sbatch file"""
+        JOB_LOG.info('Submitted sbatch/launcher file %s (%d)', task, i)
+        # parse output and get job id
+        jobid = self._parse_jobid(
+            sresult, tasks=self._sbatch_tasks.get(task, [i]),
+            array_ids=self._array_sbatch.get(task))
+        JOB_LOG.info('Submitted task %d, job ID %s was assigned', i, jobid)
+        return jobid
+
+    def _collect_finished(self, all_finished):
+        """
+        Returns the jobs that left the queue since the last call
+        """
+        active = [jobid for jobid in self.job_ids if jobid not in self._finished]
+        if not all_finished:
+            if self._pending is None:
+                return []
+            active = [jobid for jobid in active if jobid not in self._pending]
+        self._finished.update(active)
+        now = timer()
+        for jobid in active:
+            self._job_times[jobid][1] = now
+        return active
+
+    def add_listener(self, callback):
         """
-        Submits a list of sbatch files and returns the assigned job ids
+        Registers a callback that will receive the list of participants
+        of the tasks that completed successfully, as they complete
         """
-        sbatch_files = self._generate_sbatch()
-        for i, task in enumerate(sbatch_files):
-            JOB_LOG.info('Submitting sbatch/launcher file %s (%d)', task, i)
-            # run sbatch
-            sresult = self._submit_sbatch(task)
-            # parse output and get job id
-            jobid = self._parse_jobid(sresult)
-            JOB_LOG.info(
-                'Submitted task %d, job ID %s was assigned', i, jobid)
+        self._listeners.append(callback)
+
+    def _jobs_finished(self, job_ids):
+        """
+        Called by the watcher after every poll with the jobs that just left
+        the queue. Resubmits the tasks that failed and can be retried while
+        the rest of the jobs keep running, notifies the participants that
+        completed to the listeners, and returns the new job ids.
+        """
+        if job_ids and (self._retry is not None or self._listeners):
+            self._get_job_acct(job_ids)
+
+        resubmitted = []
+        if job_ids and self._retry is not None:
+            resubmitted = self._retry_failed(job_ids)
+
+        self._notify_listeners(job_ids)
+        return resubmitted
+
+    def _completed_participants(self, job_ids):
+        task_states = self.task_states()
+        completed = []
+        for jobid in job_ids:
+            # Resubmitted jobs are not tracked anymore
+            for task_index in self._job_tasks.get(jobid, []):
+                if task_states.get(task_index) == 'COMPLETED':
+                    completed += self.task_participants[task_index]
+        return completed
+
+    def _notify_listeners(self, job_ids):
+        if self._listeners:
+            completed = self._completed_participants(job_ids)
+            for listener in self._listeners:
+                listener(completed)
+
+    def _retry_failed(self, job_ids):
+        task_indices = self._select_retries(job_ids)
+        if not task_indices:
+            return []
+        return self._resubmit(task_indices)
+
+    def _select_retries(self, job_ids):
+        """
+        Returns the failed tasks of ``job_ids`` that the retry policy allows
+        to run again, and stops tracking the jobs that ran them
+        """
+        task_states = self.task_states()
+        resubmit = OrderedDict()
+        for jobid in job_ids:
+            state = self._jobs[jobid]
+            if state == 'COMPLETED':
+                continue
+            # Tasks of launcher jobs that completed before the failure are not rerun
+            failed = [task_index for task_index in self._job_tasks[jobid]
+                      if task_states.get(task_index) != 'COMPLETED']
+            if failed and all(self._retry.retry(task_index, state) is not None
+                              for task_index in failed):
+                resubmit[jobid] = failed
+
+        task_indices = []
+        for jobid, tasks in list(resubmit.items()):
+            self._retries.append((jobid, self._jobs.pop(jobid)))
+            self._job_tasks.pop(jobid)
+            task_indices += tasks
+        return task_indices
+
+    def _resubmit(self, task_indices):
+        """Submits again the given tasks with the settings of the retry policy"""
+        jobids = self._submit_files(self._resubmit_sbatch(task_indices))
+        self._resubmitted(task_indices, jobids)
+        return jobids
+
+    def _resubmit_sbatch(self, task_indices):
+        if self.sentinel_dir is not None:
+            for task_index in task_indices:
+                sentinel = op.join(self.sentinel_dir, SENTINEL_PATTERN % task_index)
+                if op.isfile(sentinel):
+                    os.remove(sentinel)
+
+        return self._generate_sbatch(
+            task_indices=task_indices, overrides=self._retry.overrides)
+
+    def _resubmitted(self, task_indices, jobids):
+        # Resubmitted jobs may reuse ids of jobs that already finished
+        self._finished.difference_update(jobids)
+        JOB_LOG.info('Resubmitted tasks %s as jobs %s', ', '.join(
+            '%d' % i for i in task_indices), ', '.join(jobids))
+
+    def task_states(self):
+        """
+        Returns the state of each submitted task, read from its sentinel
+        file when available or from the state of the job that ran it
+        otherwise
+        """
+        states = {}
+        for jobid, tasks in list(self._job_tasks.items()):
+            for task_index in tasks:
+                states[task_index] = self._jobs[jobid]
+
+        if self.sentinel_dir is not None:
+            for task_index in states:
+                sentinel = op.join(self.sentinel_dir, SENTINEL_PATTERN % task_index)
+                if op.isfile(sentinel):
+                    with open(sentinel) as sfh:
+                        exit_code = sfh.read().strip()
+                    states[task_index] = 'COMPLETED' if exit_code == '0' else 'FAILED'
+        return states
+
+    def _get_watcher(self):
+        return WATCHERS[self._settings.get('watcher', 'scheduler')](self)
 
     def wait_participant(self):
         """
-        Busy wait until all jobs in the list are done
+        Wait until all jobs in the list are done
         """
-        JOB_LOG.info('Starting busy wait on jobs %s',
+        JOB_LOG.info('Starting wait on jobs %s',
                      ' '.join(self.job_ids))
-        all_finished = False
-
-        while not all_finished:
-            all_finished = self._get_jobs_status()
-            sleep(SLEEP_SECONDS)
+        self._get_watcher().wait()
 
         JOB_LOG.info('Finished wait on jobs %s', ', '.join(self.job_ids))
 
         # Run sacct to check the exit code of jobs
-        overall_exit = sum(self._get_job_acct())
+        return self._check_exit_codes(self._get_job_acct())
 
+    def _check_exit_codes(self, exit_codes):
+        overall_exit = sum(exit_codes)
         JOB_LOG.info('Final status of jobs: %s', ', '.join([
             '%s (%s)' % (k, v) for k, v in list(self._jobs.items())]))
 
-        if overall_exit > 0:
+        # Any terminal state other than COMPLETED is a failure, whatever the exit code
+        codes = [self._jobs.code(jobid) for jobid in self._jobs]
+        failed = [code for code in codes if code in TERMINAL and code != COMPLETED]
+        if overall_exit > 0 or failed:
             failed_jobs = ['{0} (logfiles: log/bidsapp-{0}.{{err,out}}).'.format(k) for k, v in list(
                 self._jobs.items()) if v != 'COMPLETED']
             JOB_LOG.critical('One or more tasks finished with non-zero code:\n'
@@ -229,23 +706,159 @@ class TaskSubmissionBase(object):
             raise RuntimeError('One or more tasks finished with non-zero code')
         return self.job_ids
 
-    def run_grouplevel(self):
+    def close(self):
+        """Releases the connection to the scheduler"""
+        if self._transport is not None:
+            self._transport.close()
+
+    def group_cmdline(self, participants=None, extra_args=None):
         """
-        Run the reduce operation over the participant map
+        The group level command line, restricted to some participants
         """
-        if not self.group_cmd:
-            JOB_LOG.warning('Group level command not set, skipping reduce operation.')
-            return True
+        if participants is None:
+            return ' '.join(self.group_cmd)
 
-        JOB_LOG.info('Kicking off reduce operation')
-        group_wrapper = 'group-wrapper.sh'
+        cmd = [self._settings['executable'], self._settings['bids_dir'],
+               AGAVE_JOB_OUTPUT, 'group', '--participant_label'] + participants
+        if self._settings.get('group_args'):
+            cmd += [self._settings.get('group_args')]
+        if extra_args:
+            cmd += [extra_args]
+        return ' '.join(cmd)
+
+    def _write_group_wrapper(self, cmdline, group_wrapper='group-wrapper.sh'):
         conf = Template(self.GROUP_TEMPLATE)
         conf.generate_conf({
             'modules': self._settings.get('modules', []),
-            'cmdline': ' '.join(self.group_cmd)
+            'cmdline': cmdline
         }, group_wrapper)
+        return group_wrapper
+
+    def stream_grouplevel(self, batch_size, args=None):
+        """
+        Runs partial group updates every ``batch_size`` completed participants
+        while the participant level is still running
+        """
+        self._incremental = IncrementalGroup(
+            self, batch_size, args=args,
+            retries=self._settings.get('group_incremental_retries', GROUP_UPDATE_RETRIES))
+        self.add_listener(self._incremental)
+        return self._incremental
 
-        if _run_cmd(['/bin/bash', group_wrapper]):
+    def _final_group_cmdline(self):
+        """
+        The command line of the final group step, or ``None`` if there
+        is nothing left to reduce
+        """
+        if not self.group_cmd:
+            JOB_LOG.warning('Group level command not set, skipping reduce operation.')
+            return None
+
+        if self._incremental is None:
+            return ' '.join(self.group_cmd)
+
+        remaining = self._incremental.finish()
+        if not remaining:
+            JOB_LOG.info('All participants were aggregated by partial group updates.')
+            return None
+        return self.group_cmdline(remaining, self._incremental.args)
+
+    @property
+    def group_job(self):
+        """The job id of the group level, when submitted to the scheduler"""
+        return self._group_job
+
+    def submit_grouplevel(self, after_participants=False):
+        """
+        Submits the reduce operation as a batch job with its own resources
+        (``group_runtime``, ``group_cpus``, ``group_mem_per_cpu``). With
+        ``after_participants``, the job starts only after all the participant
+        jobs completed successfully (and is cancelled if any of them fails).
+        """
+        cmdline = self._final_group_cmdline()
+        if cmdline is None:
+            return None
+
+        group_sbatch = self._generate_group_sbatch(cmdline, after_participants)
+        JOB_LOG.info('Submitting reduce operation')
+        self._group_job = self._submit_group_sbatch(group_sbatch)
+        JOB_LOG.info('Group level submitted as job %s%s', self._group_job,
+                     ' (after the participant jobs)'
+                     if after_participants and self.job_ids else '')
+        return self._group_job
+
+    def _submit_group_sbatch(self, group_sbatch):
+        """Submits a group level sbatch file, returns its job id"""
+        slurm_msg = self._submit_retry(group_sbatch)
+        m = self.jobexp.search(slurm_msg or '')
+        if m is None or not m.group('jobid'):
+            raise RuntimeError('Job ID could not extracted. Slurm message:\n{}'.format(
+                slurm_msg))
+        return m.group('jobid')
+
+    def _generate_group_sbatch(self, cmdline, after_participants=False,
+                               group_sbatch='group.sbatch'):
+        settings = self._settings.copy()
+        settings['cmdline'] = cmdline
+        settings['group_runtime'] = settings.get('group_runtime', settings['max_runtime'])
+        settings.setdefault('group_cpus', settings.get('mincpus'))
+        settings.setdefault('group_mem_per_cpu', settings.get('mem_per_cpu'))
+        if after_participants and self.job_ids:
+            settings['dependency'] = 'afterok:' + ':'.join(self.query_ids)
+
+        group_sbatch = op.join(self.aux_dir, group_sbatch)
+        conf = self._template(self.GROUP_SBATCH_TEMPLATE)
+        conf.generate_conf(settings, group_sbatch)
+        return group_sbatch
+
+    def _group_job_queued(self, jobid=None):
+        squeue = self._run_scheduler(
+            ['squeue', '-j', jobid or self._group_job, '-o', '%t', '-h'])
+        return bool(squeue) and 'Invalid job id specified' not in squeue
+
+    def _final_state(self, jobid):
+        """The state and exit code of a job that left the queue"""
+        for sjobid, code, exit_code in _parse_sacct(self._run_sacct([jobid]) or ''):
+            if sjobid == jobid:
+                return STATE_NAMES[code], exit_code
+        return None, None
+
+    def wait_grouplevel(self):
+        """
+        Polls the group level job until it leaves the queue
+        """
+        if self._group_job is None:
+            return True
+
+        intervals = JobWatcher(self).intervals()
+        while self._group_job_queued():
+            sleep(next(intervals))
+
+        status, exit_code = self._final_state(self._group_job)
+        if status is None:
+            raise RuntimeError('Could not find the final state of group level job '
+                               '{}'.format(self._group_job))
+        if exit_code == 0 and status == 'COMPLETED':
             JOB_LOG.info('Group level finished successfully.')
             return True
-        return False
+        raise RuntimeError('Group level job {} finished with state {} '
+                           '(exit code {})'.format(self._group_job, status, exit_code))
+
+    def run_grouplevel(self):
+        """
+        Run the reduce operation over the participant map
+        """
+        cmdline = self._final_group_cmdline()
+        if cmdline is None:
+            return True
+
+        JOB_LOG.info('Kicking off reduce operation')
+        group_wrapper = self._write_group_wrapper(cmdline)
+
+        group_log = op.join(self.aux_dir, 'group-wrapper.log')
+        JOB_LOG.info('Output of the group level is written to %s', group_log)
+        _run_cmd(['/bin/bash', group_wrapper], log_file=group_log,
+                 timeout=self._settings.get('group_timeout'),
+                 max_output=self._settings.get('group_output_bytes', GROUP_OUTPUT_BYTES))
+        JOB_LOG.info('Group level finished successfully.')
+        return True
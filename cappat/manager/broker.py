@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Status broker: one ``squeue -u $USER`` per interval, shared by all the
+workflows of the user through a cache file
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+from os import path as op
+import json
+import getpass
+import logging
+from io import open
+from tempfile import gettempdir
+from time import time
+from builtins import object
+
+try:
+    import fcntl
+except ImportError:  # not available on windows
+    fcntl = None
+
+from cappat.metrics import METRICS
+from cappat.utils import atomic_write, check_folder
+from .parsers import SQUEUE_FORMAT
+from .watcher import SLEEP_SECONDS
+
+JOB_LOG = logging.getLogger('taskmanager')
+
+
+def default_cache_file(system=None, user=None):
+    """The cache file of a user on an execution system"""
+    if user is None:
+        user = getpass.getuser()
+    return op.join(gettempdir(), 'cappat-%s' % user,
+                   'squeue-%s.json' % (system or 'local'))
+
+
+def _private_folder(folder):
+    """
+    Creates ``folder`` readable by the user only, and refuses it if it
+    belongs to another user or others can write to it (its name in the
+    temporary directory is predictable)
+    """
+    check_folder(folder, mode=0o700)
+    stat = os.stat(folder)
+    if stat.st_uid != os.getuid() or stat.st_mode & 0o022:
+        raise RuntimeError(
+            'The cache folder of the status broker "%s" must belong to the user '
+            'and must not be writable by others' % folder)
+    return folder
+
+
+class StatusBroker(object):
+    """
+    Shares the output of ``squeue -u <user>`` among all the task managers
+    of a user, on one host or across processes. A snapshot is reused while
+    it is younger than ``interval`` seconds. Otherwise the first process to
+    take the lock on the cache file refreshes it, and the others wait and
+    read its result.
+    """
+
+    def __init__(self, cache_file=None, interval=SLEEP_SECONDS, user=None, system=None):
+        if fcntl is None:
+            raise RuntimeError('The status broker requires fcntl')
+        if user is None:
+            user = getpass.getuser()
+        if cache_file is None:
+            cache_file = default_cache_file(system, user)
+            _private_folder(op.dirname(cache_file))
+        self.user = user
+        self.cache_file = cache_file
+        self.interval = float(interval)
+        check_folder(op.dirname(op.abspath(cache_file)))
+
+    def _read(self):
+        try:
+            with open(self.cache_file) as cfh:
+                snapshot = json.load(cfh)
+        except (IOError, OSError, ValueError):
+            return None
+        if snapshot.get('user') != self.user:
+            return None
+        return snapshot
+
+    def _fresh(self, snapshot, newer_than):
+        if snapshot is None:
+            return False
+        return (snapshot['time'] > newer_than and
+                time() - snapshot['time'] < self.interval)
+
+    def _write(self, snapshot):
+        atomic_write(self.cache_file, json.dumps(snapshot))
+
+    def squeue(self, run, newer_than=0.0):
+        """
+        Returns the queue of the user, from a snapshot taken after
+        ``newer_than`` (a timestamp). ``run`` runs the scheduler command
+        when the snapshot must be refreshed.
+        """
+        snapshot = self._read()
+        if self._fresh(snapshot, newer_than):
+            METRICS.incr('status_broker.hits')
+            return snapshot['squeue']
+
+        with open(self.cache_file + '.lock', 'a') as lfh:
+            fcntl.flock(lfh, fcntl.LOCK_EX)
+            try:
+                # Another process may have refreshed it while we waited
+                snapshot = self._read()
+                if self._fresh(snapshot, newer_than):
+                    METRICS.incr('status_broker.hits')
+                    return snapshot['squeue']
+
+                started = time()
+                output = run(['squeue', '-r', '-u', self.user, '-o', SQUEUE_FORMAT, '-h'])
+                METRICS.incr('status_broker.refreshes')
+                # Jobs submitted while squeue ran may be missing from the output
+                self._write({'user': self.user, 'time': started, 'squeue': output})
+                return output
+            finally:
+                fcntl.flock(lfh, fcntl.LOCK_UN)
@@ -10,6 +10,7 @@ import logging
 
 from .slurm import (SherlockSubmission, CircleCISubmission, TestSubmission)
 from .launcher import (LauncherSubmission, Lonestar5Submission)
+from .federated import FederatedSubmission
 from .tools import getsystemname as _getsystemname
 
 JOB_LOG = logging.getLogger('taskmanager')
@@ -28,6 +29,11 @@ class TaskManager(object):
         """
         Get the appropriate TaskManager object
         """
+        if settings.get('federation'):
+            # One manager per backend, sharing the tasks
+            return FederatedSubmission(task_list, settings, work_dir,
+                                       build=TaskManager.build)
+
         hostname = settings.get('execution_system', None)
 
         if hostname is None:
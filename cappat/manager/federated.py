@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Federated submission: the participant tasks of one workflow are shared
+among several clusters (backends), configured in the ``federation``
+setting::
+
+    federation:
+      sherlock:
+        execution_system: sherlock.stanford.edu
+        partition: normal
+        capacity: 200
+      ls5:
+        execution_system: slurm-ls5.tacc.utexas.edu
+        cmd_prefix: ssh ls5.tacc.utexas.edu
+        work_dir: /scratch/01234/user/run-1
+        capacity: 100
+        allocation: 5000
+
+Each backend is the task manager of its execution system, built with the
+settings of the workflow updated with its own. ``capacity`` is the
+number of jobs a backend runs at once (1 by default), ``allocation`` the
+core-hours left in its allocation (unlimited by default) and
+``work_dir`` its working directory (``<work_dir>/<backend>`` by default).
+Jobs are identified as ``<backend>:<jobid>``.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import os.path as op
+import logging
+import subprocess as sp
+from collections import OrderedDict, Counter
+from multiprocessing.pool import ThreadPool
+from builtins import object
+
+from .tools import _time2secs
+
+JOB_LOG = logging.getLogger('taskmanager')
+
+
+class FederatedSubmission(object):
+    """
+    Shards the tasks among several backends (task managers built with
+    ``build``), tracks their jobs as one workflow and runs the group
+    level on the backend holding the outputs
+    """
+
+    def __init__(self, task_list, settings=None, work_dir=None, build=None):
+        if not task_list:
+            raise RuntimeError('a list of tasks is required')
+
+        settings = dict(settings or {})
+        federation = settings.pop('federation', None)
+        if not federation:
+            raise RuntimeError('at least one backend is required in "federation"')
+
+        if work_dir is None:
+            work_dir = os.getcwd()
+
+        self.task_list = task_list
+        self.work_dir = op.abspath(work_dir)
+        self._settings = settings
+        self._backends = OrderedDict()
+        self._capacity = {}
+        self._allocation = {}
+        self._shards = OrderedDict()
+        self._group_backend = None
+        for name, backend_settings in list(federation.items()):
+            backend_settings = dict(backend_settings or {})
+            self._capacity[name] = float(backend_settings.pop('capacity', 1))
+            allocation = backend_settings.pop('allocation', None)
+            self._allocation[name] = None if allocation is None else float(allocation)
+
+            merged = settings.copy()
+            merged.update(backend_settings)
+            self._backends[name] = build(
+                task_list, merged,
+                work_dir=merged.pop('work_dir', op.join(self.work_dir, name)))
+
+        self.task_participants = list(self._backends.values())[0].task_participants
+        JOB_LOG.info('Created federation of backends: %s', ', '.join(
+            '%s (%s)' % (name, backend.__class__.__name__)
+            for name, backend in list(self._backends.items())))
+
+    @property
+    def backends(self):
+        return self._backends
+
+    @property
+    def shards(self):
+        """The indices of the tasks submitted to each backend"""
+        return self._shards
+
+    def _combined(self, attr):
+        combined = OrderedDict()
+        for name, backend in list(self._backends.items()):
+            for jobid, value in list(getattr(backend, attr).items()):
+                combined['%s:%s' % (name, jobid)] = value
+        return combined
+
+    @property
+    def jobs(self):
+        """The state of the jobs of all the backends"""
+        return self._combined('jobs')
+
+    @property
+    def job_ids(self):
+        return list(self.jobs.keys())
+
+    @property
+    def job_tasks(self):
+        return self._combined('job_tasks')
+
+    @property
+    def job_times(self):
+        return self._combined('job_times')
+
+    @property
+    def retries(self):
+        return [('%s:%s' % (name, jobid), state)
+                for name, backend in list(self._backends.items())
+                for jobid, state in backend.retries]
+
+    def status(self):
+        """The number of jobs in each state, per backend"""
+        return OrderedDict((name, Counter(list(backend.jobs.values())))
+                           for name, backend in list(self._backends.items()))
+
+    def task_states(self):
+        states = {}
+        for backend in list(self._backends.values()):
+            states.update(backend.task_states())
+        return states
+
+    def queue_depths(self):
+        """
+        The jobs pending in the partition of each backend (``None`` for
+        the backends that could not be reached)
+        """
+        depths = OrderedDict()
+        for name, backend in list(self._backends.items()):
+            try:
+                depths[name] = backend.queue_depth()
+            except (sp.CalledProcessError, RuntimeError, OSError) as error:
+                JOB_LOG.warning('Backend %s could not be reached, skipping it: %s',
+                                name, error)
+                depths[name] = None
+        return depths
+
+    def shard(self, task_indices=None, depths=None):
+        """
+        Assigns each task to the backend where it would start first: the
+        one with the fewest jobs ahead (pending in its queue or assigned
+        before) per unit of capacity, among those with allocation left to
+        run it. The queues are probed unless ``depths`` are given.
+        """
+        if task_indices is None:
+            task_indices = list(range(len(self.task_list)))
+        if depths is None:
+            depths = self.queue_depths()
+
+        available = [name for name in self._backends if depths.get(name) is not None]
+        if not available:
+            raise RuntimeError('None of the backends of the federation could be reached')
+
+        ahead = dict((name, float(depths[name])) for name in available)
+        allocation = dict(self._allocation)
+        shards = OrderedDict((name, []) for name in self._backends)
+        for task_index in task_indices:
+            best = None
+            for name in available:
+                cost = self._backends[name].task_core_hours(task_index)
+                if allocation[name] is not None and allocation[name] < cost:
+                    continue
+                wait = (ahead[name] + 1) / self._capacity[name]
+                if best is None or wait < best[0]:
+                    best = (wait, name, cost)
+
+            if best is None:
+                raise RuntimeError('Not enough allocation left in the backends to run '
+                                   'task {}'.format(task_index))
+            _, name, cost = best
+            shards[name].append(task_index)
+            ahead[name] += 1
+            if allocation[name] is not None:
+                allocation[name] -= cost
+
+        JOB_LOG.info('Tasks per backend: %s', ', '.join(
+            '%s: %d (%s pending)' % (name, len(tasks), depths.get(name))
+            for name, tasks in list(shards.items())))
+        return shards
+
+    def map_participant(self):
+        """
+        Shards the tasks according to the current state of the queues and
+        submits them, returns the assigned job ids
+        """
+        self._shards = self.shard()
+        jobids = []
+        for name, tasks in list(self._shards.items()):
+            if not tasks:
+                continue
+            submitted = self._backends[name].map_participant(task_indices=tasks)
+            jobids += ['%s:%s' % (name, jobid) for jobid in submitted]
+        return jobids
+
+    def _wait_backend(self, name):
+        try:
+            return self._backends[name].wait_participant(), None
+        except RuntimeError as error:
+            return None, error
+
+    def wait_participant(self):
+        """
+        Waits on the jobs of all the backends at once, and raises if
+        any of them failed
+        """
+        active = [name for name, backend in list(self._backends.items()) if backend.job_ids]
+        if not active:
+            return []
+
+        pool = ThreadPool(len(active))
+        try:
+            results = pool.map(self._wait_backend, active)
+        finally:
+            pool.close()
+            pool.join()
+
+        JOB_LOG.info('Final status of the federation: %s', '; '.join(
+            '%s: %s' % (name, ', '.join('%d %s' % (count, state)
+                                        for state, count in sorted(states.items())))
+            for name, states in list(self.status().items()) if states))
+
+        failed = [name for name, (_, error) in zip(active, results) if error is not None]
+        if failed:
+            raise RuntimeError('One or more tasks finished with non-zero code '
+                               '(backends: {})'.format(', '.join(failed)))
+        return self.job_ids
+
+    def get_job_usage(self, job_ids=None):
+        usage = {}
+        for name, backend in list(self._backends.items()):
+            backend_ids = backend.job_ids
+            if job_ids is not None:
+                backend_ids = [jobid.split(':', 1)[1] for jobid in job_ids
+                               if jobid.split(':', 1)[0] == name]
+            if not backend_ids:
+                continue
+            for jobid, job in list(backend.get_job_usage(backend_ids).items()):
+                usage['%s:%s' % (name, jobid)] = job
+        return usage
+
+    def add_listener(self, callback):
+        for backend in list(self._backends.values()):
+            backend.add_listener(callback)
+
+    def stream_grouplevel(self, batch_size, args=None):
+        raise RuntimeError('Partial group updates are not supported by federated runs')
+
+    def group_backend(self):
+        """
+        The backend running the group level: the one set in the
+        ``group_backend`` setting, otherwise the one holding the outputs
+        of most participants
+        """
+        outputs = OrderedDict(
+            (name, len(backend._completed_participants(backend.job_ids)))
+            for name, backend in list(self._backends.items()))
+        name = self._settings.get('group_backend')
+        if name is None:
+            name = max(outputs, key=lambda backend: outputs[backend])
+        elif name not in self._backends:
+            raise RuntimeError('Unknown group backend "{}"'.format(name))
+
+        elsewhere = ['%s (%d)' % (other, count) for other, count in list(outputs.items())
+                     if other != name and count]
+        if elsewhere:
+            JOB_LOG.warning('The group level runs on %s, the outputs of the participants '
+                            'run on %s must be transferred there', name, ', '.join(elsewhere))
+        return name
+
+    @property
+    def group_job(self):
+        if self._group_backend is None:
+            return None
+        group_job = self._backends[self._group_backend].group_job
+        return None if group_job is None else '%s:%s' % (self._group_backend, group_job)
+
+    def submit_grouplevel(self, after_participants=False):
+        """Submits the group level to the backend with the outputs"""
+        self._group_backend = self.group_backend()
+        self._backends[self._group_backend].submit_grouplevel(
+            after_participants=after_participants)
+        return self.group_job
+
+    def wait_grouplevel(self):
+        if self._group_backend is None:
+            return True
+        return self._backends[self._group_backend].wait_grouplevel()
+
+    def run_grouplevel(self):
+        """
+        Runs the group level as a job of the backend with the outputs
+        (they are not expected to be on this host)
+        """
+        if self.group_job is None:
+            self.submit_grouplevel()
+        return self.wait_grouplevel()
+
+    def plan(self, group=False):
+        """
+        The plans of the backends (see ``TaskSubmissionBase.plan``), with
+        the tasks sharded as if their queues were empty. The group level
+        is planned on the ``group_backend``, or on the backend running
+        most tasks.
+        """
+        shards = self.shard(depths=dict((name, 0) for name in self._backends))
+        group_name = self._settings.get('group_backend') or max(
+            shards, key=lambda name: len(shards[name]))
+        jobs = []
+        for name, tasks in list(shards.items()):
+            if not tasks and name != group_name:
+                continue
+            backend_plan = self._backends[name].plan(
+                group=group and name == group_name, task_indices=tasks)
+            for job in backend_plan['jobs']:
+                job['backend'] = name
+            jobs += backend_plan['jobs']
+
+        walltimes = [job['walltime'] for job in jobs if job['walltime']]
+        return {
+            'manager': self.__class__.__name__,
+            'tasks': len(self.task_list),
+            'shards': OrderedDict((name, len(tasks)) for name, tasks in list(shards.items())),
+            'jobs': jobs,
+            'submissions': len(jobs),
+            'scheduler_jobs': sum(job['jobs'] for job in jobs),
+            'core_hours': round(sum(job['core_hours'] for job in jobs), 2),
+            'max_walltime': max(walltimes, key=_time2secs) if walltimes else None,
+        }
+
+    def close(self):
+        for backend in list(self._backends.values()):
+            backend.close()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Incremental group level: partial reduce operations while participants
+are still running
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import logging
+import subprocess as sp
+from time import sleep
+from builtins import object
+
+from .watcher import JobWatcher
+
+JOB_LOG = logging.getLogger('taskmanager')
+# Times a batch of participants is submitted again after a failed update
+GROUP_UPDATE_RETRIES = 1
+
+
+class IncrementalGroup(object):
+    """
+    Listens to participant completions and submits a partial group update
+    as a batch job (with the resources of the group level) every time
+    ``batch_size`` new participants are available, without blocking the
+    polling of the participant jobs. Only one update runs at a time, and
+    the participants of an update that failed more than ``retries`` times
+    are left to the final group step. Apps must accept partial updates as::
+
+        <app> <bids_dir> out/ group --participant_label <new participants> <args>
+
+    so that the final group step only merges the last few participants.
+    """
+
+    def __init__(self, manager, batch_size, args=None, retries=GROUP_UPDATE_RETRIES):
+        self._manager = manager
+        self.batch_size = max(1, int(batch_size))
+        self.args = args
+        self.retries = int(retries)
+        self.pending = []
+        self.aggregated = []
+        self.failed = []
+        self.jobs = []
+        self.nupdates = 0
+        self._attempts = {}
+        self._running = None
+
+    def __call__(self, participants):
+        self.pending += [part for part in participants if part not in self.pending]
+        self.poll()
+
+    def _check_running(self):
+        """Returns True if an update is still running"""
+        if self._running is None:
+            return False
+
+        jobid, batch = self._running
+        if jobid is not None and self._manager._group_job_queued(jobid):
+            return True
+
+        self._running = None
+        status, exit_code = None, None
+        if jobid is not None:
+            status, exit_code = self._manager._final_state(jobid)
+        if status == 'COMPLETED' and exit_code == 0:
+            self.aggregated += batch
+            JOB_LOG.info('Partial group update %s finished, %d participants aggregated',
+                         jobid, len(self.aggregated))
+            return False
+
+        JOB_LOG.warning('Partial group update %s failed (state %s, exit code %s) for '
+                        'participants %s', jobid, status, exit_code, ' '.join(batch))
+        for part in batch:
+            self._attempts[part] = self._attempts.get(part, 0) + 1
+        retry = [part for part in batch if self._attempts[part] <= self.retries]
+        # Give them another chance in the next update, or leave them to the final step
+        self.pending = retry + self.pending
+        self.failed += [part for part in batch if part not in retry]
+        return False
+
+    def poll(self):
+        """Starts a new update if enough participants are waiting"""
+        if self._check_running() or len(self.pending) < self.batch_size:
+            return
+
+        batch, self.pending = self.pending, []
+        self._start(batch)
+
+    def _start(self, batch):
+        self.nupdates += 1
+        group_sbatch = self._manager._generate_group_sbatch(
+            self._manager.group_cmdline(batch, self.args),
+            group_sbatch='group-%03d.sbatch' % self.nupdates)
+        JOB_LOG.info('Submitting partial group update %d with participants %s',
+                     self.nupdates, ' '.join(batch))
+        try:
+            jobid = self._manager._submit_group_sbatch(group_sbatch)
+        except (sp.CalledProcessError, RuntimeError) as error:
+            JOB_LOG.warning('Partial group update %d could not be submitted: %s',
+                            self.nupdates, error)
+            jobid = None
+        else:
+            self.jobs.append(jobid)
+        self._running = (jobid, batch)
+
+    def finish(self):
+        """
+        Waits for the running update and returns the participants that
+        still need to be merged by the final group step
+        """
+        intervals = JobWatcher(self._manager).intervals()
+        while self._check_running():
+            sleep(next(intervals))
+        remaining, self.pending = self.failed + self.pending, []
+        self.failed = []
+        JOB_LOG.info('Incremental group level: %d partial updates aggregated %d '
+                     'participants, %d left for the final step', self.nupdates,
+                     len(self.aggregated), len(remaining))
+        return remaining
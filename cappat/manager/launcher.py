@@ -9,9 +9,9 @@ import os
 import os.path as op
 import logging
 from pkg_resources import resource_filename as pkgrf
-from io import open
-from ..tpl import Template
 from .base import TaskSubmissionBase
+from .watcher import SENTINEL_PATTERN
+from .tools import pack_tasks as _pack_tasks, _time2secs
 
 JOB_LOG = logging.getLogger('taskmanager')
 
@@ -24,32 +24,91 @@ class LauncherSubmission(TaskSubmissionBase):
     SLURM_MAXCPUS = 16
     SLURM_TEMPLATE = op.abspath(pkgrf('cappat', 'tpl/sbatch-launcher-3.0.jnj2'))
 
-    def _generate_sbatch(self):
+    def _generate_sbatch(self, task_indices=None, overrides=None):
         """
-        Generates one launcher file
+        Generates one launcher file, or several if the tasks do not fit
+        in one wave of the largest job
         """
+        if task_indices is None:
+            task_indices = list(range(len(self.task_list)))
 
-        tasks_file = op.join(self.aux_dir, 'tasks_list.sh')
-        batch_file = op.join(self.aux_dir, 'launcher.sbatch')
-        with open(tasks_file, 'w') as lfh:
-            lfh.write('\n'.join(self.task_list) + '\n')
+        if overrides is None:
+            overrides = {}
 
+        suffix = ''
+        if overrides:
+            # Resubmissions do not overwrite the original launcher files
+            suffix = '-%d' % len(self._retries)
+
+        plan = self._pack(len(task_indices))
+        # Launcher would run the tasks beyond one wave after the first ones,
+        # exceeding the walltime of the job: they go to other jobs instead
+        wave = plan['nodes'] * plan['tasks_per_node']
+        if plan['waves'] > 1:
+            JOB_LOG.info('Splitting %d tasks into %d launcher jobs of up to %d tasks',
+                         len(task_indices), plan['waves'], wave)
+
+        batch_files = []
+        for offset in range(0, len(task_indices), wave):
+            job_suffix = suffix
+            if plan['waves'] > 1:
+                job_suffix += '-%03d' % (offset // wave)
+            batch_files.append(self._launcher_job(
+                task_indices[offset:offset + wave], overrides, job_suffix))
+        return batch_files
+
+    def _pack(self, ntasks):
+        ncpus = self._settings.get('ncpus', self.SLURM_MAXCPUS)
+        return _pack_tasks(
+            ntasks, ncpus,
+            node_memory=self._settings.get('memory_per_node'),
+            task_cpus=self._settings.get('task_cpus', ncpus),
+            task_memory=self._settings.get('task_memory'),
+            max_nodes=self.SLURM_MAXNODES)
+
+    def _launcher_job(self, task_indices, overrides, suffix):
+        tasks_file = op.join(self.aux_dir, 'tasks_list%s.sh' % suffix)
+        batch_file = op.join(self.aux_dir, 'launcher%s.sbatch' % suffix)
+        task_list = [self.task_list[i] for i in task_indices]
+        if self.sentinel_dir is not None:
+            task_list = ['{0}; echo $? > {1}'.format(
+                task, op.join(self.sentinel_dir, SENTINEL_PATTERN % i))
+                         for i, task in zip(task_indices, task_list)]
+
+        self._write_aux(tasks_file, '\n'.join(task_list) + '\n')
+
+        plan = self._pack(len(task_list))
         settings = {
-            'nodes': min([len(self.task_list), self.SLURM_MAXNODES]),
-            'ntasks': len(self.task_list),
-            'runtime': self._settings['child_runtime'],
+            'nodes': plan['nodes'],
+            'ntasks': len(task_list),
+            'runtime': max([self._settings['child_runtime']] + [
+                overrides[i]['child_runtime'] for i in task_indices
+                if 'child_runtime' in overrides.get(i, {})], key=_time2secs),
             'partition': self._settings.get('partition', 'normal'),
             'jobname': self._settings.get('job_name', 'openneuro'),
             'work_dir': os.getcwd(),
             'tasks_file': tasks_file,
             'ncpus': self._settings.get('ncpus', self.SLURM_MAXCPUS),
-            'tasks_per_node': 1,
+            'tasks_per_node': plan['tasks_per_node'],
+            'cpus_per_task': plan['cpus_per_task'],
         }
 
-        conf = Template(self.SLURM_TEMPLATE)
+        conf = self._template(self.SLURM_TEMPLATE)
         conf.generate_conf(settings, batch_file)
 
-        return [batch_file]
+        # All tasks run within the same job
+        self._sbatch_tasks[batch_file] = task_indices
+        return batch_file
+
+    def _job_cpus(self, request):
+        # Launcher jobs are allocated whole nodes
+        return int(request.get('nodes') or 1) * int(
+            self._settings.get('ncpus', self.SLURM_MAXCPUS))
+
+    def _task_cpus(self):
+        # Tasks share the nodes of the job
+        return int(self._settings.get(
+            'task_cpus', self._settings.get('ncpus', self.SLURM_MAXCPUS)))
 
 
 class Lonestar5Submission(LauncherSubmission):
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Parsers of the output of the scheduler commands, and the table of job states
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import re
+from collections import OrderedDict
+from builtins import range
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:  # python 2
+    from collections import MutableMapping
+
+# (state, squeue short code, terminal)
+JOB_STATES = [
+    ('SUBMITTED', None, False),  # submitted by cappat, not seen in the queue yet
+    ('PENDING', 'PD', False),
+    ('RUNNING', 'R', False),
+    ('CONFIGURING', 'CF', False),
+    ('COMPLETING', 'CG', False),
+    ('SUSPENDED', 'S', False),
+    ('STOPPED', 'ST', False),
+    ('SIGNALING', 'SI', False),
+    ('STAGE_OUT', 'SO', False),
+    ('RESIZING', 'RS', False),
+    ('REQUEUED', 'RQ', False),
+    ('REQUEUE_HOLD', 'RH', False),
+    ('REQUEUE_FED', 'RF', False),
+    ('RESV_DEL_HOLD', 'RD', False),
+    ('COMPLETED', 'CD', True),
+    ('CANCELLED', 'CA', True),
+    ('FAILED', 'F', True),
+    ('TIMEOUT', 'TO', True),
+    ('NODE_FAIL', 'NF', True),
+    ('BOOT_FAIL', 'BF', True),
+    ('OUT_OF_MEMORY', 'OOM', True),
+    ('PREEMPTED', 'PR', True),
+    ('DEADLINE', 'DL', True),
+    ('REVOKED', 'RV', True),
+    ('SPECIAL_EXIT', 'SE', True),
+    ('UNKNOWN', None, False),
+]
+STATE_NAMES = tuple(state[0] for state in JOB_STATES)
+STATE_CODES = dict((state[0], code) for code, state in enumerate(JOB_STATES))
+SHORT_CODES = dict((state[1], code) for code, state in enumerate(JOB_STATES) if state[1])
+TERMINAL = frozenset(code for code, state in enumerate(JOB_STATES) if state[2])
+COMPLETED = STATE_CODES['COMPLETED']
+CANCELLED = STATE_CODES['CANCELLED']
+UNKNOWN = STATE_CODES['UNKNOWN']
+_DELETED = 255
+# Real signal numbers end at SIGRTMAX, sacct reports other markers in the
+# same field (e.g. 125 for jobs killed for exceeding their memory)
+MAX_SIGNAL = 64
+# Raw state strings seen (e.g. "CANCELLED by 1234") -> code
+_STATE_CACHE = {}
+
+# squeue -h -o %i|%t (also accepts the former %i,%t)
+SQUEUE_FORMAT = '%i|%t'
+SQUEUE_RE = re.compile(
+    r'^\s*(?P<jobid>\d+(?:_(?:\d+|\[[^\]]+\]))?)[|,](?P<state>[A-Z]+)\s*$')
+# sacct -n -X -P -o JobID,State,ExitCode (also accepts the default, space separated)
+SACCT_RE = re.compile(
+    r'^\s*(?P<jobid>\d+(?:_\d+)?(?:\.[\w+-]+)?)[|\s]+'
+    r'(?P<state>[A-Z_]+)[^|\n]*?[|\s]+(?P<exit_code>\d+):(?P<signal>\d+)\s*$')
+# #SBATCH -N 1, #SBATCH --mincpus=4 (comments after the value are ignored)
+SBATCH_RE = re.compile(
+    r'^#SBATCH[ \t]+(?P<option>-{1,2}[\w-]+)(?:[= \t][ \t]*(?P<value>[^\s#]+))?', re.M)
+# sbatch ignores the directives after the first command
+SBATCH_END_RE = re.compile(r'^[^#\s]', re.M)
+# Parsed headers of batch scripts
+_SBATCH_CACHE = {}
+SBATCH_CACHE_SIZE = 1024
+SBATCH_OPTIONS = {
+    '-N': 'nodes', '--nodes': 'nodes',
+    '-t': 'time', '--time': 'time',
+    '-p': 'partition', '--partition': 'partition',
+    '-n': 'ntasks', '--ntasks': 'ntasks',
+    '-c': 'cpus_per_task', '--cpus-per-task': 'cpus_per_task',
+    '--tasks-per-node': 'tasks_per_node', '--ntasks-per-node': 'tasks_per_node',
+    '--mincpus': 'mincpus',
+    '--mem-per-cpu': 'mem_per_cpu',
+    '--array': 'array',
+    '--dependency': 'dependency',
+}
+
+
+def state_code(state):
+    """
+    The code of a state, given its name (e.g. ``CANCELLED by 1234`` or
+    ``OUT_OF_MEMORY+``) or its squeue short code
+
+    >>> STATE_NAMES[state_code('CANCELLED by 1234')]
+    'CANCELLED'
+
+    """
+    code = _STATE_CACHE.get(state)
+    if code is None:
+        name = state.split(' ')[0].rstrip('+')
+        code = STATE_CODES.get(name)
+        if code is None:
+            code = SHORT_CODES.get(name, UNKNOWN)
+        _STATE_CACHE[state] = code
+    return code
+
+
+def split_jobid(jobid):
+    """
+    Splits a sacct job id into the job (or array element) and the step
+
+    >>> split_jobid('1234_5.batch')
+    ('1234_5', 'batch')
+
+    """
+    jobid, _, step = jobid.partition('.')
+    return jobid, step or None
+
+
+def expand_array_range(jobid, indices):
+    """
+    Expands the pending elements of an array, as shown by squeue
+
+    >>> expand_array_range('1234', '0-2,7%2')
+    ['1234_0', '1234_1', '1234_2', '1234_7']
+
+    """
+    jobids = []
+    for item in indices.split('%')[0].split(','):
+        first, _, last = item.partition('-')
+        jobids += ['%s_%d' % (jobid, taskid)
+                   for taskid in range(int(first), int(last or first) + 1)]
+    return jobids
+
+
+def _squeue_line(jobid, state):
+    code = SHORT_CODES.get(state, UNKNOWN)
+    if jobid.endswith(']'):
+        jobid, _, indices = jobid[:-1].partition('_[')
+        return [(element, code) for element in expand_array_range(jobid, indices)]
+    return [(jobid, code)]
+
+
+def parse_squeue(output):
+    """Generates the (jobid, state code) pairs listed by squeue"""
+    for line in output.splitlines():
+        fields = line.strip().split('|')
+        if len(fields) == 2 and fields[0][-1:].isdigit():
+            # Fast path for the parsable format
+            yield fields[0], SHORT_CODES.get(fields[1], UNKNOWN)
+            continue
+
+        match = SQUEUE_RE.match(line)
+        if match is not None:
+            for item in _squeue_line(match.group('jobid'), match.group('state')):
+                yield item
+
+
+def _exit_code(code, exit_code, signal):
+    if code == CANCELLED:
+        return 128
+    if code == COMPLETED:
+        return exit_code
+    if exit_code == 0 and 0 < signal <= MAX_SIGNAL:
+        return 128 + signal
+    if exit_code == 0 and code in TERMINAL:
+        # Jobs killed by the scheduler (TIMEOUT, NODE_FAIL...) may report 0:0
+        return 1
+    return exit_code
+
+
+def parse_sacct(output, steps=False):
+    """
+    Generates (jobid, state code, exit code) tuples from the output of
+    sacct. Failed jobs killed by a signal get 128 + the signal number
+    and cancelled jobs get 128, completed jobs keep their exit code. Job
+    steps are skipped unless ``steps`` is set.
+    """
+    for line in output.splitlines():
+        fields = line.strip().split('|')
+        if len(fields) == 3 and ':' in fields[2]:
+            # Fast path for the parsable format
+            jobid, state, exit_code = fields
+            exit_code, _, signal = exit_code.partition(':')
+        else:
+            match = SACCT_RE.match(line)
+            if match is None:
+                continue
+            jobid, state, exit_code, signal = match.group(
+                'jobid', 'state', 'exit_code', 'signal')
+
+        if not steps and '.' in jobid:
+            continue
+        code = state_code(state)
+        yield jobid, code, _exit_code(code, int(exit_code), int(signal))
+
+
+def parse_sbatch(script):
+    """
+    Reads the resources requested by the ``#SBATCH`` directives of a batch
+    script (nodes, time, partition, cpus...). Job arrays also get the
+    number of their elements (``array_size``).
+
+    >>> sorted(parse_sbatch('#!/bin/bash\\n#SBATCH -N 2\\n#SBATCH -t 01:00:00   # Run time'
+    ...                     '\\n#SBATCH --array=0-9%4\\nsrun app').items())
+    [('array', '0-9%4'), ('array_size', 10), ('nodes', 2), ('time', '01:00:00')]
+    """
+    # Only the lines up to the last directive matter, and they are the
+    # same in all the scripts rendered with the same settings
+    last = script.rfind('#SBATCH')
+    end = script.find('\n', last) if last >= 0 else 0
+    header = script[:end if end >= 0 else len(script)]
+    request = _SBATCH_CACHE.get(header)
+    if request is None:
+        if len(_SBATCH_CACHE) > SBATCH_CACHE_SIZE:
+            _SBATCH_CACHE.clear()
+        request = _SBATCH_CACHE[header] = _parse_directives(header)
+    return dict(request)
+
+
+def _parse_directives(header):
+    end = SBATCH_END_RE.search(header)
+    request = {}
+    for match in SBATCH_RE.finditer(header, 0, end.start() if end else len(header)):
+        key = SBATCH_OPTIONS.get(match.group('option'))
+        if key is not None:
+            value = match.group('value')
+            request[key] = int(value) if value and value.isdigit() else value
+
+    if request.get('array'):
+        size = 0
+        for item in request['array'].split('%')[0].split(','):
+            item, _, step = item.partition(':')
+            first, _, last = item.partition('-')
+            size += (int(last) - int(first)) // int(step or 1) + 1 if last else 1
+        request['array_size'] = size
+    return request
+
+
+class StateTable(MutableMapping):
+    """
+    The state of each job, kept in submission order as one byte per job.
+    Reads and writes use state names, like a dictionary of strings.
+    """
+
+    def __init__(self):
+        self._slots = OrderedDict()
+        self._codes = bytearray()
+
+    def __getitem__(self, jobid):
+        return STATE_NAMES[self._codes[self._slots[jobid]]]
+
+    def __setitem__(self, jobid, state):
+        self.set_code(jobid, state_code(state))
+
+    def __delitem__(self, jobid):
+        slot = self._slots.pop(jobid)
+        self._codes[slot] = _DELETED
+
+    def __iter__(self):
+        return iter(self._slots)
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __contains__(self, jobid):
+        return jobid in self._slots
+
+    def code(self, jobid):
+        return self._codes[self._slots[jobid]]
+
+    def set_code(self, jobid, code):
+        slot = self._slots.get(jobid)
+        if slot is None:
+            self._slots[jobid] = len(self._codes)
+            self._codes.append(code)
+        else:
+            self._codes[slot] = code
+
+    def count(self, state):
+        """Number of jobs in a state"""
+        return self._codes.count(bytearray([state_code(state)]))
+
+    def __repr__(self):
+        return 'StateTable(%s)' % ', '.join(
+            '%s=%s' % item for item in list(self.items()))
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Retry policies for participant tasks that failed for reasons unrelated
+to the app (node failures, preemption, timeouts, out of memory)
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import logging
+from builtins import object
+
+from .tools import _time2secs, _secs2time, parse_memory
+
+# Job state -> factors applied to the settings of the resubmitted task
+RETRY_RULES = {
+    'NODE_FAIL': {},
+    'BOOT_FAIL': {},
+    'PREEMPTED': {},
+    'TIMEOUT': {'child_runtime': 2.0},
+    'OUT_OF_MEMORY': {'mem_per_cpu': 2.0},
+}
+RETRY_MAX_ATTEMPTS = 2
+# Maximum fraction of tasks that can be resubmitted in one run
+RETRY_BUDGET = 0.1
+
+JOB_LOG = logging.getLogger('taskmanager')
+
+
+class RetryPolicy(object):
+    """
+    Decides which failed tasks are resubmitted and with which settings.
+    Each task is retried at most ``max_attempts`` times, and at most
+    ``budget`` resubmissions are done overall.
+    """
+
+    def __init__(self, settings, ntasks, rules=None, max_attempts=None, budget=None):
+        self._settings = settings
+        self.rules = dict(RETRY_RULES)
+        if rules:
+            self.rules.update(rules)
+
+        if max_attempts is None:
+            max_attempts = RETRY_MAX_ATTEMPTS
+        self.max_attempts = int(max_attempts)
+
+        if budget is None:
+            budget = max(1, int(RETRY_BUDGET * ntasks))
+        self.budget = int(budget)
+
+        self.attempts = {}
+        self.overrides = {}
+
+    @property
+    def used(self):
+        return sum(self.attempts.values())
+
+    def _task_setting(self, task_index, key):
+        if key == 'child_runtime' and self._settings.get('task_runtimes'):
+            return self._settings['task_runtimes'][task_index]
+        return self._settings.get(key)
+
+    def _scale(self, key, value, factor):
+        if key in ['child_runtime', 'runtime']:
+            max_secs = _time2secs(self._settings['max_runtime'])
+            return _secs2time(min(int(_time2secs(value) * factor), max_secs))
+
+        value = '%s' % value
+        if key.startswith('mem'):
+            # Slurm memory requests are in MB by default
+            value_mb = parse_memory(value + 'M' if value.isdigit() else value) // 1024
+            return '%d' % int(value_mb * factor)
+        return '%d' % int(float(value) * factor)
+
+    def retry(self, task_index, state):
+        """
+        Returns the settings to resubmit a task that finished with ``state``,
+        or ``None`` if it should not be retried
+        """
+        rule = self.rules.get(state)
+        if rule is None:
+            return None
+
+        attempts = self.attempts.get(task_index, 0)
+        if attempts >= self.max_attempts:
+            JOB_LOG.warning('Task %d finished with state %s and will not be retried: '
+                            'reached %d attempts', task_index, state, attempts)
+            return None
+
+        if self.used >= self.budget:
+            JOB_LOG.warning('Task %d finished with state %s and will not be retried: '
+                            'the retry budget (%d) is exhausted', task_index, state,
+                            self.budget)
+            return None
+
+        overrides = dict(self.overrides.get(task_index, {}))
+        for key, factor in list(rule.items()):
+            value = overrides.get(key, self._task_setting(task_index, key))
+            if value is None:
+                JOB_LOG.warning('Task %d finished with state %s and will not be '
+                                'retried: setting "%s" is not set', task_index,
+                                state, key)
+                return None
+            scaled = self._scale(key, value, factor)
+            if scaled == value:
+                JOB_LOG.warning('Task %d finished with state %s and will not be '
+                                'retried: setting "%s" cannot be increased', task_index,
+                                state, key)
+                return None
+            overrides[key] = scaled
+
+        self.attempts[task_index] = attempts + 1
+        self.overrides[task_index] = overrides
+        JOB_LOG.info('Task %d finished with state %s, resubmitting (attempt %d) with '
+                     'settings %s', task_index, state, attempts + 1, overrides)
+        return overrides
@@ -7,12 +7,13 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 import os.path as op
 import logging
+from collections import OrderedDict
 from pprint import pformat as pf
 from pkg_resources import resource_filename as pkgrf
 
-from ..tpl import Template
+from cappat import AGAVE_JOB_LOGS
 from .base import TaskSubmissionBase
-from .tools import run_cmd as _run_cmd
+from .tools import run_cmd as _run_cmd, _time2secs
 
 JOB_LOG = logging.getLogger('taskmanager')
 
@@ -22,28 +23,140 @@ class SherlockSubmission(TaskSubmissionBase):
     The Sherlock submission
     """
     SLURM_TEMPLATE = op.abspath(pkgrf('cappat', 'tpl/sherlock-sbatch.jnj2'))
+    SLURM_ARRAY_TEMPLATE = op.abspath(pkgrf('cappat', 'tpl/sherlock-sbatch-array.jnj2'))
+    SLURM_MAXARRAYSIZE = 1000
 
     def __init__(self, task_list, settings=None, work_dir=None):
         super(SherlockSubmission, self).__init__(
             task_list, settings=settings, work_dir=work_dir)
         self._settings['qos'] = self._settings['partition']
 
-    def _generate_sbatch(self):
+    def _generate_sbatch(self, task_indices=None, overrides=None):
         """
         Generates one sbatch file per task
         """
-        settings = self._settings.copy()
+        if self._settings.get('array_jobs', False):
+            return self._generate_array_sbatch(task_indices, overrides)
+
+        if task_indices is None:
+            task_indices = list(range(len(self.task_list)))
+
+        if overrides is None:
+            overrides = {}
+
         JOB_LOG.info('Generating sbatch files with the following settings: \n\t%s',
-                     pf(settings))
+                     pf(self._settings))
         sbatch_files = []
-        for i, task in enumerate(self.task_list):
-            sbatch_files.append(op.join(self.aux_dir, 'slurm-%06d.sbatch' % i))
-            settings['commandline'] = task
-            conf = Template(self.SLURM_TEMPLATE)
-            conf.generate_conf(settings, sbatch_files[-1])
+        task_settings = []
+        for i in task_indices:
+            settings = self._settings.copy()
+            settings['commandline'] = self.task_list[i]
+            settings['task_index'] = i
+            if self._settings.get('task_runtimes'):
+                settings['child_runtime'] = self._settings['task_runtimes'][i]
+            settings.update(overrides.get(i, {}))
+            task_settings.append(settings)
+
+            fname = 'slurm-%06d.sbatch' % i
+            if i in overrides:
+                # Resubmissions do not overwrite the previous sbatch files
+                fname = 'slurm-%06d-%d.sbatch' % (i, self._retry.attempts.get(i, 0))
+            sbatch_files.append(op.join(self.aux_dir, fname))
+            self._sbatch_tasks[sbatch_files[-1]] = [i]
+
+        return self._template(self.SLURM_TEMPLATE).render_many(task_settings, sbatch_files)
+
+    def _generate_array_sbatch(self, task_indices=None, overrides=None):
+        """
+        Generates job array sbatch files for the tasks in ``task_indices``
+        (all by default) and the manifest of commands indexed by task.
+        Tasks resubmitted with the same ``overrides`` share arrays, and
+        arrays are split so that their task ids stay below the maximum
+        array size.
+        """
+        if task_indices is None:
+            task_indices = list(range(len(self.task_list)))
+
+        suffix = ''
+        if overrides is None:
+            overrides = {}
+        else:
+            # Resubmissions do not overwrite the previous sbatch files
+            suffix = '-%d' % len(self._retries)
+
+        tasks_file = op.join(self.aux_dir, 'tasks_list.sh')
+        self._write_aux(tasks_file, '\n'.join(self.task_list) + '\n')
+
+        settings = self._settings.copy()
+        # The manifest path as seen from the execution system
+        settings['tasks_file'] = op.join(
+            settings['work_dir'], AGAVE_JOB_LOGS, 'tasks_list.sh')
+        JOB_LOG.info('Generating job array sbatch files with the following '
+                     'settings: \n\t%s', pf(settings))
+
+        # Tasks with the same settings
+        groups = OrderedDict()
+        for i in sorted(task_indices):
+            groups.setdefault(tuple(sorted(overrides.get(i, {}).items())), []).append(i)
+
+        max_size = int(self._settings.get('array_max_size', self.SLURM_MAXARRAYSIZE))
+        conf = self._template(self.SLURM_ARRAY_TEMPLATE)
+        sbatch_files = []
+        for group_overrides, indices in list(groups.items()):
+            for chunk in _array_chunks(indices, max_size):
+                sbatch_files.append(op.join(
+                    self.aux_dir, 'slurm-array-%06d%s.sbatch' % (chunk[0], suffix)))
+                array_ids = [i - chunk[0] for i in chunk]
+                chunk_settings = settings.copy()
+                chunk_settings['array_offset'] = chunk[0]
+                chunk_settings['array_size'] = len(chunk)
+                chunk_settings['array_ids'] = format_array_ids(array_ids)
+                if self._settings.get('task_runtimes'):
+                    # One walltime for the whole array: the longest of its tasks
+                    chunk_settings['child_runtime'] = max(
+                        [self._settings['task_runtimes'][i] for i in chunk],
+                        key=_time2secs)
+                chunk_settings.update(dict(group_overrides))
+                self._sbatch_tasks[sbatch_files[-1]] = chunk
+                self._array_sbatch[sbatch_files[-1]] = array_ids
+                conf.generate_conf(chunk_settings, sbatch_files[-1])
         return sbatch_files
 
 
+def _array_chunks(indices, max_size):
+    """
+    Splits sorted task indices in chunks spanning less than ``max_size``
+
+    >>> list(_array_chunks([0, 1, 2, 5, 7], 3))
+    [[0, 1, 2], [5, 7]]
+    """
+    chunk = []
+    for i in indices:
+        if chunk and i - chunk[0] >= max_size:
+            yield chunk
+            chunk = []
+        chunk.append(i)
+    if chunk:
+        yield chunk
+
+
+def format_array_ids(array_ids):
+    """
+    Formats the task ids of a job array as ranges, for ``sbatch --array``
+
+    >>> format_array_ids([0, 1, 2, 4, 6, 7])
+    '0-2,4,6-7'
+    """
+    ranges = []
+    for taskid in array_ids:
+        if ranges and taskid == ranges[-1][1] + 1:
+            ranges[-1][1] = taskid
+        else:
+            ranges.append([taskid, taskid])
+    return ','.join('%d' % first if first == last else '%d-%d' % (first, last)
+                    for first, last in ranges)
+
+
 class CircleCISubmission(SherlockSubmission):
     """
     A CircleCI submission manager to work with the slurm docker image
@@ -57,7 +170,7 @@ class CircleCISubmission(SherlockSubmission):
     _cmd_prefix = ['sshpass', '-p', 'testpass',
                    'ssh', '-p', '10022', 'circleci@localhost']
 
-    def _generate_sbatch(self):
+    def _generate_sbatch(self, task_indices=None, overrides=None):
         """
         Generates one sbatch file per task
         """
@@ -66,11 +179,14 @@ class CircleCISubmission(SherlockSubmission):
         self._settings.pop('mincpus', None)
         self._settings.pop('mem_per_cpu', None)
         self._settings.pop('modules', None)
-        self._settings['work_dir'] = self._settings['work_dir'].replace(
-            op.expanduser('~/'), '/')
-        self._settings['work_dir'] = self._settings['work_dir'].replace(
-            '~/', '/')
-        return super(CircleCISubmission, self)._generate_sbatch()
+        for key in ['work_dir', 'sentinel_dir']:
+            if self._settings.get(key):
+                self._settings[key] = self._settings[key].replace(
+                    op.expanduser('~/'), '/')
+                self._settings[key] = self._settings[key].replace(
+                    '~/', '/')
+        return super(CircleCISubmission, self)._generate_sbatch(
+            task_indices=task_indices, overrides=overrides)
 
     def _submit_sbatch(self, task):
         # Fix paths for docker image in CircleCI
@@ -82,7 +198,7 @@ class TestSubmission(SherlockSubmission):
     """
     A Test submission manager to work with the slurm docker image
     """
-    def _generate_sbatch(self):
+    def _generate_sbatch(self, task_indices=None, overrides=None):
         """
         Generates one sbatch file per task
         """
@@ -92,14 +208,31 @@ class TestSubmission(SherlockSubmission):
         self._settings.pop('mem_per_cpu', None)
         self._settings.pop('modules', None)
         self._settings.pop('srun_cmd', None)
-        return super(TestSubmission, self)._generate_sbatch()
+        return super(TestSubmission, self)._generate_sbatch(
+            task_indices=task_indices, overrides=overrides)
 
     def _submit_sbatch(self, task):
         return _run_cmd(['/bin/bash', task])
 
+    def queue_depth(self):
+        return 0
+
     def _get_jobs_status(self):
         jobs = ['%s,COMPLETED' % j for j in self.job_ids]
         return _run_cmd(['echo', '\n'.join(jobs)]).strip()
 
-    def _run_sacct(self):
-        return '\n'.join(['%s  COMPLETED  0:0' % j for j in self.job_ids])
+    def _run_sacct(self, job_ids=None):
+        if job_ids is None:
+            job_ids = self.job_ids
+        return '\n'.join(['%s  COMPLETED  0:0' % j for j in job_ids])
+
+    def _group_job_queued(self, jobid=None):
+        return False
+
+    def _run_sacct_usage(self, job_ids=None):
+        if job_ids is None:
+            job_ids = self.job_ids
+        return '\n'.join([
+            '%s|COMPLETED|00:00:01|00:00.800||||4000Mc|1|1\n'
+            '%s.batch|COMPLETED|00:00:01|00:00.800|1024K|2M|1M|||' % (j, j)
+            for j in job_ids])
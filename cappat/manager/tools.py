@@ -5,25 +5,202 @@
 """ A wrapper for systems with slurm """
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-from builtins import str
+from builtins import str, object
+import os
+from os import path as op
+import re
 import logging
 import subprocess as sp
 import socket
+import shutil
+from tempfile import mkdtemp
+from threading import Lock, Timer
+from collections import deque
+from time import sleep
+from timeit import default_timer as timer
 
 JOB_LOG = logging.getLogger('taskmanager')
 
 
-def run_cmd(cmd, shell=False, env=None):
-    """Runs a command line"""
+# Lines of output kept after the capture limit is reached
+RUN_CMD_TAIL_LINES = 200
+# Output is read in chunks, and lines longer than this are cut
+READ_CHUNK_BYTES = 64 * 1024
+LINE_MAX_BYTES = 64 * 1024
+# Progress bars rewrite their line with carriage returns
+LINE_BREAKS = re.compile(b'\r\n|[\r\n]')
+
+
+class LineSplitter(object):
+    """
+    Splits chunks of raw output into lines, breaking them at newlines and
+    carriage returns and cutting them to ``max_line`` bytes, so that the
+    memory used does not depend on what the output looks like
+
+    >>> splitter = LineSplitter(max_line=4)
+    >>> print(' | '.join(splitter.feed(b'10%\\r20%\\r3')))
+    10% | 20%
+    >>> print(' | '.join(splitter.feed(b'0%\\nlong line') + splitter.close()))
+    30% | long
+
+    """
+
+    def __init__(self, max_line=LINE_MAX_BYTES):
+        self.max_line = max_line
+        self._partial = b''
+
+    def _decode(self, line):
+        return line[:self.max_line].decode('utf-8', 'replace')
+
+    def feed(self, chunk):
+        """Returns the lines completed by ``chunk``"""
+        lines = LINE_BREAKS.split(self._partial + chunk)
+        self._partial = lines.pop()[:self.max_line]
+        return [self._decode(line) for line in lines]
+
+    def close(self):
+        """Returns the last line, if the output did not end with a line break"""
+        partial, self._partial = self._partial, b''
+        return [self._decode(partial)] if partial else []
+
+
+class CommandStream(object):
+    """
+    Runs a command line, iterating over its output (stdout and stderr)
+    line by line as it is produced (see ``LineSplitter``). Optionally, the
+    raw output is copied to ``log_file`` and the process is killed after
+    ``timeout`` seconds. The exit code is available in ``returncode`` once
+    the iteration ends.
+    """
+
+    def __init__(self, cmd, shell=False, env=None, timeout=None, log_file=None,
+                 max_line=LINE_MAX_BYTES):
+        self.cmd = cmd
+        self.shell = shell
+        self.env = env
+        self.timeout = timeout
+        self.log_file = log_file
+        self.max_line = max_line
+        self.returncode = None
+        self.timed_out = False
+
+    def _kill(self, proc):
+        self.timed_out = True
+        proc.kill()
+
+    def __iter__(self):
+        proc = sp.Popen(self.cmd, stdout=sp.PIPE, stderr=sp.STDOUT,
+                        shell=self.shell, env=self.env)
+        watchdog = None
+        if self.timeout:
+            watchdog = Timer(float(self.timeout), self._kill, args=(proc,))
+            watchdog.daemon = True
+            watchdog.start()
+
+        tee = open(self.log_file, 'ab') if self.log_file else None
+        splitter = LineSplitter(self.max_line)
+        try:
+            for chunk in iter(lambda: os.read(proc.stdout.fileno(), READ_CHUNK_BYTES), b''):
+                if tee is not None:
+                    tee.write(chunk)
+                for line in splitter.feed(chunk):
+                    yield line
+            for line in splitter.close():
+                yield line
+            self.returncode = proc.wait()
+        finally:
+            if watchdog is not None:
+                watchdog.cancel()
+            if tee is not None:
+                tee.close()
+            if proc.poll() is None:
+                # The consumer stopped early
+                proc.kill()
+                self.returncode = proc.wait()
+            proc.stdout.close()
+
+
+class OutputBuffer(object):
+    """
+    Captures the lines of an output up to ``max_bytes`` and, beyond
+    that, only the last ``tail_lines`` lines (each cut to ``max_bytes``)
+
+    >>> buf = OutputBuffer(max_bytes=8, tail_lines=1)
+    >>> for line in ['one', 'two', 'three', 'four']:
+    ...     buf.append(line)
+    >>> print(buf.getvalue())
+    one
+    two
+    [... 1 lines not captured ...]
+    four
+
+    >>> buf = OutputBuffer(max_bytes=10)
+    >>> for line in ['one', 'threeeeeeeeeeee', 'ab']:
+    ...     buf.append(line)
+    >>> print(buf.getvalue())
+    one
+    threeeeeee
+    ab
+
+    """
+
+    def __init__(self, max_bytes=None, tail_lines=RUN_CMD_TAIL_LINES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.skipped = 0
+        self._head = []
+        self._tail = deque(maxlen=tail_lines)
+
+    def append(self, line):
+        if self.max_bytes is not None:
+            line = line[:self.max_bytes]
+        # Once a line went to the tail, the head is full: later (shorter)
+        # lines must not be captured before it
+        if self.max_bytes is None or (
+                not self._tail and self.nbytes + len(line) < self.max_bytes):
+            self._head.append(line)
+            self.nbytes += len(line) + 1
+            return
+        if len(self._tail) == self._tail.maxlen:
+            self.skipped += 1
+        self._tail.append(line)
+
+    def getvalue(self):
+        lines = list(self._head)
+        if self.skipped:
+            lines.append('[... %d lines not captured ...]' % self.skipped)
+        return '\n'.join(lines + list(self._tail))
+
+
+def run_cmd(cmd, shell=False, env=None, timeout=None, max_output=None,
+            log_file=None, on_line=None):
+    """
+    Runs a command line and returns its non-empty output lines, joined
+    in one string. The output is streamed: ``on_line`` is called with
+    every line as it is produced, ``log_file`` receives a full copy and
+    only ``max_output`` bytes (plus the last lines) are kept in memory.
+    """
 
     JOB_LOG.info('Executing command line: %s', ' '.join(cmd))
-    try:
-        result = str(sp.check_output(cmd, stderr=sp.STDOUT, shell=shell, env=env))
-    except sp.CalledProcessError as error:
+    stream = CommandStream(cmd, shell=shell, env=env, timeout=timeout, log_file=log_file)
+    output = OutputBuffer(max_output)
+    for line in stream:
+        if on_line is not None:
+            on_line(line)
+        if line.strip():
+            output.append(line)
+    result = output.getvalue()
+
+    if stream.timed_out:
+        JOB_LOG.critical('Command timed out after %ss: \n\tCmdline: %s\n\tOutput:\n\t%s',
+                         timeout, ' '.join(cmd), result)
+        raise RuntimeError('Command "{}" timed out after {}s'.format(' '.join(cmd), timeout))
+
+    if stream.returncode != 0:
         JOB_LOG.critical('Error submitting (exit code %d): \n\tCmdline: %s\n\tOutput:\n\t%s',
-                         error.returncode, ' '.join(cmd), error.output)
-        raise
-    result = '\n'.join([line for line in result.split('\n') if line.strip()])
+                         stream.returncode, ' '.join(cmd), result)
+        raise sp.CalledProcessError(stream.returncode, cmd, output=result)
+
     if not result:
         JOB_LOG.info('Command output was empty')
         return None
@@ -31,6 +208,122 @@ def run_cmd(cmd, shell=False, env=None):
     JOB_LOG.info('Command output: \n%s', result)
     return result
 
+class SSHTransport(object):
+    """
+    Shares one multiplexed ssh connection (ControlMaster) among all the
+    commands run with an ``ssh`` command prefix, so that only the first
+    command pays the handshake and authentication latency.
+    """
+
+    def __init__(self, cmd_prefix, persist=600, control_dir=None):
+        self._base_prefix = list(cmd_prefix)
+        self._ssh_idx = self._base_prefix.index('ssh') + 1
+        self._persist = persist
+        self._control_dir = control_dir
+        self._control_path = None
+        self._tmp_dir = None
+        self._failed = False
+        self._lock = Lock()
+
+    def _with_options(self, options):
+        return (self._base_prefix[:self._ssh_idx] + options +
+                self._base_prefix[self._ssh_idx:])
+
+    @property
+    def is_open(self):
+        return self._control_path is not None
+
+    @property
+    def prefix(self):
+        """The command prefix, using the master connection if it is up"""
+        if not self.is_open:
+            return list(self._base_prefix)
+        return self._with_options(['-oControlMaster=no',
+                                   '-oControlPath=%s' % self._control_path])
+
+    def open(self):
+        """Starts the master connection in the background"""
+        with self._lock:
+            return self._open()
+
+    def _open(self):
+        if self.is_open or self._failed:
+            return self.is_open
+
+        control_dir = self._control_dir
+        if control_dir is None:
+            # Keep it short, unix socket paths are limited to ~100 chars
+            control_dir = self._tmp_dir = mkdtemp(prefix='cappat-ssh-')
+        control_path = op.join(control_dir, 'cm-%r@%h:%p')
+
+        cmd = self._with_options([
+            '-oControlMaster=yes', '-oControlPath=%s' % control_path,
+            '-oControlPersist=%d' % self._persist, '-fN'])
+        JOB_LOG.info('Opening ssh master connection: %s', ' '.join(cmd))
+        with open(os.devnull, 'wb') as devnull:
+            retcode = sp.call(cmd, stdout=devnull, stderr=devnull)
+
+        if retcode != 0:
+            JOB_LOG.warning('Could not open ssh master connection (exit code %d), '
+                            'falling back to one connection per command', retcode)
+            self._failed = True
+            self._cleanup()
+            return False
+
+        self._control_path = control_path
+        return True
+
+    def _cleanup(self):
+        if self._tmp_dir is not None:
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
+            self._tmp_dir = None
+
+    def close(self):
+        """Stops the master connection"""
+        if not self.is_open:
+            return
+        cmd = self._with_options(['-oControlPath=%s' % self._control_path,
+                                  '-O', 'exit'])
+        JOB_LOG.info('Closing ssh master connection: %s', ' '.join(cmd))
+        with open(os.devnull, 'wb') as devnull:
+            sp.call(cmd, stdout=devnull, stderr=devnull)
+        self._control_path = None
+        self._cleanup()
+
+    def run(self, cmd, **kwargs):
+        """Runs a command through the shared connection"""
+        self.open()
+        return run_cmd(self.prefix + cmd, **kwargs)
+
+
+class RateLimiter(object):
+    """
+    A thread-safe token bucket: allows ``rate`` calls per second on average,
+    with bursts of up to ``burst`` calls
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.capacity = max(1, int(burst))
+        self._tokens = float(self.capacity)
+        self._last = timer()
+        self._lock = Lock()
+
+    def acquire(self):
+        """Blocks until a token is available"""
+        while True:
+            with self._lock:
+                now = timer()
+                self._tokens = min(self.capacity,
+                                   self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            sleep(wait)
+
+
 def format_modules(modules_list):
     if not modules_list:
         return None
@@ -65,6 +358,108 @@ def format_modules(modules_list):
 
     return modtext
 
+def pack_tasks(ntasks, node_cpus, node_memory=None, task_cpus=1, task_memory=None,
+               max_nodes=None):
+    """
+    Plans how many tasks are packed on each node given the shape of the
+    nodes (cpus and memory in GB) and the estimated requirements of each
+    task. If ``max_nodes`` is not enough to run all tasks at once, the
+    launcher would run them in ``waves``, one after the other.
+
+    >>> sorted(pack_tasks(10, 24, node_memory=64, task_cpus=4, task_memory=8).items())
+    [('cpus_per_task', 4), ('nodes', 2), ('tasks_per_node', 5), ('waves', 1)]
+    >>> pack_tasks(100, 24, task_cpus=4, max_nodes=2)['waves']
+    9
+
+    """
+    node_cpus = int(node_cpus)
+    task_cpus = max(1, int(task_cpus or 1))
+    if task_cpus > node_cpus:
+        raise RuntimeError('Tasks require {} CPUs, but nodes only have {}'.format(
+            task_cpus, node_cpus))
+
+    capacity = node_cpus // task_cpus
+    if task_memory and node_memory:
+        if float(task_memory) > float(node_memory):
+            raise RuntimeError('Tasks require {}GB of memory, but nodes only '
+                               'have {}GB'.format(task_memory, node_memory))
+        capacity = min(capacity, int(float(node_memory) // float(task_memory)))
+
+    nodes = -(-ntasks // capacity)
+    if max_nodes:
+        nodes = min(nodes, int(max_nodes))
+
+    # Spread tasks evenly and give the spare CPUs to the tasks
+    tasks_per_node = min(capacity, -(-ntasks // nodes))
+    plan = {
+        'nodes': nodes,
+        'tasks_per_node': tasks_per_node,
+        'cpus_per_task': node_cpus // tasks_per_node,
+        'waves': -(-ntasks // (nodes * tasks_per_node)),
+    }
+    JOB_LOG.info('Packing %d tasks (%d CPUs, %sGB each) into %d node(s) with '
+                 '%d CPUs and %sGB: %d tasks per node', ntasks, task_cpus,
+                 task_memory or '?', nodes, node_cpus, node_memory or '?',
+                 tasks_per_node)
+    return plan
+
+
+def task_participants(task):
+    """
+    Returns the participant labels processed by a task command line
+
+    >>> task_participants('app /data out/ participant --participant_label 01 02 -w work')
+    ['01', '02']
+
+    """
+    args = task.split()
+    if '--participant_label' not in args:
+        return []
+
+    labels = []
+    for arg in args[args.index('--participant_label') + 1:]:
+        if arg.startswith('-'):
+            break
+        labels.append(arg[4:] if arg.startswith('sub-') else arg)
+    return labels
+
+
+def parse_elapsed(timestr):
+    """
+    Converts a slurm time string (``[D-]HH:MM:SS``, ``MM:SS.mmm``) to seconds
+
+    >>> parse_elapsed('1-02:00:30')
+    93630.0
+
+    """
+    timestr = timestr.strip()
+    if not timestr or timestr in ['UNLIMITED', 'INVALID']:
+        return None
+    days = 0
+    if '-' in timestr:
+        days, timestr = timestr.split('-', 1)
+    return int(days) * 86400 + sum(
+        (60 ** i) * float(t) for i, t in enumerate(reversed(timestr.split(':'))))
+
+
+def parse_memory(memstr):
+    """
+    Converts a slurm memory string (e.g. ``1024K``, ``2.5G``) to KB
+
+    >>> parse_memory('2.5G')
+    2621440
+
+    """
+    memstr = memstr.strip()
+    if not memstr:
+        return 0
+    units = {'K': 1, 'M': 1024, 'G': 1024 ** 2, 'T': 1024 ** 3}
+    if memstr[-1].upper() in units:
+        return int(float(memstr[:-1]) * units[memstr[-1].upper()])
+    # Plain numbers are bytes
+    return int(float(memstr) / 1024)
+
+
 def time_fraction(timestr, fraction=0.90):
     """Returns a time string which is the fraction of the input"""
     return _secs2time(int(fraction * _time2secs(timestr)))
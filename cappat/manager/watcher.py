@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Watchers: wait for the completion of submitted jobs
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+from os import path as op
+from time import sleep
+import logging
+from builtins import object
+
+from .tools import _time2secs
+
+SLEEP_SECONDS = 5
+MAX_SLEEP_SECONDS = 300
+# Target number of polls during the expected runtime of a job
+POLLS_PER_RUNTIME = 100
+SENTINEL_PATTERN = 'task-%06d.exit'
+
+JOB_LOG = logging.getLogger('taskmanager')
+
+
+class JobWatcher(object):
+    """
+    Polls the scheduler until all jobs are finished. The polling interval
+    starts at ``poll_min_seconds`` and is increased geometrically up to
+    a maximum that is proportional to the expected runtime of the jobs.
+    """
+
+    def __init__(self, manager, min_sleep=None, max_sleep=None, backoff=1.5):
+        self._manager = manager
+        settings = manager._settings
+
+        if min_sleep is None:
+            min_sleep = float(settings.get('poll_min_seconds', SLEEP_SECONDS))
+
+        if max_sleep is None:
+            max_sleep = settings.get('poll_max_seconds')
+
+        if max_sleep is None:
+            runtime = _time2secs(settings['child_runtime'])
+            max_sleep = min(MAX_SLEEP_SECONDS, runtime / POLLS_PER_RUNTIME)
+
+        self.min_sleep = min_sleep
+        self.max_sleep = max(min_sleep, float(max_sleep))
+        self.backoff = backoff
+        self.npolls = 0
+
+    def intervals(self):
+        """Generates the sleeping intervals between polls"""
+        interval = self.min_sleep
+        while True:
+            yield interval
+            interval = min(interval * self.backoff, self.max_sleep)
+
+    def poll(self):
+        """Returns True when all jobs are finished"""
+        self.npolls += 1
+        return self._manager._get_jobs_status()
+
+    def wait(self):
+        """Blocks until all jobs are finished"""
+        JOB_LOG.info('%s polling every %.1f-%.1fs', self.__class__.__name__,
+                     self.min_sleep, self.max_sleep)
+        intervals = self.intervals()
+        while True:
+            all_finished = self.poll()
+            finished = self._manager._collect_finished(all_finished)
+            if self._manager._jobs_finished(finished):
+                # Some tasks were resubmitted
+                all_finished = False
+
+            if all_finished:
+                break
+            sleep(next(intervals))
+        JOB_LOG.info('%s finished after %d polls', self.__class__.__name__,
+                     self.npolls)
+
+
+class SentinelWatcher(JobWatcher):
+    """
+    Detects completion from the sentinel files written by each task
+    into ``<aux_dir>/sentinels``. Only one directory listing is done
+    per poll, and the scheduler is queried every ``sentinel_check_every``
+    polls to catch jobs that were killed before writing their sentinel
+    (e.g. timeouts or node failures).
+    """
+
+    def __init__(self, manager, min_sleep=None, max_sleep=None, backoff=1.5,
+                 check_every=None):
+        super(SentinelWatcher, self).__init__(
+            manager, min_sleep=min_sleep, max_sleep=max_sleep, backoff=backoff)
+        if check_every is None:
+            check_every = int(manager._settings.get('sentinel_check_every', 10))
+        self.check_every = check_every
+        self.sentinel_dir = manager.sentinel_dir
+
+    def finished_tasks(self):
+        """Returns the set of task indices that wrote their sentinel"""
+        if not op.isdir(self.sentinel_dir):
+            return set()
+        return set(int(fname[5:11]) for fname in os.listdir(self.sentinel_dir)
+                   if fname.startswith('task-') and fname.endswith('.exit'))
+
+    def submitted_tasks(self):
+        """Returns the set of task indices run by the submitted jobs"""
+        return set(task_index for tasks in list(self._manager.job_tasks.values())
+                   for task_index in tasks)
+
+    def poll(self):
+        self.npolls += 1
+        # Only a subset of the tasks may have been submitted (resumed runs)
+        submitted = self.submitted_tasks()
+        if submitted <= self.finished_tasks():
+            JOB_LOG.info('All %d tasks wrote their sentinel file', len(submitted))
+            return True
+
+        if self.npolls % self.check_every == 0:
+            return self._manager._get_jobs_status()
+        return False
+
+
+WATCHERS = {
+    'scheduler': JobWatcher,
+    'sentinel': SentinelWatcher,
+}
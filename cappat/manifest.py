@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Run manifest: per-participant completion records used to resume runs
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+from os import path as op
+import re
+import json
+import hashlib
+import logging
+from io import open
+from time import time
+from builtins import object
+
+from cappat.utils import atomic_write
+
+MANIFEST_VERSION = 1
+# Settings that change the outputs of a participant
+MANIFEST_KEYS = ['bids_dir', 'executable', 'participant_args']
+SUBJECT_RE = re.compile(r'sub-([a-zA-Z0-9]+)')
+
+wlogger = logging.getLogger('wrapper')
+
+
+def file_checksum(fname, blocksize=2 ** 20):
+    """Computes the SHA1 checksum of a file, reading it in blocks"""
+    sha1 = hashlib.sha1()
+    with open(fname, 'rb') as ifh:
+        for block in iter(lambda: ifh.read(blocksize), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def settings_digest(app_settings):
+    """Digest of the settings that determine the participant outputs"""
+    values = dict((key, '%s' % app_settings.get(key)) for key in MANIFEST_KEYS)
+    return hashlib.sha1(json.dumps(values, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def subject_outputs(output_dir):
+    """
+    Maps each participant to the output files that belong to it
+    (those with ``sub-<label>`` in their path)
+    """
+    outputs = {}
+    output_dir = op.abspath(output_dir)
+    for root, _, files in os.walk(output_dir):
+        for fname in files:
+            relpath = op.relpath(op.join(root, fname), output_dir)
+            match = SUBJECT_RE.search(relpath)
+            if match is not None:
+                outputs.setdefault(match.group(1), []).append(relpath)
+    return outputs
+
+
+class RunManifest(object):
+    """
+    Records the final state of each participant and the checksums of
+    its outputs. Re-running with the same settings only processes the
+    participants that are missing, failed or whose outputs changed.
+    """
+
+    def __init__(self, path, digest):
+        self.path = path
+        self.digest = digest
+        self.subjects = {}
+
+        if op.isfile(path):
+            with open(path, 'r') as mfh:
+                data = json.load(mfh)
+            if data.get('version') == MANIFEST_VERSION and data.get('digest') == digest:
+                self.subjects = data.get('subjects', {})
+            else:
+                wlogger.warning('Settings changed since manifest %s was written, '
+                                'all participants will be processed', path)
+
+    def save(self):
+        atomic_write(self.path, json.dumps({
+            'version': MANIFEST_VERSION,
+            'digest': self.digest,
+            'subjects': self.subjects,
+        }, indent=2, sort_keys=True))
+
+    def _outputs_valid(self, output_dir, outputs):
+        """
+        Checks the recorded outputs, returns whether they are valid and
+        whether the modification time of some of them was refreshed
+        """
+        refreshed = False
+        for relpath, (size, mtime, checksum) in list(outputs.items()):
+            fname = op.join(output_dir, relpath)
+            if not op.isfile(fname):
+                return False, refreshed
+            stat = os.stat(fname)
+            if stat.st_size != size:
+                return False, refreshed
+            # Only re-hash files that were touched since the last run
+            if stat.st_mtime != mtime:
+                if file_checksum(fname) != checksum:
+                    return False, refreshed
+                # Same contents: record the new time, not to hash it again
+                outputs[relpath] = [size, stat.st_mtime, checksum]
+                refreshed = True
+        return True, refreshed
+
+    def completed(self, subject_list, output_dir):
+        """Returns the participants that do not need to be processed again"""
+        output_dir = op.abspath(output_dir)
+        done = []
+        refreshed = False
+        for subject in subject_list:
+            record = self.subjects.get(subject)
+            if record is None or record['state'] != 'COMPLETED':
+                continue
+            if not record.get('outputs'):
+                wlogger.warning('No outputs were recorded for participant %s, it will be '
+                                'processed again', subject)
+                continue
+            valid, touched = self._outputs_valid(output_dir, record['outputs'])
+            refreshed = refreshed or touched
+            if valid:
+                done.append(subject)
+            else:
+                wlogger.warning('Outputs of participant %s changed, it will be '
+                                'processed again', subject)
+        if refreshed:
+            self.save()
+        return done
+
+    def update(self, states, output_dir, jobids=None):
+        """
+        Records the final state of each participant and, for those
+        completed, the checksums of their outputs (only computed for the
+        files whose size or modification time changed since recorded)
+        """
+        if jobids is None:
+            jobids = {}
+
+        output_dir = op.abspath(output_dir)
+        outputs = subject_outputs(output_dir)
+        for subject, state in list(states.items()):
+            previous = self.subjects.get(subject, {}).get('outputs', {})
+            record = {'state': state, 'jobid': jobids.get(subject), 'updated': time(),
+                      'outputs': {}}
+            if state == 'COMPLETED':
+                for relpath in outputs.get(subject, []):
+                    fname = op.join(output_dir, relpath)
+                    stat = os.stat(fname)
+                    size, mtime, checksum = previous.get(relpath, [None, None, None])
+                    if (stat.st_size, stat.st_mtime) != (size, mtime):
+                        checksum = file_checksum(fname)
+                    record['outputs'][relpath] = [stat.st_size, stat.st_mtime, checksum]
+            self.subjects[subject] = record
+        self.save()
+        wlogger.info('Updated run manifest %s (%d participants)', self.path, len(states))
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Metrics: timers and counters of a cappat run
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import re
+import json
+from io import open
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock
+from time import time
+from timeit import default_timer as timer
+from builtins import object
+
+from cappat.utils import atomic_write
+
+PROMETHEUS_PREFIX = 'cappat'
+
+
+class Metrics(object):
+    """
+    A thread-safe registry of timers (durations in seconds, with count,
+    total and maximum) and counters. Every observation is also kept as a
+    record, to be written as JSON lines at the end of the run.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.timers = OrderedDict()
+            self.counters = OrderedDict()
+            self.records = []
+
+    def observe(self, name, seconds, **labels):
+        """Records a duration"""
+        with self._lock:
+            stats = self.timers.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0})
+            stats['count'] += 1
+            stats['total'] += seconds
+            stats['max'] = max(stats['max'], seconds)
+            record = {'metric': name, 'seconds': seconds, 'time': time()}
+            record.update(labels)
+            self.records.append(record)
+
+    def incr(self, name, value=1):
+        """Increments a counter"""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Times the enclosed block"""
+        start = timer()
+        try:
+            yield
+        finally:
+            self.observe(name, timer() - start, **labels)
+
+    def write_jsonl(self, path):
+        """Writes all the records, then the totals, one JSON object per line"""
+        with self._lock:
+            lines = [json.dumps(record, sort_keys=True) for record in self.records]
+            lines += [json.dumps(dict(metric=name, summary=True, **stats), sort_keys=True)
+                      for name, stats in list(self.timers.items())]
+            lines += [json.dumps({'metric': name, 'summary': True, 'value': value},
+                                 sort_keys=True)
+                      for name, value in list(self.counters.items())]
+        with open(path, 'a') as mfh:
+            mfh.write('%s' % ''.join(line + '\n' for line in lines))
+
+    def write_prometheus(self, path):
+        """Writes the totals in the Prometheus textfile collector format"""
+        def _name(name):
+            return '%s_%s' % (PROMETHEUS_PREFIX, re.sub(r'[^a-zA-Z0-9_]', '_', name))
+
+        lines = []
+        with self._lock:
+            for name, stats in list(self.timers.items()):
+                metric = _name(name) + '_seconds'
+                lines += ['# TYPE %s summary' % metric,
+                          '%s_sum %f' % (metric, stats['total']),
+                          '%s_count %d' % (metric, stats['count'])]
+            for name, value in list(self.counters.items()):
+                metric = _name(name) + '_total'
+                lines += ['# TYPE %s counter' % metric, '%s %d' % (metric, value)]
+        atomic_write(path, ''.join(line + '\n' for line in lines))
+
+    def summary(self):
+        """A table with the totals"""
+        with self._lock:
+            lines = ['%-28s %8s %12s %12s %12s' % ('metric', 'count', 'total (s)',
+                                                   'mean (s)', 'max (s)')]
+            for name, stats in list(self.timers.items()):
+                lines.append('%-28s %8d %12.3f %12.3f %12.3f' % (
+                    name, stats['count'], stats['total'],
+                    stats['total'] / stats['count'], stats['max']))
+            for name, value in list(self.counters.items()):
+                lines.append('%-28s %8d' % (name, value))
+        return '\n'.join(lines)
+
+
+# The registry shared by the whole process
+METRICS = Metrics()
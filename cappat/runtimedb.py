@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Runtime database: a local record of past participant runs
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from os import path as op
+import sqlite3
+import logging
+from time import time
+from builtins import object
+
+from cappat.utils import check_folder
+
+RUNTIME_MARGIN = 1.5
+MIN_WALLTIME = 600
+OUTLIER_NSIGMA = 3.0
+
+wlogger = logging.getLogger('wrapper')
+
+
+def _median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return 0.5 * (values[mid - 1] + values[mid])
+
+
+class RuntimeDB(object):
+    """
+    A SQLite store of the wall time, peak memory and final state of every
+    participant processed, keyed by app, app version and input size.
+    """
+    SCHEMA = """\
+CREATE TABLE IF NOT EXISTS runs (
+    app TEXT NOT NULL,
+    version TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    input_bytes INTEGER,
+    elapsed REAL,
+    maxrss INTEGER,
+    state TEXT,
+    recorded REAL
+);
+CREATE INDEX IF NOT EXISTS runs_app_subject ON runs (app, subject);
+"""
+
+    def __init__(self, path):
+        self.path = op.abspath(op.expanduser(path))
+        check_folder(op.dirname(self.path))
+        self._conn = sqlite3.connect(self.path, timeout=30)
+        self._conn.executescript(self.SCHEMA)
+
+    def close(self):
+        self._conn.close()
+
+    def record(self, app, version, runs):
+        """
+        Stores a list of runs, each one a dictionary with keys ``subject``,
+        ``input_bytes``, ``elapsed`` (seconds), ``maxrss`` (KB) and ``state``
+        """
+        now = time()
+        with self._conn:
+            self._conn.executemany(
+                'INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [(app, version, run['subject'], run.get('input_bytes'),
+                  run.get('elapsed'), run.get('maxrss'), run.get('state'), now)
+                 for run in runs])
+        wlogger.info('Recorded %d runs of %s-%s in %s', len(runs), app, version,
+                     self.path)
+
+    def _completed(self, app, version):
+        query = ("SELECT subject, input_bytes, elapsed FROM runs WHERE app = ? AND "
+                 "state = 'COMPLETED' AND elapsed > 0")
+        rows = self._conn.execute(query + ' AND version = ?', (app, version)).fetchall()
+        if not rows:
+            # Fall back to other versions of the same app
+            rows = self._conn.execute(query, (app, )).fetchall()
+        return rows
+
+    def estimates(self, app, version, subjects, sizes=None):
+        """
+        Estimates the runtime (in seconds) of each subject. Subjects
+        processed before use their longest past runtime, others are
+        extrapolated from the median time per input byte of the app.
+        Returns ``None`` for subjects that cannot be estimated.
+        """
+        if sizes is None:
+            sizes = {}
+
+        rows = self._completed(app, version)
+        history = {}
+        rates = []
+        for subject, input_bytes, elapsed in rows:
+            history.setdefault(subject, []).append(elapsed)
+            if input_bytes:
+                rates.append(elapsed / input_bytes)
+
+        rate = _median(rates) if rates else None
+        estimates = {}
+        for subject in subjects:
+            if subject in history:
+                estimates[subject] = max(history[subject])
+            elif rate is not None and sizes.get(subject):
+                estimates[subject] = rate * sizes[subject]
+            else:
+                estimates[subject] = None
+        return estimates
+
+    def outliers(self, app, version, runs, nsigma=OUTLIER_NSIGMA):
+        """
+        Returns the subset of ``runs`` whose elapsed time is more than
+        ``nsigma`` standard deviations away from the history of the subject
+        (or from the estimate, for subjects with less than three past runs)
+        """
+        subjects = [run['subject'] for run in runs]
+        sizes = dict((run['subject'], run.get('input_bytes')) for run in runs)
+        estimates = self.estimates(app, version, subjects, sizes)
+
+        history = {}
+        for subject, _, elapsed in self._completed(app, version):
+            history.setdefault(subject, []).append(elapsed)
+
+        flagged = []
+        for run in runs:
+            elapsed = run.get('elapsed')
+            if not elapsed or run.get('state') != 'COMPLETED':
+                continue
+            past = history.get(run['subject'], [])
+            if len(past) >= 3:
+                mean = sum(past) / len(past)
+                std = (sum((x - mean) ** 2 for x in past) / len(past)) ** 0.5
+                # Do not flag tiny variations of very stable runtimes
+                if abs(elapsed - mean) > nsigma * max(std, 0.1 * mean):
+                    flagged.append(run)
+            elif estimates.get(run['subject']):
+                ratio = elapsed / estimates[run['subject']]
+                if ratio > nsigma or ratio < 1.0 / nsigma:
+                    flagged.append(run)
+        return flagged
+
+
+def walltime(estimate, margin=RUNTIME_MARGIN, minimum=MIN_WALLTIME):
+    """
+    A walltime request (in seconds) for a task with the given estimated
+    runtime, or ``None`` if it could not be estimated
+    """
+    if estimate is None:
+        return None
+    return int(max(minimum, margin * estimate))
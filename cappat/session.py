@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Agave session: a small REST client of the services used by cappat (files,
+systems, apps, profiles), over one pooled HTTP session. The token of the
+Agave CLI cache (``~/.agave/current``) is reused while it is valid and
+refreshed when it is about to expire, and every API call is timed
+(``agave.<service>.<method>`` in ``cappat.metrics``).
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os.path as op
+import json
+import logging
+from io import open
+from threading import Lock
+from time import time
+from builtins import object
+
+from cappat.metrics import METRICS
+from cappat.utils import atomic_write
+
+try:
+    from requests import RequestException
+except ImportError:  # requests is only needed to open a session
+    RequestException = IOError
+
+SESSION_FILE = op.expanduser('~/.agave/current')
+# Tokens are refreshed when they expire in less than this (seconds)
+TOKEN_MARGIN = 300
+# Connections kept alive to the API server
+POOL_SIZE = 8
+APPS_PAGE = 100
+FILES_PAGE = 1000
+
+logger = logging.getLogger('appgen')
+
+
+class AttrDict(dict):
+    """A dictionary with attribute access, like the responses of agavepy"""
+
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+
+def _attrs(value):
+    if isinstance(value, dict):
+        return AttrDict((key, _attrs(val)) for key, val in list(value.items()))
+    if isinstance(value, list):
+        return [_attrs(val) for val in value]
+    return value
+
+
+def load_session(session_file=SESSION_FILE):
+    """Reads the session cache of the Agave CLI"""
+    if not op.isfile(session_file):
+        return None
+    with open(session_file) as sfh:
+        return json.load(sfh)
+
+
+def save_session(data, session_file=SESSION_FILE):
+    """Writes the session cache, readable only by the user"""
+    atomic_write(session_file, json.dumps(data, indent=2), mode=0o600)
+
+
+def token_expires(data):
+    """The time the token of a session expires (``None`` if unknown)"""
+    try:
+        return float(data['created_at']) + float(data['expires_in'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def http_session(pool_size=POOL_SIZE):
+    """A requests session keeping up to ``pool_size`` connections alive"""
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class _Service(object):
+    def __init__(self, session, name):
+        self._session = session
+        self._name = name
+
+    def _request(self, operation, method, path, **kwargs):
+        return self._session.request('%s.%s' % (self._name, operation), method, path,
+                                     **kwargs)
+
+    def _list(self, path, page_size):
+        """Gets all the items of a listing, page by page"""
+        items = []
+        while True:
+            page = self._request('list', 'GET', path, params={
+                'limit': page_size, 'offset': len(items)})
+            items += page
+            if len(page) < page_size:
+                return items
+
+
+class Files(_Service):
+    MEDIA = 'files/v2/media/system/%s/%s'
+
+    def list(self, systemId, filePath=''):
+        return self._list('files/v2/listings/system/%s/%s' % (systemId, filePath),
+                          FILES_PAGE)
+
+    def manage(self, systemId, filePath, body):
+        return self._request('manage', 'PUT', self.MEDIA % (systemId, filePath), json=body)
+
+    def download(self, systemId, filePath):
+        return self._request('download', 'GET', self.MEDIA % (systemId, filePath), raw=True)
+
+    def importData(self, systemId, filePath, fileName, fileToUpload):
+        return self._request('importData', 'POST', self.MEDIA % (systemId, filePath),
+                             data={'fileName': fileName},
+                             files={'fileToUpload': (fileName, fileToUpload)})
+
+
+class Systems(_Service):
+    def get(self, systemId):
+        return self._request('get', 'GET', 'systems/v2/%s' % systemId)
+
+
+class Apps(_Service):
+    def list(self):
+        return self._list('apps/v2/', APPS_PAGE)
+
+    def add(self, body):
+        return self._request('add', 'POST', 'apps/v2/', json=body)
+
+
+class Profiles(_Service):
+    def get(self):
+        return self._request('get', 'GET', 'profiles/v2/me')
+
+
+class AgaveSession(object):
+    """
+    An authenticated Agave client, built from the session cache of the
+    Agave CLI. It provides the ``files``, ``systems``, ``apps`` and
+    ``profiles`` services with the interface of agavepy, and can be used
+    wherever cappat takes an Agave client.
+    """
+
+    def __init__(self, data, session_file=SESSION_FILE, http=None, pool_size=POOL_SIZE):
+        for key in ['access_token', 'refresh_token', 'baseurl', 'apikey', 'apisecret']:
+            if not data.get(key):
+                raise RuntimeError('{} required in the Agave session'.format(key))
+        self.data = data
+        self.session_file = session_file
+        self.baseurl = data['baseurl'].rstrip('/')
+        self._http = http if http is not None else http_session(pool_size)
+        self._lock = Lock()
+        self.files = Files(self, 'files')
+        self.systems = Systems(self, 'systems')
+        self.apps = Apps(self, 'apps')
+        self.profiles = Profiles(self, 'profiles')
+
+    @classmethod
+    def from_cache(cls, session_file=SESSION_FILE, **kwargs):
+        """
+        A session from the cache, if there is one and its token is valid
+        (refreshing it if necessary), otherwise ``None``, also when the
+        API cannot be reached
+        """
+        data = load_session(session_file)
+        if not data:
+            return None
+        try:
+            session = cls(data, session_file=session_file, **kwargs)
+        except RuntimeError as error:
+            logger.warning('Agave session cache could not be used: %s', error)
+            return None
+        if session.validate():
+            return session
+        session.close()
+        return None
+
+    @property
+    def token(self):
+        return self.data['access_token']
+
+    def expired(self, margin=TOKEN_MARGIN):
+        """Whether the token is expired, or expires within ``margin`` seconds"""
+        expires = token_expires(self.data)
+        return expires is not None and expires - time() < margin
+
+    def probe(self):
+        """A cheap call to check that the token is accepted"""
+        try:
+            self.profiles.get()
+        except RuntimeError:
+            return False
+        except RequestException as error:
+            logger.warning('Agave API could not be reached: %s', error)
+            return False
+        return True
+
+    def validate(self):
+        """Makes sure the token is valid, refreshing it if needed"""
+        if not self.expired() and self.probe():
+            return True
+        try:
+            self.refresh()
+        except (RuntimeError, RequestException) as error:
+            logger.warning('Agave token could not be refreshed: %s', error)
+            return False
+        return self.probe()
+
+    def refresh(self, if_expired=False):
+        """Gets a new token with the refresh token, and caches it"""
+        with self._lock, METRICS.timer('agave.token.refresh'):
+            if if_expired and not self.expired(margin=0):
+                # Refreshed by another thread
+                return
+            response = self._http.post(
+                '%s/token' % self.baseurl,
+                data={'grant_type': 'refresh_token', 'scope': 'PRODUCTION',
+                      'refresh_token': self.data['refresh_token']},
+                auth=(self.data['apikey'], self.data['apisecret']))
+            if response.status_code != 200:
+                raise RuntimeError('token refresh failed ({})'.format(response.status_code))
+            token = response.json()
+            self.data.update({
+                'access_token': token['access_token'],
+                'refresh_token': token.get('refresh_token', self.data['refresh_token']),
+                'expires_in': token.get('expires_in', self.data.get('expires_in')),
+                'created_at': '%d' % time(),
+            })
+            if self.session_file:
+                save_session(self.data, self.session_file)
+        logger.info('Agave token refreshed')
+
+    def request(self, operation, method, path, raw=False, **kwargs):
+        """Calls the API, returning the ``result`` of the response"""
+        if self.expired(margin=0):
+            self.refresh(if_expired=True)
+        url = '%s/%s' % (self.baseurl, path)
+        with METRICS.timer('agave.' + operation):
+            response = self._http.request(
+                method, url, headers={'Authorization': 'Bearer %s' % self.token}, **kwargs)
+            if response.status_code == 401 and 'files' not in kwargs:
+                # Revoked before its expiration time, uploads are not replayed
+                self.refresh()
+                response = self._http.request(
+                    method, url, headers={'Authorization': 'Bearer %s' % self.token},
+                    **kwargs)
+        if response.status_code >= 400:
+            raise RuntimeError('Agave {} {} failed ({}): {}'.format(
+                method, path, response.status_code, response.text[:200]))
+        if raw:
+            return response.content
+        return _attrs(response.json().get('result'))
+
+    def close(self):
+        self._http.close()
@@ -0,0 +1,8 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import sys
+
+# The asyncio driver (cappat.manager.aio) is only available on Python 3
+collect_ignore = ['test_aio.py'] if sys.version_info[0] < 3 else []
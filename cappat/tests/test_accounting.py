@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+from cappat.manager.accounting import (
+    chunks, parse_reqmem, parse_usage, accounting_report)
+
+SACCT_OUTPUT = """\
+1001|COMPLETED|01:00:00|02:00:00||||4000Mc|4|1
+1001.batch|COMPLETED|01:00:00|02:00:00|4G|1.5M|200M|||
+1001.extern|COMPLETED|01:00:00|00:00:00|1M|0|0|||
+1002_0|COMPLETED|00:30:00|00:15:00||||8Gn|2|1
+1002_0.batch|COMPLETED|00:30:00|00:15:00|2G|0|0|||
+1003|FAILED|00:01:00|00:00:30||||16G|1|1
+9999|COMPLETED|00:01:00|00:00:30||||16G|1|1
+"""
+
+
+def test_parse_usage():
+    usage = parse_usage(SACCT_OUTPUT, set(['1001', '1002_0', '1003']))
+    assert sorted(usage) == ['1001', '1002_0', '1003']
+    assert usage['1001']['cpus'] == 4
+    assert usage['1001']['reqmem'] == 16000 * 1024
+    assert usage['1001']['maxrss'] == 4 * 1024 ** 2
+    assert usage['1001']['disk_write'] == 200 * 1024
+    assert usage['1001']['cpu_efficiency'] == 0.5
+    assert usage['1002_0']['reqmem'] == 8 * 1024 ** 2
+    assert usage['1002_0']['mem_efficiency'] == 0.25
+    assert parse_reqmem('') is None
+
+    report = accounting_report(usage, {'1001': [0], '1002_0': [1], '1003': [2]},
+                               [['01'], ['02'], ['03']], app='mriqc-0.9.0')
+    summary = report['summary']
+    assert summary['completed'] == 2
+    assert summary['core_hours'] == 5.0
+    assert summary['suggested_mincpus'] == 3
+    assert summary['suggested_mem_per_cpu'] == 1639
+    assert [task['participants'] for task in report['tasks']] == [['01'], ['02'], ['03']]
+
+
+def test_chunks():
+    assert chunks(list(range(5)), 2) == [[0, 1], [2, 3], [4]]
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+import asyncio
+import subprocess as sp
+
+import mock
+import pytest
+
+from cappat.manager import TaskManager
+from cappat.manager.aio import AsyncTaskManager
+from cappat.benchmarks.fakeslurm import FakeSlurm
+from cappat.benchmarks.taskmanager import BENCH_SETTINGS
+
+
+def _async_manager(tmpdir, ntasks, settings=None, **fake_args):
+    bench_settings = BENCH_SETTINGS.copy()
+    bench_settings.update(settings or {})
+    tasks = ['true --participant_label %02d' % i for i in range(ntasks)]
+    stm = TaskManager.build(tasks, bench_settings, work_dir=str(tmpdir))
+    amgr = AsyncTaskManager(stm)
+    fake = FakeSlurm(**fake_args)
+
+    async def _run_cmd(cmd, timeout=None):
+        return fake.run(cmd)
+
+    amgr._run_cmd = _run_cmd
+    return amgr, fake
+
+
+def test_async_completions(tmpdir):
+    amgr, fake = _async_manager(tmpdir, 4, runtime=0.1, seed=0)
+
+    async def _main():
+        await amgr.map_participant()
+        return [event async for event in amgr.completions()]
+
+    events = asyncio.run(_main())
+    assert sorted(jobid for jobid, _, _ in events) == amgr.job_ids
+    assert all(state == 'COMPLETED' for _, state, _ in events)
+    assert sorted(label for _, _, labels in events for label in labels) == [
+        '00', '01', '02', '03']
+    assert fake.calls['sbatch'] == 4
+
+
+def test_async_fail_and_cancel(tmpdir):
+    amgr, _ = _async_manager(tmpdir, 2, runtime=0.1, failure_rate=1.0, seed=0)
+
+    async def _fail():
+        await amgr.map_participant()
+        await amgr.wait_participant()
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(_fail())
+
+    amgr, fake = _async_manager(tmpdir, 2, runtime=60, seed=0)
+
+    async def _cancel():
+        await amgr.map_participant()
+        waiter = asyncio.ensure_future(amgr.wait_participant())
+        await asyncio.sleep(0.2)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+
+    asyncio.run(_cancel())
+    assert fake.calls['scancel'] == 1
+    assert set(amgr.manager.jobs.values()) == {'CANCELLED'}
+
+
+def test_async_throttling(tmpdir):
+    amgr, fake = _async_manager(tmpdir, 3, settings={'submit_rate': 1000},
+                                runtime=0.1, seed=0)
+    with mock.patch.object(amgr.manager._rate_limiter, 'acquire') as acquire:
+        asyncio.run(amgr.map_participant())
+    # Every submission goes through the rate limiter of the manager
+    assert acquire.call_count == fake.calls['sbatch'] == 3
+
+    amgr = AsyncTaskManager(amgr.manager)
+    with pytest.raises(RuntimeError):
+        asyncio.run(amgr._run_cmd(['sleep', '5'], timeout=0.2))
+
+
+def test_async_grouplevel(tmpdir):
+    amgr, _ = _async_manager(tmpdir, 1, settings={'group_output_bytes': 1024})
+    manager = amgr.manager
+    group_log = tmpdir.join('log', 'group-wrapper.log')
+    script = tmpdir.join('group.sh')
+    # A long output with no line breaks but carriage returns
+    script.write('for i in $(seq 1 20000); do printf "progress %d\\r" $i; done\n'
+                 'head -c 200000 /dev/zero | tr "\\0" x\n'
+                 'exit 2\n')
+    with mock.patch.object(manager, '_final_group_cmdline', return_value='group'), \
+            mock.patch.object(manager, '_write_group_wrapper', return_value=str(script)):
+        with pytest.raises(sp.CalledProcessError) as excinfo:
+            asyncio.run(amgr.run_grouplevel())
+    lines = excinfo.value.output.split('\n')
+    assert lines[0] == 'progress 1'
+    assert lines[-1] == 'x' * 1024
+    assert len(excinfo.value.output) < 10 * 1024
+    assert group_log.size() > 200000
+
+    script.write('sleep 30\n')
+    with mock.patch.object(manager, '_final_group_cmdline', return_value='group'), \
+            mock.patch.object(manager, '_write_group_wrapper', return_value=str(script)):
+        manager._settings['group_timeout'] = 0.5
+        with pytest.raises(RuntimeError):
+            asyncio.run(amgr.run_grouplevel())
@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+from cappat.benchmarks.taskmanager import run_benchmark
+
+
+def test_fakeslurm_workflow(tmpdir):
+    results = run_benchmark(20, work_dir=str(tmpdir), runtime=0.1, seed=0)
+    assert not results['failed']
+    assert results['jobs'] == 20
+    assert results['calls']['sbatch'] == 20
+    assert results['polls'] == results['calls']['squeue']
+
+    results = run_benchmark(20, settings={'array_jobs': True}, work_dir=str(tmpdir),
+                            runtime=0.1, failure_rate=1.0, seed=0)
+    assert results['failed']
+    assert results['jobs'] == 20
+    assert results['calls']['sbatch'] == 1
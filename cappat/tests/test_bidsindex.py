@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+import os
+from multiprocessing.pool import ThreadPool
+
+import mock
+
+from cappat.bidsindex import BIDSIndex
+
+
+def test_bids_index(tmpdir):
+    bids_dir = tmpdir.mkdir('bids')
+    bids_dir.join('dataset_description.json').write('{}')
+    anat = bids_dir.mkdir('sub-01').mkdir('ses-pre').mkdir('anat')
+    anat.join('sub-01_ses-pre_T1w.nii.gz').write('x' * 100)
+    bids_dir.join('sub-01').mkdir('ses-post').mkdir('anat').join(
+        'sub-01_ses-post_T1w.nii.gz').write('x' * 50)
+    bids_dir.mkdir('sub-02').mkdir('anat').join('sub-02_T1w.nii.gz').write('x' * 10)
+    bids_dir.mkdir('sub-03')
+    cache_file = os.path.join(str(tmpdir), 'index.json')
+
+    index = BIDSIndex(str(bids_dir), cache_file=cache_file).build()
+    assert sorted(index.subjects) == ['01', '02', '03']
+    assert index.sessions('01') == ['post', 'pre']
+    assert index.sessions('02') == []
+    assert index.sizes(['01', '02']) == {'01': 150, '02': 10}
+    assert index.subjects['01']['nfiles'] == 2
+    assert index.empty() == ['03']
+    assert index.rescanned == ['01', '02', '03']
+
+    # A second build reuses the cache
+    index = BIDSIndex(str(bids_dir), cache_file=cache_file).build()
+    assert index.rescanned == []
+    assert index.sizes() == {'01': 150, '02': 10, '03': 0}
+
+    # Only the modified subject is walked again
+    anat.join('sub-01_ses-pre_T2w.nii.gz').write('x' * 20)
+    os.utime(str(anat), (0, 1))
+    index = BIDSIndex(str(bids_dir), cache_file=cache_file).build()
+    assert index.rescanned == ['01']
+    assert index.sizes(['01']) == {'01': 170}
+
+    # The default cache goes to cache_dir
+    cache_dir = os.path.join(str(tmpdir), 'cache')
+    index = BIDSIndex(str(bids_dir), cache_dir=cache_dir).build()
+    assert os.path.dirname(index.cache_file) == cache_dir
+    assert os.path.isfile(index.cache_file)
+
+
+def test_bids_index_shared_cache(tmpdir):
+    bids_dir = tmpdir.mkdir('bids')
+    for label in range(10):
+        bids_dir.mkdir('sub-%02d' % label).mkdir('anat').join('T1w.nii.gz').write('x')
+    cache_file = os.path.join(str(tmpdir), 'index.json')
+
+    # Concurrent runs sharing the cache do not clobber each other's writes
+    def _build(_):
+        return sorted(BIDSIndex(str(bids_dir), cache_file=cache_file).build().subjects)
+
+    pool = ThreadPool(8)
+    with mock.patch('cappat.bidsindex.wlogger') as wlogger:
+        results = pool.map(_build, range(64))
+    pool.close()
+    assert all(subjects == results[0] for subjects in results)
+    assert not wlogger.warning.called
+    assert sorted(os.listdir(str(tmpdir))) == ['bids', 'index.json']
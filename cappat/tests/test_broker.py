@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+import os
+from time import sleep, time
+
+import mock
+import pytest
+
+from cappat.manager import TaskManager
+from cappat.manager.broker import StatusBroker
+from cappat.benchmarks.fakeslurm import FakeSlurm
+from cappat.benchmarks.taskmanager import BENCH_SETTINGS
+
+
+def test_status_broker(tmpdir):
+    settings = BENCH_SETTINGS.copy()
+    settings.update({'status_broker': True, 'poll_min_seconds': 0.5,
+                     'status_broker_file': os.path.join(str(tmpdir), 'squeue.json')})
+    fake = FakeSlurm(runtime=0.2, seed=0)
+
+    managers = []
+    for i in range(3):
+        tasks = ['true --participant_label %02d' % j for j in range(2)]
+        stm = TaskManager.build(tasks, settings,
+                                work_dir=os.path.join(str(tmpdir), 'run-%d' % i))
+        stm._run_scheduler = fake.run
+        stm.map_participant()
+        managers.append(stm)
+
+    # One squeue for the three workflows
+    assert not any([stm._get_jobs_status() for stm in managers])
+    assert fake.calls['squeue'] == 1
+
+    # A workflow that submitted after the snapshot refreshes it
+    managers[0]._last_submit = time()
+    managers[0]._get_jobs_status()
+    assert fake.calls['squeue'] == 2
+
+    sleep(0.5)
+    assert all([stm._get_jobs_status() for stm in managers])
+    assert fake.calls['squeue'] == 3
+
+
+def test_status_broker_folder(tmpdir):
+    with mock.patch('cappat.manager.broker.gettempdir', return_value=str(tmpdir)):
+        broker = StatusBroker(user='someone', system='sherlock')
+        folder = tmpdir.join('cappat-someone')
+        assert broker.cache_file == str(folder.join('squeue-sherlock.json'))
+        assert folder.stat().mode & 0o777 == 0o700
+
+        # A folder others can write to is refused
+        folder.chmod(0o777)
+        with pytest.raises(RuntimeError):
+            StatusBroker(user='someone', system='sherlock')
+
+        folder.chmod(0o700)
+        with mock.patch('cappat.manager.broker.os.getuid', return_value=os.getuid() + 1):
+            with pytest.raises(RuntimeError):
+                StatusBroker(user='someone', system='sherlock')
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+import pytest
+
+from cappat.bulk import BulkRegistration, read_manifest
+from cappat.benchmarks.fakeagave import FakeAgave
+
+MANIFEST = """\
+defaults:
+  participant_args: --nthreads 4
+apps:
+  - name: fmriprep-{system}
+    version: 1.0.0
+    image: %s
+    systems: [slurm-sherlock.stanford.edu, slurm-ls5.tacc.utexas.edu]
+  - name: mriqc-{system}
+    version: 0.9.6
+    image: %s
+    systems: [slurm-sherlock.stanford.edu]
+"""
+
+
+def test_bulk_registration(tmpdir):
+    images = []
+    for name in ['fmriprep.img', 'mriqc.img']:
+        images.append(str(tmpdir.join(name)))
+        with open(images[-1], 'wb') as ifh:
+            ifh.write(name.encode())
+    manifest = tmpdir.join('manifest.yml')
+    manifest.write(MANIFEST % tuple(images))
+
+    apps = read_manifest(str(manifest))
+    assert [desc['name'] for desc, _ in apps] == [
+        'fmriprep-slurm-sherlock', 'fmriprep-slurm-ls5', 'mriqc-slurm-sherlock']
+
+    agave = FakeAgave()
+    agave.apps.registered['mriqc-slurm-sherlock-0.9.6'] = {}
+    registration = BulkRegistration(agave, content_addressed=True,
+                                    state_file=str(tmpdir.join('transfers.json')),
+                                    index_file=str(tmpdir.join('images.json')))
+    status = registration.register(apps)
+    assert list(status.values()) == ['registered', 'registered', 'exists']
+    assert agave.calls['apps.list'] == 1
+    assert agave.calls['systems.get'] == 2
+    # The wrapper once, and the image once per image storage (plus digests)
+    assert agave.calls['files.importData'] == 3 * 2
+
+    with pytest.raises(RuntimeError):
+        registration.register(apps + apps[:1])
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+from cappat.manager import TaskManager
+from cappat.benchmarks.fakeslurm import FakeSlurm
+from cappat.benchmarks.taskmanager import BENCH_SETTINGS
+
+
+def test_federated(tmpdir):
+    tmpdir.chdir()
+    settings = BENCH_SETTINGS.copy()
+    # Tasks request 0.9 core-hours, "b" can run two of them
+    settings['federation'] = {'a': {'capacity': 2},
+                              'b': {'capacity': 1, 'allocation': 2}}
+    tasks = ['true --participant_label %02d' % i for i in range(6)]
+    stm = TaskManager.build(tasks, settings, work_dir=str(tmpdir))
+    fakes = {'a': FakeSlurm(runtime=0.1, backlog=4, first_jobid=1000, seed=0),
+             'b': FakeSlurm(runtime=0.1, first_jobid=5000, seed=0)}
+    for name, backend in list(stm.backends.items()):
+        backend._run_scheduler = fakes[name].run
+
+    # The plan does not look at the queues
+    plan = stm.plan(group=True)
+    assert plan['shards'] == {'a': 4, 'b': 2}
+    assert [job['backend'] for job in plan['jobs'] if job.get('group')] == ['a']
+    assert 'squeue' not in fakes['a'].calls
+
+    # "b" has an empty queue, but runs fewer jobs at once and has less allocation
+    stm.map_participant()
+    assert stm.shards == {'a': [2, 3, 4, 5], 'b': [0, 1]}
+    assert stm.job_ids == ['a:1000', 'a:1001', 'a:1002', 'a:1003', 'b:5000', 'b:5001']
+
+    assert stm.wait_participant() == stm.job_ids
+    assert stm.status() == {'a': {'COMPLETED': 4}, 'b': {'COMPLETED': 2}}
+    assert sorted(stm.get_job_usage()) == sorted(stm.job_ids)
+    assert sorted(stm.job_tasks.values()) == [[i] for i in range(6)]
+
+    # The group level runs where most outputs are
+    assert stm.run_grouplevel()
+    assert stm.group_job == 'a:1004'
+    assert fakes['b'].calls['sbatch'] == 2
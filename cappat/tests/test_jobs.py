@@ -5,7 +5,7 @@
 
 import os
 import mock
-# import pytest
+import pytest
 from cappat.manager import TaskManager
 from cappat.manager.tools import format_modules as _format_modules
 
@@ -64,3 +64,290 @@ def test_job_fail():
                                  work_dir=os.path.expanduser('~/scratch/slurm-3'))
     slurm.map_participant()
     slurm.wait_participant()
+
+def test_job_array():
+    tasks = ['echo "Submitted batch job 49533"',
+             'echo "Submitted batch job 49534"',
+             'echo "Submitted batch job 49535"']
+    settings = JOB_SETTINGS.copy()
+    settings['array_jobs'] = True
+    settings['array_max_size'] = 2
+    slurm = TaskManager.build(tasks, settings,
+                                 work_dir=os.path.expanduser('~/scratch/slurm-4'))
+    slurm.map_participant()
+    assert slurm.job_ids == ['49533_0', '49533_1', '49535_0']
+    assert slurm.query_ids == ['49533', '49535']
+    assert len(slurm.wait_participant()) == 3
+
+def test_job_array_subset():
+    tasks = ['echo "Submitted batch job %d"' % jobid for jobid in range(49533, 49538)]
+    settings = JOB_SETTINGS.copy()
+    settings['array_jobs'] = True
+    slurm = TaskManager.build(tasks, settings,
+                              work_dir=os.path.expanduser('~/scratch/slurm-12'))
+    slurm.map_participant(task_indices=[1, 3, 4])
+    # One array for the subset, its task ids are offset from the first task
+    with open(os.path.join(slurm.aux_dir, 'slurm-array-000001.sbatch')) as sfh:
+        assert '#SBATCH --array=0,2-3\n' in sfh.read()
+    assert slurm.job_ids == ['49534_0', '49534_2', '49534_3']
+    assert slurm.job_tasks == {'49534_0': [1], '49534_2': [3], '49534_3': [4]}
+
+@mock.patch('cappat.manager.slurm.TestSubmission._get_jobs_status',
+            mock.Mock(return_value=False))
+def test_job_sentinel():
+    tasks = ['echo "Submitted batch job 49533"',
+             'echo "Submitted batch job 49534"']
+    settings = JOB_SETTINGS.copy()
+    settings['watcher'] = 'sentinel'
+    slurm = TaskManager.build(tasks, settings,
+                                 work_dir=os.path.expanduser('~/scratch/slurm-5'))
+    slurm.map_participant()
+    assert sorted(os.listdir(slurm.sentinel_dir)) == ['task-000000.exit',
+                                                      'task-000001.exit']
+    assert len(slurm.wait_participant()) == 2
+
+@mock.patch('cappat.manager.slurm.TestSubmission._get_jobs_status',
+            mock.Mock(return_value=False))
+def test_job_sentinel_subset(tmpdir):
+    tasks = ['echo "Submitted batch job %d"' % jobid for jobid in range(49533, 49536)]
+    settings = JOB_SETTINGS.copy()
+    settings['watcher'] = 'sentinel'
+    slurm = TaskManager.build(tasks, settings, work_dir=str(tmpdir))
+    slurm.map_participant(task_indices=[1])
+    # Completion is reached with the sentinels of the submitted tasks only
+    assert os.listdir(slurm.sentinel_dir) == ['task-000001.exit']
+    assert slurm._get_watcher().poll()
+
+def test_watcher_backoff():
+    settings = JOB_SETTINGS.copy()
+    settings['max_runtime'] = '02:00:00'
+    slurm = TaskManager.build(['echo "Submitted batch job 49533"'], settings)
+    intervals = slurm._get_watcher().intervals()
+    sleeps = [next(intervals) for _ in range(10)]
+    assert sleeps[0] == 5.0
+    assert sleeps == sorted(sleeps)
+    # 90% of 2h, polled 100 times
+    assert sleeps[-1] == 64.8
+
+def test_job_concurrent():
+    tasks = ['echo "Submitted batch job %d"' % jobid for jobid in range(49533, 49543)]
+    settings = JOB_SETTINGS.copy()
+    settings['submit_concurrency'] = 4
+    settings['submit_rate'] = 1000
+    slurm = TaskManager.build(tasks, settings,
+                                 work_dir=os.path.expanduser('~/scratch/slurm-6'))
+    slurm.map_participant()
+    assert slurm.job_ids == ['%d' % jobid for jobid in range(49533, 49543)]
+
+def test_job_concurrent_error():
+    from subprocess import CalledProcessError
+    tasks = ['echo "Submitted batch job %d"' % jobid for jobid in range(49533, 49537)]
+    settings = JOB_SETTINGS.copy()
+    settings['submit_concurrency'] = 4
+    slurm = TaskManager.build(tasks, settings,
+                              work_dir=os.path.expanduser('~/scratch/slurm-11'))
+
+    def submit(task):
+        if task.endswith('slurm-000001.sbatch'):
+            raise CalledProcessError(1, 'sbatch', 'sbatch: error: Invalid account')
+        return 'Submitted batch job %d' % (49533 + int(task[-13:-7]))
+
+    with mock.patch.object(slurm, '_submit_sbatch', side_effect=submit):
+        with pytest.raises(CalledProcessError):
+            slurm.map_participant()
+    # The jobs submitted before the error are still tracked
+    assert slurm.job_ids == ['49533', '49535', '49536']
+
+@mock.patch('cappat.manager.base.SUBMIT_RETRY_SECONDS', 0)
+def test_job_submit_retry():
+    from subprocess import CalledProcessError
+    slurm = TaskManager.build(['echo "Submitted batch job 49533"'], JOB_SETTINGS,
+                              work_dir=os.path.expanduser('~/scratch/slurm-7'))
+    submit = mock.Mock(side_effect=[
+        CalledProcessError(1, 'sbatch', 'sbatch: error: Socket timed out on send/recv'),
+        'Submitted batch job 49533'])
+    with mock.patch.object(slurm, '_submit_sbatch', submit):
+        slurm.map_participant()
+    assert submit.call_count == 2
+    assert slurm.job_ids == ['49533']
+
+def test_launcher_packing():
+    tasks = ['testapp participant --participant_label %02d' % i for i in range(10)]
+    settings = JOB_SETTINGS.copy()
+    settings.update({'execution_system': 'slurm-ls5.tacc.utexas.edu',
+                     'ncpus': 24, 'memory_per_node': 64,
+                     'task_cpus': 4, 'task_memory': 8})
+    launcher = TaskManager.build(tasks, settings,
+                                 work_dir=os.path.expanduser('~/scratch/launcher-1'))
+    with open(launcher._generate_sbatch()[0]) as sfh:
+        sbatch = sfh.read()
+    assert '#SBATCH -N 2\n' in sbatch
+    assert '#SBATCH --tasks-per-node=5\n' in sbatch
+    assert 'export OMP_NUM_THREADS=4\n' in sbatch
+
+def test_launcher_waves():
+    # 40 nodes x 6 tasks do not fit 500 tasks at once: 3 launcher jobs
+    tasks = ['testapp participant --participant_label %03d' % i for i in range(500)]
+    settings = JOB_SETTINGS.copy()
+    settings.update({'execution_system': 'slurm-ls5.tacc.utexas.edu',
+                     'ncpus': 24, 'task_cpus': 4})
+    launcher = TaskManager.build(tasks, settings,
+                                 work_dir=os.path.expanduser('~/scratch/launcher-2'))
+    batch_files = launcher._generate_sbatch()
+    assert [os.path.basename(f) for f in batch_files] == [
+        'launcher-000.sbatch', 'launcher-001.sbatch', 'launcher-002.sbatch']
+    assert [len(launcher._sbatch_tasks[f]) for f in batch_files] == [240, 240, 20]
+    assert sum(launcher._sbatch_tasks.values(), []) == list(range(500))
+    with open(batch_files[0]) as sfh:
+        assert '#SBATCH -N 40\n' in sfh.read()
+    with open(batch_files[-1]) as sfh:
+        assert '#SBATCH -N 4\n' in sfh.read()
+    with open(os.path.join(launcher.aux_dir, 'tasks_list-002.sh')) as tfh:
+        assert len(tfh.read().splitlines()) == 20
+
+@mock.patch('cappat.manager.slurm.TestSubmission._run_sacct',
+            mock.Mock(side_effect=['49533   TIMEOUT   0:0\n49534   COMPLETED   0:0',
+                                   '49533   COMPLETED   0:0',
+                                   '49533   COMPLETED   0:0\n49534   COMPLETED   0:0']))
+def test_job_retry():
+    tasks = ['echo "Submitted batch job 49533"',
+             'echo "Submitted batch job 49534"']
+    settings = JOB_SETTINGS.copy()
+    settings['retry'] = True
+    settings['poll_min_seconds'] = 0.1
+    slurm = TaskManager.build(tasks, settings,
+                                 work_dir=os.path.expanduser('~/scratch/slurm-8'))
+    slurm.map_participant()
+    assert slurm.wait_participant() == ['49534', '49533']
+    assert slurm.retries == [('49533', 'TIMEOUT')]
+    # The resubmitted task got a longer walltime, up to max_runtime
+    with open(os.path.join(slurm.aux_dir, 'slurm-000000-1.sbatch')) as sfh:
+        assert '#SBATCH -t 00:05:00' in sfh.read()
+
+@mock.patch('cappat.manager.slurm.TestSubmission._run_sacct',
+            mock.Mock(side_effect=['49533   NODE_FAIL   0:0',
+                                   '49533   COMPLETED   0:0',
+                                   '49533   COMPLETED   0:0']))
+def test_job_retry_same_settings():
+    settings = JOB_SETTINGS.copy()
+    settings['retry'] = True
+    settings['poll_min_seconds'] = 0.1
+    slurm = TaskManager.build(['echo "Submitted batch job 49533"'], settings,
+                              work_dir=os.path.expanduser('~/scratch/slurm-13'))
+    slurm.map_participant()
+    assert slurm.wait_participant() == ['49533']
+    assert slurm.retries == [('49533', 'NODE_FAIL')]
+    # Retries without new settings do not overwrite the original sbatch file
+    assert sorted(os.path.basename(f) for f in slurm._sbatch_tasks) == [
+        'slurm-000000-1.sbatch', 'slurm-000000.sbatch']
+
+def test_group_incremental(tmpdir):
+    tmpdir.chdir()
+    tasks = ['echo "Submitted batch job 49533" --participant_label 01',
+             'echo "Submitted batch job 49534" --participant_label 02',
+             'echo "Submitted batch job 49535" --participant_label 03']
+    settings = JOB_SETTINGS.copy()
+    settings['executable'] = 'echo "Submitted batch job 49600"'
+    slurm = TaskManager.build(tasks, settings, work_dir=str(tmpdir))
+    incremental = slurm.stream_grouplevel(2)
+    slurm.map_participant()
+    slurm.wait_participant()
+    assert incremental.nupdates == 1
+    # Partial updates are batch jobs
+    assert incremental.jobs == ['49600']
+    with open(os.path.join(slurm.aux_dir, 'group-001.sbatch')) as sfh:
+        assert '--participant_label 01 02 03' in sfh.read()
+    # All participants finished in the same poll and were aggregated together
+    assert slurm.run_grouplevel()
+    assert incremental.aggregated == ['01', '02', '03']
+    assert not os.path.exists('group-wrapper.sh')
+
+    # Failed updates are retried once, then left to the final step
+    slurm = TaskManager.build(tasks, settings, work_dir=str(tmpdir))
+    incremental = slurm.stream_grouplevel(2)
+    with mock.patch.object(slurm, '_final_state', return_value=('FAILED', 1)):
+        incremental(['01', '02'])
+        for _ in range(3):
+            incremental([])
+    assert incremental.nupdates == 2
+    assert incremental.finish() == ['01', '02']
+
+    # Not enough participants for a partial update: the final step takes them all
+    slurm = TaskManager.build(tasks, settings, work_dir=str(tmpdir))
+    incremental = slurm.stream_grouplevel(4)
+    slurm.map_participant()
+    slurm.wait_participant()
+    assert slurm.run_grouplevel()
+    assert incremental.nupdates == 0
+    with open('group-wrapper.sh') as gfh:
+        assert '--participant_label 01 02 03' in gfh.read()
+
+def test_group_submit(tmpdir):
+    tmpdir.chdir()
+    tasks = ['echo "Submitted batch job 49533"',
+             'echo "Submitted batch job 49534"']
+    settings = JOB_SETTINGS.copy()
+    settings['executable'] = 'echo "Submitted batch job 49600"'
+    settings['group_runtime'] = '00:30:00'
+    slurm = TaskManager.build(tasks, settings, work_dir=str(tmpdir))
+    slurm.map_participant()
+    assert slurm.submit_grouplevel(after_participants=True) == '49600'
+    with open(os.path.join(slurm.aux_dir, 'group.sbatch')) as sfh:
+        sbatch = sfh.read()
+    assert '#SBATCH --dependency=afterok:49533:49534' in sbatch
+    assert '#SBATCH -t 00:30:00' in sbatch
+    assert slurm.wait_grouplevel()
+
+def test_plan(tmpdir):
+    tmpdir.chdir()
+    tasks = ['testapp participant --participant_label %02d' % i for i in range(5)]
+    settings = JOB_SETTINGS.copy()
+    settings.update({'execution_system': 'slurm-sherlock.stanford.edu',
+                     'array_jobs': True, 'array_max_size': 3, 'mincpus': 4,
+                     'group_runtime': '01:00:00'})
+    slurm = TaskManager.build(tasks, settings, work_dir=str(tmpdir))
+    with mock.patch.object(slurm, '_run_scheduler') as run:
+        plan = slurm.plan(group=True)
+    assert not run.called
+    assert plan['submissions'] == 3
+    assert plan['scheduler_jobs'] == 6
+    assert [job['tasks'] for job in plan['jobs']] == [[0, 1, 2], [3, 4], None]
+    assert plan['jobs'][0]['walltime'] == '00:04:30'
+    assert plan['jobs'][0]['cpus'] == 4
+    # 5 array elements of 4.5 minutes and the group level, 1 hour
+    assert plan['core_hours'] == round(5 * 4 * 4.5 / 60, 2) + 4.0
+    assert plan['max_walltime'] == '01:00:00'
+    assert '#SBATCH --array=0-1' in plan['jobs'][1]['script']
+    # Nothing was written to disk
+    assert not any(os.path.exists(job['sbatch']) for job in plan['jobs'])
+    assert not os.path.exists(os.path.join(slurm.aux_dir, 'tasks_list.sh'))
+
+def test_plan_launcher_waves(tmpdir):
+    tmpdir.chdir()
+    tasks = ['testapp participant --participant_label %03d' % i for i in range(500)]
+    settings = JOB_SETTINGS.copy()
+    settings.update({'execution_system': 'slurm-ls5.tacc.utexas.edu',
+                     'ncpus': 24, 'task_cpus': 4})
+    launcher = TaskManager.build(tasks, settings, work_dir=str(tmpdir))
+    plan = launcher.plan()
+    # One launcher job per wave of 40 nodes x 6 tasks
+    assert plan['submissions'] == 3
+    assert [job['nodes'] for job in plan['jobs']] == [40, 40, 4]
+    assert [len(job['tasks']) for job in plan['jobs']] == [240, 240, 20]
+    assert plan['max_walltime'] == '00:04:30'
+    assert plan['core_hours'] == round(84 * 24 * 4.5 / 60, 2)
+    assert os.listdir(launcher.aux_dir) == []
+
+@mock.patch('cappat.manager.slurm.TestSubmission._run_sacct',
+            mock.Mock(return_value='49533|NODE_FAIL|0:0'))
+def test_job_fail_no_exit_code():
+    tasks = ['echo "Submitted batch job 49533"']
+    for retry in [{}, {'retry': True, 'retry_max_attempts': 0}]:
+        settings = JOB_SETTINGS.copy()
+        settings.update(retry)
+        slurm = TaskManager.build(tasks, settings,
+                                  work_dir=os.path.expanduser('~/scratch/slurm-10'))
+        slurm.map_participant()
+        with pytest.raises(RuntimeError):
+            slurm.wait_participant()
+        assert slurm.jobs['49533'] == 'NODE_FAIL'
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+import os
+import mock
+from cappat import manifest as cm
+from cappat.manifest import RunManifest, settings_digest
+
+
+def test_manifest_resume(tmpdir):
+    out_dir = tmpdir.mkdir('out')
+    out_dir.mkdir('sub-01').join('report.html').write('subject 01')
+    out_dir.join('sub-02_T1w.html').write('subject 02')
+    manifest_file = os.path.join(str(tmpdir), 'manifest.json')
+    digest = settings_digest({'executable': 'mriqc', 'bids_dir': '/data'})
+
+    manifest = RunManifest(manifest_file, digest)
+    manifest.update({'01': 'COMPLETED', '02': 'COMPLETED', '03': 'FAILED',
+                     '05': 'COMPLETED'}, str(out_dir))
+
+    # Participants without outputs are processed again
+    manifest = RunManifest(manifest_file, digest)
+    assert manifest.completed(['01', '02', '03', '04', '05'], str(out_dir)) == ['01', '02']
+
+    # Unchanged outputs are not hashed again
+    with mock.patch.object(cm, 'file_checksum', side_effect=cm.file_checksum) as checksum:
+        manifest.update({'01': 'COMPLETED', '02': 'COMPLETED'}, str(out_dir))
+        assert manifest.completed(['01', '02'], str(out_dir)) == ['01', '02']
+    assert checksum.call_count == 0
+
+    # Touched outputs are hashed once, their new time is recorded
+    os.utime(str(out_dir.join('sub-02_T1w.html')), (0, 1))
+    with mock.patch.object(cm, 'file_checksum', side_effect=cm.file_checksum) as checksum:
+        assert manifest.completed(['01', '02'], str(out_dir)) == ['01', '02']
+        manifest = RunManifest(manifest_file, digest)
+        assert manifest.completed(['01', '02'], str(out_dir)) == ['01', '02']
+    assert checksum.call_count == 1
+
+    # Modified outputs must be recomputed
+    out_dir.join('sub-02_T1w.html').write('corrupted')
+    assert manifest.completed(['01', '02'], str(out_dir)) == ['01']
+
+    # Changing the settings invalidates the manifest
+    other = RunManifest(manifest_file, settings_digest({'executable': 'fmriprep'}))
+    assert other.completed(['01', '02'], str(out_dir)) == []
@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+import json
+from cappat.metrics import Metrics
+
+
+def test_metrics(tmpdir):
+    metrics = Metrics()
+    with metrics.timer('scheduler.sbatch'):
+        pass
+    metrics.observe('scheduler.sbatch', 2.0)
+    metrics.observe('job_runtime', 30.0, jobid='1234')
+    metrics.incr('jobs', 3)
+    assert metrics.timers['scheduler.sbatch']['count'] == 2
+    assert metrics.timers['scheduler.sbatch']['max'] == 2.0
+
+    jsonl = str(tmpdir.join('metrics.jsonl'))
+    metrics.write_jsonl(jsonl)
+    with open(jsonl) as mfh:
+        records = [json.loads(line) for line in mfh]
+    assert records[2] == dict(records[2], metric='job_runtime', jobid='1234')
+    assert records[-1] == {'metric': 'jobs', 'summary': True, 'value': 3}
+
+    textfile = str(tmpdir.join('cappat.prom'))
+    metrics.write_prometheus(textfile)
+    with open(textfile) as mfh:
+        prom = mfh.read()
+    assert 'cappat_scheduler_sbatch_seconds_count 2\n' in prom
+    assert 'cappat_jobs_total 3\n' in prom
+    assert 'job_runtime' in metrics.summary()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+from cappat.manager.parsers import (
+    StateTable, STATE_NAMES, TERMINAL, parse_squeue, parse_sacct, parse_sbatch)
+
+
+def test_parse_squeue():
+    output = '1000_1|R\n1000_[2-3,5%2]|PD\n1001|CD\n1002,CG\n1003|PDX\ngarbage\n'
+    states = [(jobid, STATE_NAMES[code]) for jobid, code in parse_squeue(output)]
+    assert states == [('1000_1', 'RUNNING'), ('1000_2', 'PENDING'), ('1000_3', 'PENDING'),
+                      ('1000_5', 'PENDING'), ('1001', 'COMPLETED'), ('1002', 'COMPLETING'),
+                      ('1003', 'UNKNOWN')]
+    # Completed jobs still listed by squeue are not pending
+    assert dict(parse_squeue(output))['1001'] in TERMINAL
+
+
+def test_parse_sacct():
+    output = ('1000_1|COMPLETED|0:0\n1000_1.batch|COMPLETED|0:0\n'
+              '1000_2|CANCELLED by 501|0:15\n1001|OUT_OF_MEMORY|0:125\n'
+              '1002      FAILED      2:0\n1003|COMPLETED|0:9\n1004|FAILED|0:9\n')
+    results = [(jobid, STATE_NAMES[code], exit_code)
+               for jobid, code, exit_code in parse_sacct(output)]
+    assert results == [('1000_1', 'COMPLETED', 0), ('1000_2', 'CANCELLED', 128),
+                       ('1001', 'OUT_OF_MEMORY', 1), ('1002', 'FAILED', 2),
+                       ('1003', 'COMPLETED', 0), ('1004', 'FAILED', 137)]
+    assert [jobid for jobid, _, _ in parse_sacct(output, steps=True)][:2] == [
+        '1000_1', '1000_1.batch']
+    # Jobs killed by the scheduler are failures even if they report 0:0
+    output = '1005|TIMEOUT|0:0\n1006|NODE_FAIL|0:0\n1007|RUNNING|0:0\n'
+    assert [exit_code for _, _, exit_code in parse_sacct(output)] == [1, 1, 0]
+
+
+def test_state_table():
+    table = StateTable()
+    table['1000'] = 'SUBMITTED'
+    table['1001'] = 'PD'
+    table['1002'] = 'CANCELLED by 501'
+    assert list(table.items()) == [('1000', 'SUBMITTED'), ('1001', 'PENDING'),
+                                   ('1002', 'CANCELLED')]
+    assert table.pop('1000') == 'SUBMITTED'
+    table['1000'] = 'COMPLETED'
+    assert list(table) == ['1001', '1002', '1000']
+    assert table.count('CANCELLED') == 1
+
+
+def test_parse_sbatch():
+    script = ('#!/bin/bash\n#  SBATCH -N 4 (commented out)\n#SBATCH -N 2\n'
+              '#SBATCH -t 02:00:00   # Run time\n#SBATCH --mincpus=8\n'
+              '#SBATCH --array=0-4,10-20:5%2\n\necho start\n#SBATCH -p ignored\n')
+    assert parse_sbatch(script) == {
+        'nodes': 2, 'time': '02:00:00', 'mincpus': 8, 'array': '0-4,10-20:5%2',
+        'array_size': 8}
+    # Cached requests are not shared
+    parse_sbatch(script)['nodes'] = 3
+    assert parse_sbatch(script)['nodes'] == 2
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+import os
+from cappat.runtimedb import RuntimeDB, walltime
+
+
+def test_runtimedb(tmpdir):
+    rdb = RuntimeDB(os.path.join(str(tmpdir), 'runtimes.sqlite'))
+    rdb.record('mriqc', '0.9.0', [
+        {'subject': '01', 'input_bytes': 1000, 'elapsed': 100., 'state': 'COMPLETED'},
+        {'subject': '02', 'input_bytes': 3000, 'elapsed': 300., 'state': 'COMPLETED'},
+        {'subject': '03', 'input_bytes': 3000, 'elapsed': 20., 'state': 'FAILED'},
+    ])
+
+    estimates = rdb.estimates('mriqc', '0.9.1', ['01', '03', '04'],
+                              sizes={'03': 2000})
+    assert estimates == {'01': 100., '03': 200., '04': None}
+
+    runs = [{'subject': '01', 'elapsed': 1000., 'state': 'COMPLETED'},
+            {'subject': '02', 'elapsed': 310., 'state': 'COMPLETED'}]
+    assert [run['subject'] for run in rdb.outliers('mriqc', '0.9.0', runs)] == ['01']
+    rdb.close()
+
+    assert walltime(None) is None
+    assert walltime(100.) == 600
+    assert walltime(1000.) == 1500
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+import json
+from time import time
+
+import mock
+
+from cappat.metrics import METRICS
+from cappat.session import AgaveSession, RequestException, save_session, load_session
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, result=None):
+        self.status_code = status_code
+        self._result = result
+        self.text = json.dumps(result)
+        self.content = self.text.encode()
+
+    def json(self):
+        return self._result
+
+
+class OfflineHTTP(object):
+    """The API server cannot be reached"""
+
+    def post(self, url, **kwargs):
+        raise RequestException('Connection refused')
+
+    def request(self, method, url, **kwargs):
+        raise RequestException('Connection refused')
+
+    def close(self):
+        pass
+
+
+class FakeHTTP(object):
+    """Accepts only the token ``valid``"""
+
+    def __init__(self):
+        self.requests = []
+
+    def post(self, url, data=None, auth=None):
+        self.requests.append(('POST', url))
+        return FakeResponse(200, {'access_token': 'valid', 'expires_in': 14400})
+
+    def request(self, method, url, headers=None, params=None, **kwargs):
+        self.requests.append((method, url))
+        if headers['Authorization'] != 'Bearer valid':
+            return FakeResponse(401, {'status': 'error'})
+        # Two items, listed from the offset on
+        offset = (params or {}).get('offset', 0)
+        return FakeResponse(200, {'status': 'success', 'result': [
+            {'name': name} for name in ['wrapper.sh', 'last.sh'][offset:]]})
+
+    def close(self):
+        pass
+
+
+def test_agave_session(tmpdir):
+    session_file = str(tmpdir.join('current'))
+    data = {'access_token': 'valid', 'refresh_token': 'refresh', 'apikey': 'key',
+            'apisecret': 'secret', 'baseurl': 'https://api.example.org',
+            'created_at': '%d' % time(), 'expires_in': '14400'}
+    save_session(data, session_file)
+
+    # A valid token is probed once, without refreshing
+    http = FakeHTTP()
+    METRICS.reset()
+    session = AgaveSession.from_cache(session_file, http=http)
+    assert http.requests == [('GET', 'https://api.example.org/profiles/v2/me')]
+    assert session.files.list(systemId='storage', filePath='apps')[0].name == 'wrapper.sh'
+    assert METRICS.timers['agave.files.list']['count'] == 1
+
+    # Expired tokens are refreshed, and cached
+    save_session(dict(data, access_token='old', created_at='%d' % (time() - 20000)),
+                 session_file)
+    http = FakeHTTP()
+    session = AgaveSession.from_cache(session_file, http=http)
+    assert session is not None
+    assert http.requests[0] == ('POST', 'https://api.example.org/token')
+    assert load_session(session_file)['access_token'] == 'valid'
+
+    # Revoked tokens are refreshed on the first rejected call
+    session.data['access_token'] = 'revoked'
+    assert session.apps.list()[0].name == 'wrapper.sh'
+    assert session.token == 'valid'
+
+    # Listings are read page by page
+    with mock.patch('cappat.session.FILES_PAGE', 1):
+        names = [item.name for item in session.files.list(systemId='storage', filePath='apps')]
+    assert names == ['wrapper.sh', 'last.sh']
+
+    # The password login is used when the API cannot be reached
+    assert AgaveSession.from_cache(session_file, http=OfflineHTTP()) is None
+    save_session(dict(data, created_at='%d' % (time() - 20000)), session_file)
+    assert AgaveSession.from_cache(session_file, http=OfflineHTTP()) is None
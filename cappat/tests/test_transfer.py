@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+import os
+import hashlib
+import pytest
+
+from cappat.transfer import Uploader, TransferState, ImageStore, file_digest
+from cappat.benchmarks.fakeagave import FakeAgave
+
+
+def test_file_digest(tmpdir):
+    fname = str(tmpdir.join('image.img'))
+    content = os.urandom(100000)
+    with open(fname, 'wb') as ifh:
+        ifh.write(content)
+    assert file_digest(fname, chunk_size=4096) == hashlib.sha256(content).hexdigest()
+
+
+def test_uploader(tmpdir):
+    images = []
+    for i in range(3):
+        images.append(str(tmpdir.join('image-%d.img' % i)))
+        with open(images[-1], 'wb') as ifh:
+            ifh.write(os.urandom(10000))
+
+    agave = FakeAgave()
+    state_file = str(tmpdir.join('transfers.json'))
+    uploader = Uploader(agave, state=TransferState(state_file), retries=0)
+    transfers = [{'fname': image, 'remote_path': 'images', 'system': 'images-sherlock',
+                  'overwrite': False} for image in images]
+    results = uploader.upload_many(transfers)
+    assert [result['status'] for result in results] == ['uploaded'] * 3
+    assert agave.calls['files.importData'] == 6
+
+    # Identical remote copies are not uploaded again
+    results = uploader.upload_many(transfers)
+    assert [result['status'] for result in results] == ['identical'] * 3
+    assert agave.calls['files.importData'] == 6
+
+    # An interrupted upload leaves a partial remote copy...
+    with open(images[0], 'ab') as ifh:
+        ifh.write(b'new version')
+    agave.files.fail_uploads = 1
+    with pytest.raises(IOError):
+        uploader.upload(**dict(transfers[0], overwrite=True))
+    assert len(agave.files.storage[('images-sherlock', 'images/image-0.img')]) < 10000
+
+    # ... that is replaced in the next attempt, even without overwrite
+    uploader = Uploader(agave, state=TransferState(state_file))
+    assert uploader.upload(**transfers[0])['status'] == 'uploaded'
+    with open(images[0], 'rb') as ifh:
+        assert agave.files.storage[('images-sherlock', 'images/image-0.img')] == ifh.read()
+    assert uploader.upload(**transfers[1])['status'] == 'identical'
+
+
+def test_image_store(tmpdir):
+    images = []
+    for name in ['fmriprep.img', 'fmriprep-copy.img']:
+        images.append(str(tmpdir.join(name)))
+        with open(images[-1], 'wb') as ifh:
+            ifh.write(b'singularity image')
+
+    agave = FakeAgave()
+    index_file = str(tmpdir.join('images.json'))
+    uploader = Uploader(agave, state=TransferState(str(tmpdir.join('transfers.json'))))
+    store = ImageStore(uploader, index_file=index_file)
+    first = store.put(images[0], 'images-sherlock')
+    assert first['status'] == 'uploaded'
+    assert first['remote'] == 'sha256-%s.img' % first['digest']
+
+    # Identical images are stored once, with only a listing to check them
+    ncalls = sum(agave.calls.values())
+    store = ImageStore(uploader, index_file=index_file)
+    second = store.put(images[1], 'images-sherlock')
+    assert second['status'] == 'reused'
+    assert second['remote'] == first['remote']
+    assert sum(agave.calls.values()) == ncalls + 1
+
+    # Images deleted from the remote system are uploaded again
+    agave.files.storage.pop(('images-sherlock', first['remote']))
+    assert store.put(images[1], 'images-sherlock')['status'] == 'uploaded'
+    assert store.put(images[1], 'images-sherlock')['status'] == 'reused'
+
+    # Other systems get their own copy
+    assert store.put(images[1], 'images-ls5')['status'] == 'uploaded'
@@ -3,8 +3,11 @@
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
 # vi: set ft=python sts=4 ts=4 sw=4 et:
 
+import sys
 import mock
+import pytest
 import cappat.manager.tools as cmt
+from cappat.utils import atomic_write
 
 
 @mock.patch('cappat.manager.tools.socket.gethostname',
@@ -24,3 +27,98 @@ def test_getsystemname():
 #     """Use monkeypatch to fake the env variable"""
 #     monkeypatch.setenv('AGAVE_EXECUTION_SYSTEM', 'test.local')
 #     assert cu.getsystemname() == 'test.local'
+
+
+@mock.patch('cappat.manager.tools.sp.call', mock.Mock(return_value=0))
+def test_ssh_transport():
+    transport = cmt.SSHTransport(['sshpass', '-p', 'pass', 'ssh', '-p', '10022',
+                                  'user@localhost'], control_dir='/tmp/cm')
+    assert transport.prefix == ['sshpass', '-p', 'pass', 'ssh', '-p', '10022',
+                                'user@localhost']
+    assert transport.open()
+    assert transport.prefix == [
+        'sshpass', '-p', 'pass', 'ssh', '-oControlMaster=no',
+        '-oControlPath=/tmp/cm/cm-%r@%h:%p', '-p', '10022', 'user@localhost']
+    transport.close()
+    assert not transport.is_open
+
+
+@pytest.mark.parametrize("ntasks,kwargs,expected", [
+    (10, {'task_cpus': 24}, (10, 1, 24)),
+    (60, {'task_cpus': 24}, (40, 1, 24)),
+    (10, {'node_memory': 64, 'task_cpus': 4, 'task_memory': 8}, (2, 5, 4)),
+    (10, {'node_memory': 64, 'task_cpus': 1, 'task_memory': 16}, (3, 4, 6)),
+    (100, {'task_cpus': 2}, (9, 12, 2)),
+])
+def test_pack_tasks(ntasks, kwargs, expected):
+    plan = cmt.pack_tasks(ntasks, 24, max_nodes=40, **kwargs)
+    assert (plan['nodes'], plan['tasks_per_node'], plan['cpus_per_task']) == expected
+
+
+def test_template_render_many(tmpdir):
+    from cappat.tpl import Template
+    from cappat.tpl.config import get_template
+    tpl_file = tmpdir.join('test.jnj2')
+    tpl_file.write('task {{ index }}\n')
+    paths = [str(tmpdir.join('out-%d.txt' % i)) for i in range(3)]
+    Template(str(tpl_file)).render_many(({'index': i} for i in range(3)), paths)
+    assert [open(path).read() for path in paths] == ['task 0', 'task 1', 'task 2']
+    # The compiled template is shared
+    assert get_template(str(tpl_file)) is get_template(str(tpl_file))
+
+
+def test_run_cmd_streaming(tmpdir):
+    log_file = str(tmpdir.join('cmd.log'))
+    jobids = []
+    output = cmt.run_cmd(
+        ['/bin/bash', '-c', 'for i in $(seq 1 1000); do echo "line $i"; done; '
+                            'echo "Submitted batch job 1234"'],
+        max_output=30, log_file=log_file,
+        on_line=lambda line: jobids.extend(line.split()[-1:] if 'Submitted' in line else []))
+    lines = output.split('\n')
+    assert lines[:2] == ['line 1', 'line 2']
+    assert lines[-1] == 'Submitted batch job 1234'
+    assert len(lines) < 1000
+    assert jobids == ['1234']
+    with open(log_file) as lfh:
+        assert len(lfh.read().splitlines()) == 1001
+
+    # Lines are kept in order once the head is full
+    assert cmt.run_cmd(['/bin/bash', '-c', 'echo one; echo threeeeeeeeeeee; echo ab'],
+                       max_output=10) == 'one\nthreeeeeee\nab'
+
+    with pytest.raises(RuntimeError):
+        cmt.run_cmd(['sleep', '5'], timeout=0.2)
+
+    with pytest.raises(cmt.sp.CalledProcessError):
+        cmt.run_cmd(['/bin/bash', '-c', 'echo failed; exit 3'])
+
+
+def test_run_cmd_no_newlines(tmpdir):
+    # Progress bars only write carriage returns
+    log_file = str(tmpdir.join('cmd.log'))
+    output = cmt.run_cmd(
+        [sys.executable, '-c', 'import sys\nfor i in range(200000): sys.stdout.write("progress %d\\r" % i)'],
+        max_output=1024, log_file=log_file)
+    lines = output.split('\n')
+    assert lines[0] == 'progress 0'
+    assert lines[-1] == 'progress 199999'
+    assert len(lines) <= cmt.RUN_CMD_TAIL_LINES + 200
+    assert tmpdir.join('cmd.log').size() > 2 * 1024 * 1024
+
+    # A single line with no break at all is cut
+    output = cmt.run_cmd([sys.executable, '-c', 'import sys; sys.stdout.write("x" * 10000000)'],
+                         max_output=1024)
+    assert output == 'x' * 1024
+
+
+def test_atomic_write(tmpdir):
+    target = tmpdir.join('state.json')
+    atomic_write(str(target), '{"a": 1}')
+    atomic_write(str(target), '{"a": 2}')
+    assert target.read() == '{"a": 2}'
+    assert tmpdir.listdir() == [target]
+
+    private = tmpdir.join('session.json')
+    atomic_write(str(private), 'secret', mode=0o600)
+    assert private.stat().mode & 0o777 == 0o600
@@ -66,3 +66,26 @@ def test_get_subject_list_part(data, participant_label, randomize, expected):
 ])
 def test_get_task_list(group_size, expected):
     assert cw.get_task_list('~/Data', 'testapp', ['10', '11', '12'], group_size=group_size) == expected
+
+
+def test_balance_groups():
+    weights = {'01': 10, '02': 9, '03': 8, '04': 2, '05': 1, '06': None}
+    groups = cw.balance_groups(sorted(weights), weights, 2)
+    # The subject without weight counts as the heaviest one
+    assert groups == [['02', '03'], ['01', '04'], ['06', '05']]
+
+    tasks = cw.get_task_list('~/Data', 'testapp', sorted(weights), group_size=3,
+                             weights=weights)
+    assert tasks == ['testapp ~/Data out/ participant --participant_label 01 02 05',
+                     'testapp ~/Data out/ participant --participant_label 03 04 06']
+
+
+def test_check_group_detach():
+    settings = {'level_plan': ['participant', 'group'], 'group_submit': True,
+                'group_detach': True}
+    cw.check_group_detach(settings)
+    with pytest.raises(RuntimeError):
+        cw.check_group_detach(dict(settings, resume=True))
+    # Without detaching, the run waits for the participants
+    cw.check_group_detach(dict(settings, resume=True, group_detach=False))
+    cw.check_group_detach(dict(settings, runtime_db='runtimes.sqlite'))
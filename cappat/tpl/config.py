@@ -8,25 +8,70 @@ Utilities: Jinja2 templates
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 from io import open
+from threading import Lock
+from builtins import object, zip
 
 import jinja2
 
+from cappat.metrics import METRICS
+
+# One environment and one compiled template per file for the whole process
+_ENV = jinja2.Environment(
+    loader=jinja2.FileSystemLoader(searchpath='/'),
+    trim_blocks=True, lstrip_blocks=True)
+_CACHE = {}
+_CACHE_LOCK = Lock()
+
+
+def get_template(template_str):
+    """Returns the compiled template, parsing the file only the first time"""
+    with _CACHE_LOCK:
+        template = _CACHE.get(template_str)
+        if template is None:
+            template = _CACHE[template_str] = _ENV.get_template(template_str)
+    return template
+
+
+def clear_cache():
+    """Drops all compiled templates (e.g. after editing a template file)"""
+    with _CACHE_LOCK:
+        _CACHE.clear()
+
+
 class Template(object):
     """
     Utility class for generating a config file from a jinja template.
     https://github.com/oesteban/endofday/blob/f2e79c625d648ef45b08cc1f11fd0bd84342d604/endofday/core/template.py
     """
-    def __init__(self, template_str):
+    def __init__(self, template_str, outputs=None):
         self.template_str = template_str
-        self.env = jinja2.Environment(
-            loader=jinja2.FileSystemLoader(searchpath='/'),
-            trim_blocks=True, lstrip_blocks=True)
+        self.env = _ENV
+        # If given, rendered files are stored here (by path) instead of written
+        self.outputs = outputs
 
     def compile(self, configs):
-        template = self.env.get_template(self.template_str)
+        template = get_template(self.template_str)
         return template.render(configs)
 
-    def generate_conf(self, configs, path):
-        output = self.compile(configs)
+    def _write(self, output, path):
+        if self.outputs is not None:
+            self.outputs[path] = output
+            return
         with open(path, 'w+') as output_file:
             output_file.write(output)
+
+    def generate_conf(self, configs, path):
+        with METRICS.timer('render', files=1):
+            self._write(self.compile(configs), path)
+
+    def render_many(self, settings_iter, paths):
+        """
+        Renders the template once per item of ``settings_iter`` into the
+        corresponding file of ``paths``
+        """
+        paths = list(paths)
+        with METRICS.timer('render', files=len(paths)):
+            template = get_template(self.template_str)
+            for configs, path in zip(settings_iter, paths):
+                self._write(template.render(configs), path)
+        return paths
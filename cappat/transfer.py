@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Transfers: checksummed, resumable and concurrent uploads to Agave storage
+systems.
+
+The Agave files API takes each file in one request, so files are streamed
+from disk (never loaded in memory) and several files are uploaded at once.
+The sha256 of every file is stored next to it (``<name>.sha256``): files
+whose remote copy is identical are not uploaded again, and a local state
+file keeps the uploads that were interrupted, so that their partial
+remote copies are replaced in the next attempt.
+
+Images can also be kept in a content-addressed store (``ImageStore``),
+where identical images are uploaded once per storage system.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import os.path as op
+import io
+import json
+import mmap
+import hashlib
+import logging
+from time import time
+from threading import Lock
+from multiprocessing.pool import ThreadPool
+from tempfile import mkstemp
+from builtins import object, range
+
+from cappat.utils import atomic_write, check_folder
+
+DIGEST_SUFFIX = '.sha256'
+# Bytes hashed at a time
+CHUNK_BYTES = 64 * 1024 * 1024
+TRANSFER_STATE_FILE = op.expanduser('~/.cappat/transfers.json')
+IMAGE_INDEX_FILE = op.expanduser('~/.cappat/images.json')
+
+logger = logging.getLogger('appgen')
+
+
+def file_digest(fname, chunk_size=CHUNK_BYTES):
+    """The sha256 of a file, read through mmap ``chunk_size`` bytes at a time"""
+    digest = hashlib.sha256()
+    size = op.getsize(fname)
+    if size:
+        with open(fname, 'rb') as dfh:
+            mapped = mmap.mmap(dfh.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for offset in range(0, size, chunk_size):
+                    digest.update(mapped[offset:offset + chunk_size])
+            finally:
+                mapped.close()
+    return digest.hexdigest()
+
+
+def run_concurrently(calls, concurrency=4):
+    """
+    Runs ``(function, kwargs)`` pairs, ``concurrency`` at a time, and
+    returns their results in order
+    """
+    if len(calls) < 2 or concurrency < 2:
+        return [func(**kwargs) for func, kwargs in calls]
+
+    pool = ThreadPool(min(concurrency, len(calls)))
+    try:
+        return pool.map(lambda call: call[0](**call[1]), calls)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _write_json(data, path):
+    check_folder(op.dirname(op.abspath(path)))
+    atomic_write(path, json.dumps(data, indent=2, sort_keys=True))
+
+
+def _read_json(path, default):
+    if path and op.isfile(path):
+        try:
+            with open(path) as jfh:
+                default.update(json.load(jfh))
+        except ValueError:
+            logger.warning('Ignoring corrupted file %s', path)
+    return default
+
+
+def _field(item, key):
+    """Agave responses are dictionaries with attribute access"""
+    value = getattr(item, key, None)
+    if value is None and isinstance(item, dict):
+        value = item.get(key)
+    return value
+
+
+class TransferState(object):
+    """
+    A JSON file with the digests of local files (indexed by path, size and
+    modification time) and the state of the uploads (``started`` or
+    ``done``), indexed by system and remote path
+    """
+
+    def __init__(self, state_file=TRANSFER_STATE_FILE):
+        self.state_file = state_file
+        self._lock = Lock()
+        self._state = _read_json(state_file, {'digests': {}, 'uploads': {}})
+
+    def _save(self):
+        if self.state_file:
+            _write_json(self._state, self.state_file)
+
+    def digest(self, fname, chunk_size=CHUNK_BYTES):
+        """The digest of a local file, computed only when it changed"""
+        fname = op.abspath(fname)
+        stat = os.stat(fname)
+        key = [stat.st_size, stat.st_mtime]
+        with self._lock:
+            cached = self._state['digests'].get(fname)
+        if cached is not None and cached[:2] == key:
+            return cached[2]
+
+        digest = file_digest(fname, chunk_size)
+        with self._lock:
+            self._state['digests'][fname] = key + [digest]
+            self._save()
+        return digest
+
+    def upload(self, system, remote):
+        with self._lock:
+            return self._state['uploads'].get('%s:%s' % (system, remote))
+
+    def set_upload(self, system, remote, **fields):
+        fields['time'] = time()
+        with self._lock:
+            self._state['uploads']['%s:%s' % (system, remote)] = fields
+            self._save()
+
+
+class Uploader(object):
+    """
+    Uploads files to Agave storage systems through ``agave`` (an authenticated
+    ``agavepy.agave.Agave`` client), ``concurrency`` files at a time
+    """
+
+    def __init__(self, agave, state=None, concurrency=4, chunk_size=CHUNK_BYTES,
+                 retries=2):
+        self.agave = agave
+        self.state = state if state is not None else TransferState()
+        self.concurrency = concurrency
+        self.chunk_size = chunk_size
+        self.retries = retries
+
+    def _mkdir(self, remote_path, system):
+        head_path, tail_path = op.split(remote_path)
+        if head_path and head_path != '/':
+            while head_path.endswith('/'):
+                head_path, tail = op.split(head_path)
+                tail_path = op.join(tail, tail_path)
+
+            # Make sure the folder exists
+            self.agave.files.manage(
+                systemId=system, filePath=head_path,
+                body={'action': 'mkdir', 'path': tail_path})
+            logger.info('Created/checked that "%s/" folder exists under "%s/"',
+                        tail_path, head_path)
+
+    def remote_files(self, remote_path, system):
+        """The files in a remote folder, and their size"""
+        return dict((_field(item, 'name'), _field(item, 'length'))
+                    for item in self.agave.files.list(systemId=system, filePath=remote_path))
+
+    def remote_digest(self, remote, system):
+        """The digest stored next to a remote file, if any"""
+        try:
+            content = self.agave.files.download(systemId=system,
+                                                filePath=remote + DIGEST_SUFFIX)
+        except Exception:  # pylint: disable=broad-except
+            return None
+        content = getattr(content, 'content', content)
+        if isinstance(content, bytes):
+            content = content.decode('utf-8', 'replace')
+        return ('%s' % content).strip().split(' ')[0] or None
+
+    def _import(self, fname, remote_path, remote_fname, system):
+        with open(fname, 'rb') as file_to_upload:
+            return self.agave.files.importData(
+                systemId=system, filePath=remote_path,
+                fileName=remote_fname, fileToUpload=file_to_upload)
+
+    def _upload_digest(self, digest, remote_path, remote_fname, system):
+        fdesc, digest_file = mkstemp(suffix=DIGEST_SUFFIX)
+        try:
+            with io.open(fdesc, 'w') as dfh:
+                dfh.write('%s  %s\n' % (digest, remote_fname))
+            self._import(digest_file, remote_path, remote_fname + DIGEST_SUFFIX, system)
+        finally:
+            os.remove(digest_file)
+
+    def upload(self, fname, remote_path, remote_fname=None, system='openfmri-storage',
+               overwrite=True):
+        """
+        Uploads one file, unless the remote copy is identical (or exists and
+        ``overwrite`` is not set). Remote copies of uploads that did not
+        finish are always replaced. Returns a dictionary with the
+        ``status`` (``uploaded``, ``identical`` or ``exists``), the remote
+        path and the digest of the file.
+        """
+        if remote_fname is None:
+            remote_fname = op.basename(fname)
+        remote = op.join(remote_path, remote_fname)
+        size = op.getsize(fname)
+        digest = self.state.digest(fname, self.chunk_size)
+        result = {'local': fname, 'remote': remote, 'system': system, 'digest': digest,
+                  'size': size}
+
+        self._mkdir(remote_path, system)
+        existing = self.remote_files(remote_path, system)
+        if remote_fname in existing:
+            previous = self.state.upload(system, remote) or {}
+            if previous.get('status') == 'started':
+                logger.warning('Remote file "%s" in "%s" is a partial upload, replacing it',
+                               remote, system)
+            elif (existing[remote_fname] in (None, size) and
+                  self.remote_digest(remote, system) == digest):
+                logger.info('Remote file "%s" in "%s" is identical to "%s", skipping...',
+                            remote, system, fname)
+                result['status'] = 'identical'
+                return result
+            elif not overwrite:
+                logger.warning(
+                    'Overwriting remote path "%s" in "%s" is not allowed, skipping...',
+                    remote, system)
+                result['status'] = 'exists'
+                return result
+            else:
+                logger.warning('Overwriting remote path "%s" in "%s"', remote, system)
+
+        logger.info('Uploading "%s" (%d bytes) to remote path "%s" in %s',
+                    fname, size, remote, system)
+        self.state.set_upload(system, remote, status='started', digest=digest, size=size)
+        for attempt in range(self.retries + 1):
+            try:
+                result['response'] = self._import(fname, remote_path, remote_fname, system)
+                break
+            except (IOError, OSError) as error:
+                if attempt == self.retries:
+                    raise
+                logger.warning('Upload of "%s" failed (%s), retrying (%d/%d)', fname,
+                               error, attempt + 1, self.retries)
+        self._upload_digest(digest, remote_path, remote_fname, system)
+        self.state.set_upload(system, remote, status='done', digest=digest, size=size)
+        result['status'] = 'uploaded'
+        return result
+
+    def upload_many(self, transfers):
+        """
+        Uploads several files at once. ``transfers`` is a list of
+        dictionaries with the arguments of ``upload``.
+        """
+        return run_concurrently([(self.upload, transfer) for transfer in transfers],
+                                self.concurrency)
+
+
+class ImageStore(object):
+    """
+    Content-addressed storage of images: images are uploaded once per
+    storage system, named after their digest (``sha256-<digest>.<ext>``),
+    and a local index (digest -> remote path, per system) lets later
+    registrations reuse them without any transfer, once a listing of
+    the remote folder shows they are still there
+    """
+
+    def __init__(self, uploader, index_file=IMAGE_INDEX_FILE, remote_path=''):
+        self.uploader = uploader
+        self.index_file = index_file
+        self.remote_path = remote_path
+        self._lock = Lock()
+        self._index = _read_json(index_file, {})
+
+    def remote_name(self, image_file, digest):
+        """The name of an image in the store"""
+        return 'sha256-%s%s' % (digest, op.splitext(image_file)[1])
+
+    def lookup(self, digest, system):
+        """The remote path of the image with ``digest`` in a system, if stored"""
+        with self._lock:
+            entry = self._index.get(system, {}).get(digest)
+        return entry['remote'] if entry else None
+
+    def exists(self, remote, system):
+        """Whether a stored image is still in the remote system"""
+        remote_path, remote_fname = op.split(remote)
+        try:
+            return remote_fname in self.uploader.remote_files(remote_path, system)
+        except (IOError, OSError, RuntimeError) as error:
+            logger.warning('Could not list "%s" in "%s": %s', remote_path, system, error)
+            return False
+
+    def _forget(self, digest, system):
+        with self._lock:
+            self._index.get(system, {}).pop(digest, None)
+            if self.index_file:
+                _write_json(self._index, self.index_file)
+
+    def _record(self, digest, system, remote, image_file):
+        with self._lock:
+            self._index.setdefault(system, {})[digest] = {
+                'remote': remote, 'source': op.abspath(image_file), 'time': time()}
+            if self.index_file:
+                _write_json(self._index, self.index_file)
+
+    def put(self, image_file, system):
+        """
+        Stores an image in a system, unless it is already there. Returns
+        the same dictionary as ``Uploader.upload``, with the ``reused``
+        status when the image was found in the index.
+        """
+        digest = self.uploader.state.digest(image_file, self.uploader.chunk_size)
+        remote = self.lookup(digest, system)
+        if remote is not None and self.exists(remote, system):
+            logger.info('Image "%s" is stored in "%s" as "%s", reusing it',
+                        image_file, system, remote)
+            return {'local': image_file, 'remote': remote, 'system': system,
+                    'digest': digest, 'size': op.getsize(image_file), 'status': 'reused'}
+        if remote is not None:
+            logger.warning('Image "%s" is no longer in "%s", storing it again',
+                           remote, system)
+            self._forget(digest, system)
+
+        # Names are unique to the content, so existing copies are identical
+        # unless their upload did not complete
+        result = self.uploader.upload(
+            image_file, self.remote_path, remote_fname=self.remote_name(image_file, digest),
+            system=system, overwrite=True)
+        self._record(digest, system, result['remote'], image_file)
+        return result
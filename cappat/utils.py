@@ -7,16 +7,40 @@ Utilities: helper functions
 """
 import os
 from os import path as op
+from io import open
 from errno import EEXIST
+from uuid import uuid4
 
-def check_folder(folder):
+def check_folder(folder, mode=None):
     """
-    Creates a folder if it does not exist
+    Creates a folder if it does not exist (with permissions ``mode``)
     """
     if not op.exists(folder):
         try:
-            os.makedirs(folder)
+            if mode is None:
+                os.makedirs(folder)
+            else:
+                os.makedirs(folder, mode)
         except OSError as exc:
             if not exc.errno == EEXIST:
                 raise
     return folder
+
+
+def atomic_write(path, text, mode=None):
+    """
+    Writes ``text`` to a temporary file renamed to ``path``, so that
+    readers never see a partial file. The file is created with
+    permissions ``mode`` (by default, those of the umask).
+    """
+    # A random name, as several processes (or hosts) may share the folder
+    tmpfile = '%s.%s.tmp' % (path, uuid4().hex)
+    fdesc = os.open(tmpfile, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                    0o666 if mode is None else mode)
+    try:
+        with open(fdesc, 'w', encoding='utf-8') as tfh:
+            tfh.write(u'%s' % text)
+        os.rename(tmpfile, path)
+    except Exception:
+        os.remove(tmpfile)
+        raise
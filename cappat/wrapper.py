@@ -5,7 +5,11 @@
 """
 The Agave wrapper in python
 """
+import os
+import json
 from os import path as op, getenv
+from collections import Counter
+from heapq import heappush, heappop
 from glob import glob
 from random import shuffle
 from argparse import ArgumentParser, RawTextHelpFormatter
@@ -13,19 +17,24 @@ from textwrap import dedent
 import logging
 from yaml import load as loadyml
 from cappat import __version__, AGAVE_JOB_OUTPUT
+from cappat.metrics import METRICS
 
 
 wlogger = logging.getLogger('wrapper')
 
 
-def get_subject_list(bids_dir, participant_label=None, randomize=True):
+def get_subject_list(bids_dir, participant_label=None, randomize=True, index=None):
     """
     Returns a the list of subjects to be processed
 
     """
     # Build settings dict
     bids_dir = op.abspath(bids_dir)
-    all_subjects = sorted([op.basename(subj)[4:] for subj in glob(op.join(bids_dir, 'sub-*'))])
+    if index is not None:
+        all_subjects = sorted(index.subjects)
+    else:
+        all_subjects = sorted([op.basename(subj)[4:]
+                               for subj in glob(op.join(bids_dir, 'sub-*'))])
 
     if participant_label is None:
         participant_label = []
@@ -58,10 +67,204 @@ def get_subject_list(bids_dir, participant_label=None, randomize=True):
     return subject_list
 
 
+def get_subject_sizes(bids_dir, subject_list, index=None):
+    """
+    Returns the total size in bytes of the input data of each subject
+    """
+    if index is not None:
+        return index.sizes(subject_list)
+
+    sizes = {}
+    for subject in subject_list:
+        total = 0
+        for root, _, files in os.walk(op.join(op.abspath(bids_dir), 'sub-' + subject)):
+            total += sum(op.getsize(op.join(root, fname)) for fname in files)
+        sizes[subject] = total
+    return sizes
+
+
+def get_app_key(settings):
+    """
+    Returns the name and version of the app, as registered in Agave
+    """
+    app_id = (settings.get('agave') or {}).get('app_id')
+    if app_id and '-' in '%s' % app_id:
+        return tuple(('%s' % app_id).rsplit('-', 1))
+    return op.basename(settings['app']['executable'].split(' ')[-1]), ''
+
+
+def sort_by_runtime(subject_list, estimates):
+    """
+    Sorts subjects longest-first, so that the tail of the run finishes sooner.
+    Subjects without an estimate go first.
+    """
+    return sorted(subject_list, reverse=True,
+                  key=lambda s: float('inf') if estimates.get(s) is None
+                  else estimates[s])
+
+
+def get_subject_weights(subject_list, mode=True, estimates=None, index=None):
+    """
+    Returns the expected amount of work of each subject, used to balance
+    groups of participants. ``mode`` is one of ``runtime``, ``bytes``,
+    ``sessions``, or ``True`` for the best available (historical runtimes,
+    then input sizes). Returns ``None`` if no weights are available.
+    """
+    if not mode:
+        return None
+
+    if estimates is None:
+        estimates = {}
+
+    if mode == 'runtime' or (mode is True and estimates and all(
+            estimates.get(subj) is not None for subj in subject_list)):
+        return dict((subj, estimates.get(subj)) for subj in subject_list)
+
+    if index is None:
+        return None
+
+    if mode == 'sessions':
+        return dict((subj, max(1, len(index.sessions(subj)))) for subj in subject_list)
+    return index.sizes(subject_list)
+
+
+def balance_groups(subject_list, weights, group_size):
+    """
+    Partitions the subjects into groups of at most ``group_size`` with
+    roughly the same total weight (longest processing time first: each
+    subject, heaviest first, goes to the lightest group with room).
+    Subjects without weight are considered as heavy as the heaviest one.
+    Groups are returned heaviest first.
+    """
+    known = [weights[subj] for subj in subject_list if weights.get(subj) is not None]
+    default = max(known) if known else 1
+    work = dict((subj, default if weights.get(subj) is None else weights[subj])
+                for subj in subject_list)
+
+    ngroups = (len(subject_list) + group_size - 1) // group_size
+    groups = [[] for _ in range(ngroups)]
+    loads = [0] * ngroups
+    # The groups with room, lightest (and then first) on top
+    lightest = [(0, i) for i in range(ngroups)]
+    for subj in sorted(subject_list, key=lambda s: work[s], reverse=True):
+        _, idx = heappop(lightest)
+        groups[idx].append(subj)
+        loads[idx] += work[subj]
+        if len(groups[idx]) < group_size:
+            heappush(lightest, (loads[idx], idx))
+
+    wlogger.info('Balanced %d groups, work per group: %s', ngroups,
+                 ', '.join('%g' % load for load in sorted(loads, reverse=True)))
+    return [group for _, group in sorted(zip(loads, groups), key=lambda g: g[0],
+                                         reverse=True)]
+
+
+def get_task_runtimes(task_list, estimates):
+    """
+    Generates the walltime request of each task from the estimated
+    runtimes of its participants (``None`` if unknown)
+    """
+    from cappat.runtimedb import walltime
+    from cappat.manager.tools import task_participants, _secs2time
+
+    runtimes = []
+    for task in task_list:
+        secs = [estimates.get(s) for s in task_participants(task)]
+        if not secs or None in secs:
+            runtimes.append(None)
+        else:
+            runtimes.append(_secs2time(walltime(sum(secs))))
+    wlogger.info('Walltime requests per task: %s', ', '.join(
+        '%s' % runtime for runtime in runtimes))
+    return runtimes
+
+
+def record_job_metrics(stm, usage):
+    """
+    Records the runtime of each job and its queue wait, estimated as the
+    time from submission until it was found out of the queue minus its
+    runtime (hence, up to one polling interval longer than the real wait)
+    """
+    for jobid, (submitted, ended) in list(stm.job_times.items()):
+        job = usage.get(jobid)
+        if job is None or job['elapsed'] is None:
+            continue
+        METRICS.observe('job_runtime', job['elapsed'], jobid=jobid, state=job['state'])
+        if ended is not None:
+            METRICS.observe('queue_wait', max(0.0, ended - submitted - job['elapsed']),
+                            jobid=jobid)
+
+
+def write_accounting(path, stm, usage, app_key):
+    """
+    Writes the cpu and memory efficiency of each task and the summary
+    of the app (see ``cappat.manager.accounting``)
+    """
+    from cappat.manager.accounting import accounting_report, write_report
+    try:
+        return write_report(accounting_report(
+            usage, stm.job_tasks, stm.task_participants,
+            app='-'.join(part for part in app_key if part)), path)
+    except (IOError, OSError) as exc:
+        wlogger.warning('Could not write the accounting report: %s', exc)
+
+
+def record_runtimes(runtime_db, stm, app_key, sizes, usage=None):
+    """
+    Stores the runtime of each participant into the runtime database
+    and flags outliers. Participants grouped in one task are recorded
+    with an even share of its elapsed time.
+    """
+    if usage is None:
+        usage = stm.get_job_usage()
+    runs = []
+    for jobid, tasks in list(stm.job_tasks.items()):
+        # Jobs running several tasks (launcher) do not tell per task runtimes
+        if len(tasks) != 1 or jobid not in usage:
+            continue
+
+        job = usage[jobid]
+        subjects = stm.task_participants[tasks[0]]
+        # Approximation: the participants of a group run within one task,
+        # which only tells their total time, so it is split evenly among them
+        for subject in subjects:
+            runs.append({
+                'subject': subject,
+                'input_bytes': sizes.get(subject),
+                'elapsed': job['elapsed'] / len(subjects) if job['elapsed'] else None,
+                'maxrss': job['maxrss'],
+                'state': job['state'],
+            })
+
+    for run in runtime_db.outliers(app_key[0], app_key[1], runs):
+        wlogger.warning('Runtime of subject %s (%.0fs) is an outlier with respect '
+                        'to previous runs', run['subject'], run['elapsed'])
+    runtime_db.record(app_key[0], app_key[1], runs)
+    return runs
+
+
+def update_manifest(manifest, stm, output_dir):
+    """
+    Records the final state of the participants processed by the
+    submission manager into the run manifest
+    """
+    task_states = stm.task_states()
+    states = {}
+    jobids = {}
+    for jobid, tasks in list(stm.job_tasks.items()):
+        for task_index in tasks:
+            for subject in stm.task_participants[task_index]:
+                states[subject] = task_states[task_index]
+                jobids[subject] = jobid
+    manifest.update(states, output_dir, jobids)
+    return states
+
+
 def get_task_list(bids_dir, app_name, subject_list, group_size=1,
-                  workdir=False, args=None):
+                  workdir=False, args=None, weights=None):
     """
-    Generate a list of tasks for launcher or slurm
+    Generate a list of tasks for launcher or slurm. If the ``weights``
+    of the subjects are given, groups are balanced (see ``balance_groups``)
     """
     if not isinstance(group_size, int):
         try:
@@ -71,8 +274,12 @@ def get_task_list(bids_dir, app_name, subject_list, group_size=1,
 
         group_size = int(group_size)
 
-    groups = [sorted(subject_list[i:i+group_size])
-              for i in range(0, len(subject_list), group_size)]
+    if weights is not None and group_size > 1:
+        groups = [sorted(group) for group in balance_groups(
+            subject_list, weights, group_size)]
+    else:
+        groups = [sorted(subject_list[i:i+group_size])
+                  for i in range(0, len(subject_list), group_size)]
 
     task_list = []
     for i, part_group in enumerate(groups):
@@ -88,6 +295,25 @@ def get_task_list(bids_dir, app_name, subject_list, group_size=1,
     return task_list
 
 
+def check_group_detach(app_settings):
+    """
+    With ``group_detach``, the run exits as soon as the group job is queued
+    behind the participant jobs: their results are not collected. Refuses
+    ``resume`` (completed participants would never be recorded in the
+    manifest) and warns that ``runtime_db`` will not learn from the run.
+    """
+    levels = app_settings.get('level_plan', ['participant'])
+    if not ('group' in levels and app_settings.get('group_submit', False) and
+            app_settings.get('group_detach', False)):
+        return
+    if app_settings.get('resume', False):
+        raise RuntimeError('Settings group_detach and resume cannot be used together: '
+                           'the run exits before the participants are recorded')
+    if app_settings.get('runtime_db'):
+        wlogger.warning('With group_detach, the runtimes and the accounting report of '
+                        'the participant jobs are not recorded')
+
+
 def run_wrapper(opts):
     """
     A python wrapper to BIDS-Apps for Agave
@@ -101,6 +327,7 @@ def run_wrapper(opts):
 
     app_settings = settings['app']
     levels = app_settings.get('level_plan', ['participant'])
+    check_group_detach(app_settings)
 
     if not app_settings['bids_dir'].strip():
         raise RuntimeError('Missing BIDS directory')
@@ -116,11 +343,55 @@ def run_wrapper(opts):
         filename=op.join(log_dir, 'logfile.txt'),
         level=getattr(logging, app_settings.get('log_level', 'INFO')))
 
-    # Generate subjects list
-    subject_list = get_subject_list(
-        app_settings['bids_dir'],
-        app_settings.get('participant_label', None),
-        randomize=app_settings.get('randomize_part_level', True))
+    METRICS.reset()
+    with METRICS.timer('discovery'):
+        index = None
+        if app_settings.get('bids_index', False):
+            from cappat.bidsindex import BIDSIndex
+            index = BIDSIndex(app_settings['bids_dir'],
+                              cache_file=app_settings.get('bids_index_cache'),
+                              cache_dir=app_settings.get('bids_index_cache_dir')).build()
+
+        # Generate subjects list
+        subject_list = get_subject_list(
+            app_settings['bids_dir'],
+            app_settings.get('participant_label', None),
+            randomize=app_settings.get('randomize_part_level', True),
+            index=index)
+
+    if index is not None:
+        empty = index.empty(subject_list)
+        for subj in empty:
+            wlogger.warning('Skipping participant %s: no input files found', subj)
+        subject_list = [subj for subj in subject_list if subj not in empty]
+
+    manifest = None
+    completed = []
+    if app_settings.get('resume', False):
+        from cappat.manifest import RunManifest, settings_digest
+        manifest = RunManifest(op.join(log_dir, 'manifest.json'),
+                               settings_digest(app_settings))
+        completed = manifest.completed(subject_list, app_settings['output_dir'])
+        if completed:
+            wlogger.info('Resuming run, skipping %d completed participants: %s',
+                         len(completed), ' '.join(completed))
+        subject_list = [subj for subj in subject_list if subj not in completed]
+
+    run_participant = bool(subject_list)
+    if not run_participant:
+        wlogger.info('All participants were already completed')
+        # The submission manager still needs tasks to run the group level
+        subject_list = completed
+
+    runtime_db = None
+    estimates = {}
+    if app_settings.get('runtime_db'):
+        from cappat.runtimedb import RuntimeDB
+        runtime_db = RuntimeDB(app_settings['runtime_db'])
+        app_key = get_app_key(settings)
+        sizes = get_subject_sizes(app_settings['bids_dir'], subject_list, index=index)
+        estimates = runtime_db.estimates(app_key[0], app_key[1], subject_list, sizes)
+        subject_list = sort_by_runtime(subject_list, estimates)
 
     # Ensure modules is a list of modules
     if app_settings.get('modules'):
@@ -128,28 +399,169 @@ def run_wrapper(opts):
             app_settings['modules'] = [app_settings['modules']]
 
     # Generate tasks & submit
-    task_list = get_task_list(
-        app_settings['bids_dir'], app_settings['executable'], subject_list,
-        group_size=app_settings.get('parallel_npart', 1),
-        args=app_settings.get('participant_args'))
+    with METRICS.timer('task_generation'):
+        task_list = get_task_list(
+            app_settings['bids_dir'], app_settings['executable'], subject_list,
+            group_size=app_settings.get('parallel_npart', 1),
+            args=app_settings.get('participant_args'),
+            # Balanced groups replace the randomized partitioning, on request
+            weights=get_subject_weights(
+                subject_list, app_settings.get('balance_groups', False),
+                estimates=estimates, index=index))
+    METRICS.incr('subjects', len(subject_list) if run_participant else 0)
+    METRICS.incr('tasks', len(task_list) if run_participant else 0)
+
+    if any(est is not None for est in estimates.values()):
+        app_settings['task_runtimes'] = get_task_runtimes(task_list, estimates)
 
     app_settings['ncpus'] = getenv('CRNENV_SYSTEM_NCPUS', 16)
     # TaskManager factory will return the appropriate submission object
     stm = TaskManager.build(task_list, settings=app_settings)
-    # Participant level mapping
-    stm.map_participant()
-    # Participant level polling
-    stm.wait_participant()
-
-    # Group level reduce
-    if 'group' in levels:
+    if 'group' in levels and app_settings.get('group_incremental'):
+        # Reduce participants as they complete
+        stm.stream_grouplevel(app_settings['group_incremental'],
+                              args=app_settings.get('group_incremental_args'))
+
+    # Run the group level as a batch job instead of on this host
+    group_submit = 'group' in levels and app_settings.get('group_submit', False)
+    group_detach = group_submit and app_settings.get('group_detach', False)
+    # The group job can be queued right away behind the participant jobs, unless
+    # the participants to reduce are only known once they finished
+    group_early = (group_submit and run_participant and not app_settings.get('retry') and
+                   not app_settings.get('group_incremental') and
+                   not app_settings.get('federation'))
+
+    if getattr(opts, 'plan', None) is not None:
+        # Dry run: render the sbatch files, but do not submit them
         try:
-            stm.run_grouplevel()
-        except Exception:
-            wlogger.error('Error in execution of grouplevel command')
-            raise
+            write_plan(stm, subject_list if run_participant else [],
+                       opts.plan or op.join(log_dir, 'plan.json'),
+                       group='group' in levels, group_submit=group_submit,
+                       completed=completed)
+        finally:
+            stm.close()
+            if runtime_db is not None:
+                runtime_db.close()
+        return
+
+    try:
+        if run_participant:
+            # Participant level mapping
+            with METRICS.timer('submission'):
+                stm.map_participant()
+            METRICS.incr('jobs', len(stm.job_ids))
+            if group_early:
+                stm.submit_grouplevel(after_participants=True)
+                if group_detach:
+                    wlogger.info('Group level job %s will start after the participant '
+                                 'jobs, exiting now', stm.group_job)
+                    return
+            # Participant level polling
+            try:
+                with METRICS.timer('participant_wait'):
+                    stm.wait_participant()
+            finally:
+                usage = {}
+                try:
+                    usage = stm.get_job_usage()
+                except Exception as exc:
+                    wlogger.warning('Could not collect the usage of jobs: %s', exc)
+                record_job_metrics(stm, usage)
+                if usage:
+                    write_accounting(op.join(log_dir, 'accounting.json'), stm, usage,
+                                     get_app_key(settings))
+                if manifest is not None:
+                    update_manifest(manifest, stm, app_settings['output_dir'])
+                if runtime_db is not None:
+                    try:
+                        record_runtimes(runtime_db, stm, app_key, sizes, usage=usage)
+                    except Exception as exc:
+                        wlogger.warning('Could not record runtimes: %s', exc)
+
+        # Group level reduce
+        if 'group' in levels:
+            try:
+                with METRICS.timer('group_level'):
+                    if not group_submit:
+                        stm.run_grouplevel()
+                    else:
+                        if stm.group_job is None:
+                            stm.submit_grouplevel()
+                        if not group_detach:
+                            stm.wait_grouplevel()
+            except Exception:
+                wlogger.error('Error in execution of grouplevel command')
+                raise
+    finally:
+        # Clean up
+        stm.close()
+        if runtime_db is not None:
+            runtime_db.close()
+        write_metrics(log_dir, app_settings.get('metrics_textfile'))
+
+
+def write_plan(stm, subject_list, plan_file, group=False, group_submit=False,
+               completed=None):
+    """
+    Writes the execution plan of the run (see ``TaskSubmissionBase.plan``)
+    with its subjects and task grouping to ``plan_file``, and prints its
+    summary. No scheduler command is run.
+    """
+    plan = stm.plan(group=group_submit)
+    plan.update({
+        'subjects': subject_list,
+        'completed': completed or [],
+        'task_participants': stm.task_participants if subject_list else [],
+        'group_level': ('job' if group_submit else 'local') if group else None,
+    })
+    if not subject_list:
+        # Only the group level is left to run
+        plan['jobs'] = [job for job in plan['jobs'] if job.get('group')]
+        plan['tasks'] = 0
+        plan['submissions'] = plan['scheduler_jobs'] = len(plan['jobs'])
+        plan['core_hours'] = round(sum(job['core_hours'] for job in plan['jobs']), 2)
+
+    with open(plan_file, 'w') as pfh:
+        # Not indented, so that the C encoder is used with thousands of jobs
+        pfh.write(json.dumps(plan))
+
+    print('Execution plan ({}): {} subjects in {} tasks'.format(
+        plan['manager'], len(subject_list), plan['tasks']))
+    print('  {} submissions, {} jobs, {} core-hours (walltime up to {})'.format(
+        plan['submissions'], plan['scheduler_jobs'], plan['core_hours'],
+        plan['max_walltime']))
+    shapes = Counter()
+    for job in plan['jobs']:
+        shapes[(job['partition'], job['nodes'], job['cpus'], job['walltime'])] += job['jobs']
+    for (partition, nodes, cpus, walltime), njobs in sorted(
+            shapes.items(), key=lambda item: -item[1]):
+        print('  {:6d} x partition={} nodes={} cpus={} walltime={}'.format(
+            njobs, partition, nodes, cpus, walltime))
+    for backend, ntasks in list(plan.get('shards', {}).items()):
+        print('  backend {}: {} tasks'.format(backend, ntasks))
+    if group:
+        print('  group level: {}'.format(
+            'batch job' if group_submit else 'on this host'))
+    if plan['jobs']:
+        print('First sbatch script ({}):\n{}'.format(
+            plan['jobs'][0]['sbatch'], plan['jobs'][0]['script']))
+    print('Plan written to {}'.format(plan_file))
+    return plan
+
+
+def write_metrics(log_dir, textfile=None):
+    """
+    Writes the metrics of the run to ``<log_dir>/metrics.jsonl`` (and to a
+    Prometheus textfile, if given) and logs the summary table
+    """
+    try:
+        METRICS.write_jsonl(op.join(log_dir, 'metrics.jsonl'))
+        if textfile:
+            METRICS.write_prometheus(textfile)
+    except (IOError, OSError) as exc:
+        wlogger.warning('Could not write metrics: %s', exc)
+    wlogger.info('Run summary:\n%s', METRICS.summary())
 
-    # Clean up
 
 def parser():
     argparser = ArgumentParser(formatter_class=RawTextHelpFormatter, description=dedent('''\
@@ -161,6 +573,10 @@ def parser():
     argparser.add_argument('-v', '--version', action='version',
                         version='BIDS-Apps wrapper v{}'.format(__version__))
     argparser.add_argument('settings', action='store', help='settings file')
+    argparser.add_argument(
+        '--plan', action='store', nargs='?', const='', metavar='PLAN_FILE',
+        help='do not submit anything: only write the execution plan (jobs, resources,\n'
+             'core-hours and sbatch scripts) to PLAN_FILE (default: <log_dir>/plan.json)')
     return argparser
 
 def main():
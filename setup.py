@@ -2,15 +2,28 @@
 # -*- coding: utf-8 -*-
 
 PACKAGE_NAME = 'cappat'
+# Modules using syntax only available on Python 3 (package, module)
+PY3_MODULES = [('cappat.manager', 'aio')]
 
 def main():
     """ Install entry-point """
     from os import path as op
     from glob import glob
     from inspect import getfile, currentframe
+    import sys
     from setuptools import setup, find_packages
+    from setuptools.command.build_py import build_py
     from io import open  # pylint: disable=W0622
 
+    class BuildPy(build_py):
+        """Leaves out the Python 3 only modules when installing on Python 2"""
+        def find_package_modules(self, package, package_dir):
+            modules = build_py.find_package_modules(self, package, package_dir)
+            if sys.version_info[0] < 3:
+                modules = [module for module in modules
+                           if (module[0], module[1]) not in PY3_MODULES]
+            return modules
+
     this_path = op.dirname(op.abspath(getfile(currentframe())))
 
     # Python 3: use a locals dictionary
@@ -45,10 +58,12 @@ def main():
         ]},
         entry_points={'console_scripts': [
             'cappwrapp=cappat.wrapper:main',
-            'cappgen=cappat.appgen:main'
+            'cappgen=cappat.appgen:main',
+            'cappgen-bulk=cappat.bulk:main'
         ]},
         # scripts=glob('scripts/*'),
         zip_safe=False,
+        cmdclass={'build_py': BuildPy},
         # Dependencies handling
         setup_requires=ldict['SETUP_REQUIRES'],
         install_requires=ldict['REQUIRES'],